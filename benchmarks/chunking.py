@@ -0,0 +1,93 @@
+"""Compares chunking by characters with chunking by tokens: tokens per chunk, total tokens and embedding requests.
+
+The chunks of every page are queued in the embedding batcher with a fake embedder, like the sync does, so the
+number of requests follows EMBEDDING_BATCH_SIZE and EMBEDDING_BATCH_MAX_TOKENS. The corpus is generated, or read
+from a directory of pages in storage format (*.html, *.xml) exported from confluence.
+
+    python -m benchmarks.chunking --pages 500 --batch-size 16 --max-batch-tokens 50000
+    python -m benchmarks.chunking --corpus exported_pages/ --token-chunk-size 512
+"""
+import argparse
+import json
+import logging
+import statistics
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from benchmarks.fakes import FakeWiki, HashingEmbedder
+from confluence_vector_sync.confluence import ConfluenceWrapper, TOKEN_CHUNK_OVERLAP, TOKEN_CHUNK_SIZE
+from confluence_vector_sync.embedding import EmbeddingBatcher
+from confluence_vector_sync.parsing import StorageFormatChunker, fragments, token_counter
+
+
+def load_corpus(args) -> List[str]:
+    if args.corpus:
+        return [path.read_text() for path in sorted(Path(args.corpus).iterdir()) if path.suffix in (".html", ".xml")]
+    wiki = FakeWiki(spaces=1, pages=args.pages, page_bytes=args.page_bytes, seed=args.seed)
+    return [wiki.body(page_id) for page_id in wiki.page_ids(wiki.spaces[0])]
+
+
+def get_token_counter(model: str) -> Callable[[str], int]:
+    try:
+        count = token_counter(model)
+        count("tiktoken")
+        return count
+    except Exception:
+        # The encodings are downloaded on first use, estimate the tokens when that is not possible
+        logging.warning("tiktoken encoding not available, estimating token counts")
+        return lambda text: len(text) // 4 + 1
+
+
+def measure(name: str, pages: List[str], chunk_size: int, chunk_overlap: int, length: Callable[[str], int],
+            count_tokens: Callable[[str], int], args) -> Dict:
+    embedder = HashingEmbedder(dimensions=8, latency=0.0, latency_per_text=0.0)
+    batcher = EmbeddingBatcher(embedder, model=args.model, batch_size=args.batch_size,
+                               max_batch_tokens=args.max_batch_tokens)
+    batcher.count_tokens = count_tokens
+    tokens = []
+    for page_id, page in enumerate(pages):
+        chunks = list(StorageFormatChunker(chunk_size, chunk_overlap, length=length).chunks(fragments(page)))
+        docs = [{"id": f"{page_id}_{i}", "chunk": chunk, "chunkVector": None, "title": "", "titleVector": []}
+                for i, chunk in enumerate(chunks)]
+        counts = {chunk: count_tokens(chunk) for chunk in chunks}
+        tokens.extend(counts.values())
+        batcher.add(docs, counts)
+    batcher.flush()
+    return {"name": name,
+            "chunk_size": chunk_size,
+            "chunk_overlap": chunk_overlap,
+            "chunks": len(tokens),
+            "total_tokens": sum(tokens),
+            "mean_chunk_tokens": round(statistics.mean(tokens)),
+            "min_chunk_tokens": min(tokens),
+            "max_chunk_tokens": max(tokens),
+            "stdev_chunk_tokens": round(statistics.pstdev(tokens)),
+            "embedding_requests": embedder.requests,
+            "tokens_per_request": round(sum(tokens) / embedder.requests)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="directory of pages in storage format, instead of generated pages")
+    parser.add_argument("--pages", type=int, default=500)
+    parser.add_argument("--page-bytes", type=int, default=6000, help="median page size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model", default="text-embedding-ada-002")
+    parser.add_argument("--chunk-size", type=int, default=ConfluenceWrapper.chunk_size)
+    parser.add_argument("--chunk-overlap", type=int, default=ConfluenceWrapper.chunk_overlap)
+    parser.add_argument("--token-chunk-size", type=int, default=TOKEN_CHUNK_SIZE)
+    parser.add_argument("--token-chunk-overlap", type=int, default=TOKEN_CHUNK_OVERLAP)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-batch-tokens", type=int, default=50000)
+    args = parser.parse_args()
+
+    pages = load_corpus(args)
+    count_tokens = get_token_counter(args.model)
+    runs = [measure("characters", pages, args.chunk_size, args.chunk_overlap, len, count_tokens, args),
+            measure("tokens", pages, args.token_chunk_size, args.token_chunk_overlap, count_tokens, count_tokens,
+                    args)]
+    print(json.dumps({"parameters": vars(args), "pages": len(pages), "runs": runs}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""In-process stand-ins for Confluence, Azure AI Search and the embedding model.
+
+They let the sync run end to end without any of the services, for benchmarks and offline tests.
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+from azure.core.exceptions import ResourceNotFoundError
+from langchain_core.documents import Document
+
+from confluence_vector_sync.local_search import parse_filter
+
+WORDS = ("confluence search index vector page space chunk token embedding attachment release service team "
+         "deploy config pipeline document query cluster storage network runbook incident owner review").split()
+BASE_DATE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeWiki:
+    """A synthetic wiki: spaces of pages with attachments, all generated from the seed when requested.
+
+    Page sizes follow a log-normal distribution around page_bytes. edit() changes a page like a user would,
+    one paragraph and the modification date. With templates, pages start with the text of one of that many
+    templates, with the page filled in here and there, and end with the same footer.
+    """
+
+    def __init__(self, spaces: int = 2, pages: int = 50, attachments: int = 0, page_bytes: int = 4000,
+                 page_bytes_sigma: float = 0.8, attachment_bytes: int = 8000, templates: int = 0, seed: int = 0):
+        self.spaces = [f"SP{s}" for s in range(spaces)]
+        self.pages_per_space = pages
+        self.attachments_per_page = attachments
+        self.page_bytes = page_bytes
+        self.page_bytes_sigma = page_bytes_sigma
+        self.attachment_bytes = attachment_bytes
+        self.templates = templates
+        self.seed = seed
+        # page id -> number of edits and when the last one was made
+        self.edits: Dict[str, int] = {}
+        self.edited: Dict[str, datetime] = {}
+        self.removed = set()
+        # Attachments deleted from their page, the page itself is not modified
+        self.removed_attachments = set()
+
+    def page_ids(self, space_key: str) -> List[str]:
+        s = self.spaces.index(space_key)
+        return [str(s * self.pages_per_space + j + 1) for j in range(self.pages_per_space)]
+
+    def space_of(self, page_id: str) -> str:
+        return self.spaces[(int(page_id) - 1) // self.pages_per_space]
+
+    def modified(self, page_id: str) -> datetime:
+        return self.edited.get(page_id, BASE_DATE + timedelta(seconds=int(page_id)))
+
+    def page(self, page_id: str, expand: str = "") -> Dict:
+        space_key = self.space_of(page_id)
+        page = {"id": page_id,
+                "type": "page",
+                "status": "trashed" if page_id in self.removed else "current",
+                "title": f"Page {page_id}",
+                "space": {"key": space_key},
+                "version": {"when": self.modified(page_id).isoformat(timespec="milliseconds")},
+                "_links": {"webui": f"/spaces/{space_key}/pages/{page_id}/Page+{page_id}",
+                           "self": f"/rest/api/content/{page_id}"}}
+        if "body.storage" in expand:
+            page["body"] = {"storage": {"value": self.body(page_id), "representation": "storage"}}
+        return page
+
+    def paragraphs(self, key: str, size: int, edits: int) -> List[str]:
+        rng = random.Random(f"{self.seed}-{key}")
+        paragraphs = []
+        while sum(len(p) for p in paragraphs) < size:
+            paragraphs.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80))))
+        for edit in range(edits):
+            # An edit rewrites one paragraph
+            paragraphs[rng.randrange(len(paragraphs))] = f"Edit {edit}: " + " ".join(rng.sample(WORDS, 10))
+        return paragraphs
+
+    def body(self, page_id: str) -> str:
+        size = int(random.Random(f"{self.seed}-size-{page_id}").lognormvariate(0, self.page_bytes_sigma)
+                   * self.page_bytes)
+        paragraphs = self.paragraphs(page_id, size, self.edits.get(page_id, 0))
+        if self.templates:
+            template = self.paragraphs(f"template-{int(page_id) % self.templates}", self.page_bytes, 0)
+            # Every third paragraph of the template names the page
+            template = [f"{p} Page {page_id}." if i % 3 == 0 else p for i, p in enumerate(template)]
+            footer = self.paragraphs("footer", 600, 0)
+            paragraphs = template + paragraphs[:len(paragraphs) // 2] + footer
+        return "".join(f"<h2>Section {i}</h2><p>{p}</p>" if i % 5 == 0 else f"<p>{p}</p>"
+                       for i, p in enumerate(paragraphs))
+
+    def attachments(self, page_id: str) -> List[Dict]:
+        modified = int(BASE_DATE.timestamp() * 1000)
+        return [{"id": f"att{page_id}x{k}",
+                 "type": "attachment",
+                 "status": "current",
+                 "title": f"notes-{k}.txt",
+                 "metadata": {"mediaType": "text/plain"},
+                 "extensions": {"fileSize": len(self.attachment_content(page_id, f"notes-{k}.txt"))},
+                 "_links": {"download": f"/download/attachments/{page_id}/notes-{k}.txt"
+                                        f"?version=1&modificationDate={modified}&api=v2"}}
+                for k in range(self.attachments_per_page) if f"att{page_id}x{k}" not in self.removed_attachments]
+
+    def attachment_exists(self, attachment_id: str) -> bool:
+        page_id, k = re.fullmatch(r"att(\d+)x(\d+)", attachment_id).groups()
+        return page_id not in self.removed and int(k) < self.attachments_per_page and \
+            attachment_id not in self.removed_attachments
+
+    def attachment_content(self, page_id: str, name: str) -> bytes:
+        return "\n\n".join(self.paragraphs(f"{page_id}/{name}", self.attachment_bytes, 0)).encode()
+
+    def edit(self, fraction: float, seed: int = 1) -> List[str]:
+        """Edit a fraction of all pages, returns their ids"""
+        rng = random.Random(seed)
+        ids = [page_id for space_key in self.spaces for page_id in self.page_ids(space_key)]
+        edited = rng.sample(ids, int(len(ids) * fraction))
+        now = datetime.now(timezone.utc)
+        # Confluence keeps the dates to the millisecond
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        for page_id in edited:
+            self.edits[page_id] = self.edits.get(page_id, 0) + 1
+            self.edited[page_id] = now
+        return edited
+
+
+class FakeConfluenceServer:
+    """Serves the parts of the confluence REST api that the sync uses from a FakeWiki, counting the requests.
+
+    Also answers the index creation request of Azure AI Search, so it can be the search endpoint as well.
+    """
+
+    def __init__(self, wiki: FakeWiki, latency: float = 0.0):
+        self.wiki = wiki
+        self.latency = latency
+        self.requests: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Send headers and body in one segment, separate small writes wait for delayed acks
+            wbufsize = 1 << 16
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server.handle(self)
+
+            def do_PUT(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                server.respond(self, "index", 201, {})
+
+            def do_DELETE(self):
+                server.respond(self, "index", 204, None)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def total_requests(self) -> int:
+        return sum(self.requests.values())
+
+    def respond(self, handler, endpoint: str, status: int, body, content_type="application/json"):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        data = b"" if body is None else body if isinstance(body, bytes) else json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def handle(self, handler):
+        url = urlparse(handler.path)
+        path = unquote(url.path).strip("/")
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        start, limit = int(params.get("start", 0)), int(params.get("limit", 25))
+        wiki = self.wiki
+        if path == "rest/api/space":
+            results = [{"key": key, "type": "global"} for key in wiki.spaces][start:start + limit]
+            return self.respond(handler, "spaces", 200, {"results": results, "size": len(results)})
+        if match := re.fullmatch(r"rest/api/space/(\w+)", path):
+            if match[1] not in wiki.spaces:
+                return self.respond(handler, "space", 404, {"message": "not found"})
+            return self.respond(handler, "space", 200, {"key": match[1], "type": "global"})
+        if path == "rest/api/content":
+            ids = wiki.page_ids(params["spaceKey"])[start:start + limit]
+            results = [wiki.page(page_id, params.get("expand", "")) for page_id in ids]
+            return self.respond(handler, "pages", 200, {"results": results, "size": len(results)})
+        attachments_cql = re.match(r'space = "(\w+)" and type = attachment', params.get("cql", ""))
+        if path == "rest/api/content/search" and attachments_cql:
+            since = re.search(r'lastmodified >= "([\d-]+)"', params["cql"])
+            # All attachments were added at BASE_DATE
+            pages = [] if since and since[1] > f"{BASE_DATE:%Y-%m-%d}" else wiki.page_ids(attachments_cql[1])
+            attachments = [dict(attachment, container={"id": page_id, "type": "page"})
+                           for page_id in pages if page_id not in wiki.removed
+                           for attachment in wiki.attachments(page_id)]
+            results = attachments[start:start + limit]
+            return self.respond(handler, "attachment_inventory", 200, {"results": results, "size": len(results)})
+        if path == "rest/api/content/search":
+            ids = re.fullmatch(r"id in \((.*)\)", params["cql"])[1].split(",")
+            results = [wiki.page(page_id.strip(), params.get("expand", "")) for page_id in ids]
+            return self.respond(handler, "bodies", 200, {"results": results, "size": len(results)})
+        if path == "rest/api/search":
+            space_key = re.search(r'space = "(\w+)"', params["cql"])[1]
+            since = re.search(r'lastmodified >= "([\d-]+)"', params["cql"])
+            # CQL finds the current pages, modified on the day or later
+            ids = [page_id for page_id in wiki.page_ids(space_key) if page_id not in wiki.removed
+                   and not (since and f"{wiki.modified(page_id):%Y-%m-%d}" < since[1])][start:start + limit]
+            results = [{"content": wiki.page(page_id)} for page_id in ids]
+            return self.respond(handler, "cql", 200, {"results": results, "size": len(results)})
+        if match := re.fullmatch(r"rest/api/content/(\d+)/child/attachment", path):
+            results = wiki.attachments(match[1])
+            return self.respond(handler, "attachments", 200, {"results": results, "size": len(results)})
+        if match := re.fullmatch(r"rest/api/content/(\d+)", path):
+            return self.respond(handler, "page", 200, wiki.page(match[1], params.get("expand", "")))
+        if match := re.fullmatch(r"download/attachments/(\d+)/(.+)", path):
+            return self.respond(handler, "download", 200, wiki.attachment_content(match[1], match[2]),
+                                content_type="text/plain")
+        if match := re.fullmatch(r"(?:wiki/)?api/v2/attachments/(att\d+x\d+)", path):
+            if not wiki.attachment_exists(match[1]):
+                return self.respond(handler, "attachment", 404, {"message": "not found"})
+            return self.respond(handler, "attachment", 200, {"id": match[1], "status": "current"})
+        return self.respond(handler, "unknown", 404, {"message": f"unknown path {path}"})
+
+
+class FakeSearchClient:
+    """An in-memory index with the SearchClient methods the indexer uses, counting the requests"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.documents: Dict[str, Dict] = {}
+        self.requests: Dict[str, int] = {}
+        # The actions in order, with the keys of their documents
+        self.log: List[Tuple[str, List[str]]] = []
+        # Keys of the documents that the index refuses to write
+        self.rejected = set()
+        # Keys of the documents that the index is too busy to write, the next try succeeds
+        self.fail_once = set()
+        self.lock = threading.Lock()
+
+    def request(self, name: str):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def index_documents(self, action: str, documents: List[Dict]):
+        self.request(action)
+        results = []
+        with self.lock:
+            self.log.append((action, [doc["id"] for doc in documents]))
+            for doc in documents:
+                if doc["id"] in self.rejected:
+                    results.append(SimpleNamespace(key=doc["id"], succeeded=False, status_code=400,
+                                                   error_message="Document rejected"))
+                    continue
+                if doc["id"] in self.fail_once:
+                    self.fail_once.remove(doc["id"])
+                    results.append(SimpleNamespace(key=doc["id"], succeeded=False, status_code=503,
+                                                   error_message="Service unavailable"))
+                    continue
+                if action == "upload":
+                    self.documents[doc["id"]] = dict(doc)
+                elif action == "merge":
+                    if doc["id"] not in self.documents:
+                        results.append(SimpleNamespace(key=doc["id"], succeeded=False, status_code=404,
+                                                       error_message="Document not found"))
+                        continue
+                    self.documents[doc["id"]].update(doc)
+                else:
+                    self.documents.pop(doc["id"], None)
+                results.append(SimpleNamespace(key=doc["id"], succeeded=True, status_code=200, error_message=None))
+        return results
+
+    def upload_documents(self, documents):
+        return self.index_documents("upload", documents)
+
+    def merge_documents(self, documents):
+        return self.index_documents("merge", documents)
+
+    def delete_documents(self, documents):
+        return self.index_documents("delete", documents)
+
+    def get_document(self, key, selected_fields=None):
+        self.request("get")
+        with self.lock:
+            if key not in self.documents:
+                raise ResourceNotFoundError(f"Document {key} not found")
+            return select_fields(self.documents[key], selected_fields)
+
+    def search(self, search_text="*", filter=None, select=None, order_by=None, top=None, **kwargs):
+        self.request("search")
+        matches = parse_filter(filter) if filter else (lambda doc: True)
+        with self.lock:
+            results = [doc for doc in self.documents.values() if matches(doc)]
+        if order_by:
+            field, _, direction = order_by[0].partition(" ")
+            results.sort(key=lambda doc: doc.get(field) or "", reverse=direction == "desc")
+        if top is not None:
+            results = results[:top]
+        return [select_fields(doc, select) for doc in results]
+
+
+def select_fields(doc: Dict, fields: Optional[List[str]]) -> Dict:
+    return dict(doc) if not fields else {field: doc.get(field) for field in fields}
+
+
+class HashingEmbedder:
+    """Deterministic embeddings from the hash of the text, with the latency of a remote model"""
+
+    def __init__(self, dimensions: int = 1536, latency: float = 0.0, latency_per_text: float = 0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.latency_per_text = latency_per_text
+        self.requests = 0
+        self.texts = 0
+        self.lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self.lock:
+            self.requests += 1
+            self.texts += len(texts)
+        time.sleep(self.latency + self.latency_per_text * len(texts))
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimensions, dtype=np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+class TextMediaHandler:
+    """Media handler that splits a text file into paragraphs, instead of calling a document AI service.
+
+    latency simulates the round trip to the service.
+    """
+
+    def __init__(self, config: str = "", latency: float = 0.0):
+        self.config = config
+        self.latency = latency
+
+    def handle(self, file_path: str) -> List[Document]:
+        with open(file_path, "rb") as f:
+            return self.handle_bytes(f.read())
+
+    def handle_bytes(self, data: bytes) -> List[Document]:
+        time.sleep(self.latency)
+        return [Document(page_content=paragraph) for paragraph in data.decode().split("\n\n") if paragraph]
@@ -0,0 +1,99 @@
+"""Measures the cold start of the sync: the import time of its modules and what loading the config costs.
+
+Every measurement runs in a fresh interpreter with `python -X importtime`, the cumulative time of the module is
+the median of the repeats. The heaviest packages it pulls in (by the self time of their modules) and whether
+langchain, openai and the Azure SDKs are loaded after get_config() show what is left to defer. A media
+handler is configured so that get_config() has a handler to resolve. --compare measures another checkout
+the same way, for example the previous release:
+
+    python -m benchmarks.import_time
+    git worktree add /tmp/before HEAD~1 && python -m benchmarks.import_time --compare /tmp/before
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+MODULES = ["confluence_vector_sync.config", "confluence_vector_sync.sync", "confluence_vector_sync.distributed"]
+HEAVY_PACKAGES = ["langchain", "langchain_core", "langchain_community", "langchain_openai", "openai",
+                  "azure.monitor", "azure.ai.documentintelligence", "azure.search.documents"]
+HANDLER_ENV = {"MEDIA_HANDLER_KEY_1": "application/pdf,image/png",
+               "MEDIA_HANDLER_VALUE_1": "AzureDocumentIntelligenceMediaHandler",
+               "MEDIA_HANDLER_CONFIG_1": '{"ENDPOINT": "https://example.invalid", "API_KEY": "benchmark"}'}
+CONFIG_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from confluence_vector_sync.config import get_config
+get_config()
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "modules": sorted(sys.modules)}))
+"""
+
+
+def run(code: List[str], checkout: str) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=checkout, PYTHONWARNINGS="ignore", **HANDLER_ENV)
+    return subprocess.run([sys.executable, *code], cwd=checkout, env=env, capture_output=True, text=True,
+                          check=True)
+
+
+def parse_importtime(stderr: str) -> List[Dict]:
+    """(module, self_us, cumulative_us) of the lines of -X importtime"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append({"module": name.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us)})
+    return rows
+
+
+def measure_import(module: str, checkout: str, repeat: int, top: int) -> Dict:
+    totals = []
+    packages: Dict[str, int] = {}
+    for _ in range(repeat):
+        rows = parse_importtime(run(["-X", "importtime", "-c", f"import {module}"], checkout).stderr)
+        totals.append(next(row["cumulative_us"] for row in rows if row["module"] == module))
+        packages = {}
+        for row in rows:
+            package = row["module"].split(".")[0]
+            packages[package] = packages.get(package, 0) + row["self_us"]
+    heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {"module": module,
+            "import_ms": round(statistics.median(totals) / 1000, 1),
+            "heaviest_packages_ms": {package: round(us / 1000, 1) for package, us in heaviest}}
+
+
+def measure_config(checkout: str, repeat: int) -> Dict:
+    results = [json.loads(run(["-c", CONFIG_SCRIPT], checkout).stdout) for _ in range(repeat)]
+    modules = set(results[-1]["modules"])
+    return {"get_config_ms": round(statistics.median(result["seconds"] for result in results) * 1000, 1),
+            "modules_loaded": len(modules),
+            "heavy_packages_loaded": [package for package in HEAVY_PACKAGES if package in modules]}
+
+
+def measure(checkout: str, args) -> Dict:
+    return {"checkout": checkout,
+            "imports": [measure_import(module, checkout, args.repeat, args.top) for module in args.modules],
+            "config": measure_config(checkout, args.repeat)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per measurement")
+    parser.add_argument("--top", type=int, default=8, help="heaviest packages to list per module")
+    parser.add_argument("--compare", help="another checkout of the repository to measure the same way")
+    args = parser.parse_args()
+
+    runs = [measure(str(Path(__file__).resolve().parent.parent), args)]
+    if args.compare:
+        runs.insert(0, measure(str(Path(args.compare).resolve()), args))
+    print(json.dumps({"parameters": vars(args), "python": sys.version.split()[0], "runs": runs}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
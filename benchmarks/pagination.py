@@ -0,0 +1,120 @@
+"""Counts the confluence requests needed to list a synthetic space and fetch the bodies of its pages.
+
+Compares the previous listing (limit growing with the offset, one body request per page) with the
+fixed page size / v2 cursor listing and the bulk body fetch. Nothing is sent over the network.
+
+    python -m benchmarks.pagination --pages 5000 --server-max-limit 1000
+"""
+import argparse
+import json
+import time
+from urllib.parse import parse_qs, urlparse
+
+from confluence_vector_sync.confluence import ConfluenceWrapper
+
+
+class FakeConfluence:
+    """Answers the listing calls of the atlassian client for one space, counting requests and returned results"""
+    url = "https://example.atlassian.net/wiki"
+
+    def __init__(self, pages: int, server_max_limit: int):
+        self.pages = [{"id": str(i),
+                       "title": f"Page {i}",
+                       "status": "current",
+                       "space": {"key": "BENCH"},
+                       "version": {"when": "2024-01-01T00:00:00.000Z", "createdAt": "2024-01-01T00:00:00.000Z"},
+                       "_links": {"webui": f"/spaces/BENCH/pages/{i}/Page+{i}",
+                                  "self": f"{self.url}/rest/api/content/{i}"}} for i in range(pages)]
+        self.by_id = {page["id"]: page for page in self.pages}
+        self.server_max_limit = server_max_limit
+        self.requests = 0
+        self.results = 0
+
+    def respond(self, results):
+        self.requests += 1
+        self.results += len(results)
+        return results
+
+    def get_all_pages_from_space(self, space_key, start=0, limit=100, **kwargs):
+        return self.respond(self.pages[start:start + min(limit, self.server_max_limit)])
+
+    def get_page_by_id(self, page_id, expand=None):
+        return self.respond([dict(self.by_id[page_id], body={"storage": {"value": f"<p>{page_id}</p>"}})])[0]
+
+    def get(self, path, params=None, absolute=False):
+        if absolute:
+            url = urlparse(path)
+            path, params = url.path.removeprefix("/wiki/"), {k: v[0] for k, v in parse_qs(url.query).items()}
+        if path == "api/v2/spaces":
+            return {"results": self.respond([{"id": "1", "key": params["keys"]}])}
+        if path == "api/v2/spaces/1/pages":
+            start = int(params.get("cursor", 0))
+            limit = min(int(params["limit"]), 250)
+            results = self.respond(self.pages[start:start + limit])
+            links = {}
+            if start + limit < len(self.pages):
+                links["next"] = f"/wiki/api/v2/spaces/1/pages?cursor={start + limit}&limit={limit}"
+            return {"results": results, "_links": links}
+        # Bulk body fetch, v2 by id list and v1 by CQL
+        ids = params["id"].split(",") if "id" in params else params["cql"][len("id in ("):-1].split(",")
+        return {"results": self.respond([dict(self.by_id[i], body={"storage": {"value": f"<p>{i}</p>"}})
+                                         for i in ids])}
+
+
+def legacy_listing(confluence: FakeConfluence):
+    """The listing before the fix: the requested limit grows with the offset"""
+    results = []
+    i = 0
+    while True:
+        iter_results = confluence.get_all_pages_from_space("BENCH", start=i, limit=i + 100)
+        if len(iter_results) == 0:
+            break
+        results.extend(iter_results)
+        i += 100
+    for page in results:
+        confluence.get_page_by_id(page["id"], expand="body.storage")
+    return len(results)
+
+
+def paged_listing(wrapper: ConfluenceWrapper):
+    pages = [wrapper.page_header(page, "BENCH") for page in wrapper.get_pages("BENCH")]
+    for page in wrapper.with_page_bodies(pages):
+        wrapper.get_page_content(page)
+    return len(pages)
+
+
+def measure(name, pages, server_max_limit, run):
+    confluence = FakeConfluence(pages, server_max_limit)
+    start = time.perf_counter()
+    listed = run(confluence)
+    return {"name": name,
+            "requests": confluence.requests,
+            "results_returned": confluence.results,
+            "pages_listed": listed,
+            "seconds": round(time.perf_counter() - start, 3)}
+
+
+def wrapper_for(confluence: FakeConfluence, api_version: str, page_size: int, body_batch_size: int):
+    wrapper = ConfluenceWrapper(url=confluence.url, username="bench", password="bench", api_version=api_version,
+                                page_size=page_size, body_batch_size=body_batch_size)
+    wrapper.confluence = confluence
+    return wrapper
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=5000)
+    parser.add_argument("--server-max-limit", type=int, default=1000,
+                        help="largest limit the fake server honors for v1 listings")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--body-batch-size", type=int, default=25)
+    args = parser.parse_args()
+    results = [measure("legacy", args.pages, args.server_max_limit, legacy_listing)]
+    for api_version, page_size in (("v1", args.page_size), ("v2", 250)):
+        results.append(measure(api_version, args.pages, args.server_max_limit,
+                               lambda c: paged_listing(wrapper_for(c, api_version, page_size, args.body_batch_size))))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
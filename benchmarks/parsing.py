@@ -0,0 +1,69 @@
+"""Compares the single pass storage format chunker with parsing by BeautifulSoup and splitting the text after.
+
+The pages are generated like the pages of the sync benchmark, with a share of large pages. Reports the time,
+throughput, peak traced memory and chunk sizes of both.
+
+    python -m benchmarks.parsing --pages 200 --page-bytes 20000
+"""
+import argparse
+import json
+import statistics
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from bs4 import BeautifulSoup
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from benchmarks.fakes import FakeWiki
+from confluence_vector_sync.confluence import ConfluenceWrapper
+from confluence_vector_sync.parsing import split_storage_format
+
+
+def split_with_beautifulsoup(content: str, chunk_size: int, chunk_overlap: int) -> List[Dict]:
+    """The previous parsing: get_text of the whole page, then a new splitter for every page"""
+    text = BeautifulSoup(content, 'html.parser').get_text()
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return [{"text": chunk, "chunk": i} for i, chunk in enumerate(text_splitter.split_text(text))]
+
+
+def measure(name: str, split: Callable, pages: List[str], chunk_size: int, chunk_overlap: int) -> Dict:
+    start = time.perf_counter()
+    chunks = [split(page, chunk_size, chunk_overlap) for page in pages]
+    seconds = time.perf_counter() - start
+    # Memory is traced in a second pass, tracing slows the parsers down
+    tracemalloc.start()
+    split(max(pages, key=len), chunk_size, chunk_overlap)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    sizes = [len(chunk["text"]) for page_chunks in chunks for chunk in page_chunks]
+    megabytes = sum(len(page) for page in pages) / 1e6
+    return {"name": name,
+            "seconds": round(seconds, 3),
+            "pages_per_second": round(len(pages) / seconds, 1),
+            "megabytes_per_second": round(megabytes / seconds, 2),
+            "peak_kb_largest_page": round(peak / 1024),
+            "chunks": len(sizes),
+            "mean_chunk_chars": round(statistics.mean(sizes)),
+            "max_chunk_chars": max(sizes)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--page-bytes", type=int, default=20000, help="median page size")
+    parser.add_argument("--chunk-size", type=int, default=ConfluenceWrapper.chunk_size)
+    parser.add_argument("--chunk-overlap", type=int, default=ConfluenceWrapper.chunk_overlap)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    wiki = FakeWiki(spaces=1, pages=args.pages, page_bytes=args.page_bytes, seed=args.seed)
+    pages = [wiki.body(page_id) for page_id in wiki.page_ids(wiki.spaces[0])]
+    runs = [measure("beautifulsoup", split_with_beautifulsoup, pages, args.chunk_size, args.chunk_overlap),
+            measure("single_pass", split_storage_format, pages, args.chunk_size, args.chunk_overlap)]
+    print(json.dumps({"parameters": vars(args), "megabytes": round(sum(map(len, pages)) / 1e6, 2), "runs": runs},
+                     indent=2))
+
+
+if __name__ == "__main__":
+    main()
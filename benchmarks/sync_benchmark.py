@@ -0,0 +1,182 @@
+"""Runs sync.sync end to end against in-process fakes and reports throughput as JSON.
+
+A fake confluence REST server generates the wiki, the Azure AI Search client is an in-memory index and the
+embedder hashes the texts. The first run indexes everything, the optional second run after editing a
+fraction of the pages measures updates. With --shard-workers the run is split into shards that are indexed by
+that many workers, threads here with one indexer each, like the processes of the distributed mode.
+
+    python -m benchmarks.sync_benchmark --spaces 4 --pages 250 --attachments 1 --edit-fraction 0.1
+    python -m benchmarks.sync_benchmark --spaces 4 --pages 250 --shard-workers 4 --shard-buckets 2
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from benchmarks.fakes import FakeConfluenceServer, FakeSearchClient, FakeWiki, HashingEmbedder, TextMediaHandler
+from confluence_vector_sync.azure_ai_search import AzureAISearchIndexer
+from confluence_vector_sync.config import get_config
+from confluence_vector_sync.distributed import coordinate, run_worker
+from confluence_vector_sync.parsing import get_encoding
+from confluence_vector_sync.search import search_indexer_from_config
+from confluence_vector_sync.sync import sync
+
+
+def make_config(server: FakeConfluenceServer, **overrides) -> Dict:
+    """A config that points confluence and the search endpoint at the fake server, without rate limits"""
+    config = get_config()
+    config.update({"confluence_url": server.url,
+                   "confluence_user_name": "benchmark",
+                   "confluence_password": "benchmark",
+                   "confluence_auth_method": "PASSWORD",
+                   "confluence_extra_headers": [],
+                   "confluence_space_filter": list(server.wiki.spaces),
+                   "azure_search_endpoint": server.url.rstrip("/"),
+                   "azure_search_key": "benchmark",
+                   "azure_search_confluence_index": "benchmark",
+                   "azure_search_full_reindex": False,
+                   "embedding_cache_path": "",
+                   "index_attachments": server.wiki.attachments_per_page > 0,
+                   "media_handlers": [{"text/plain": TextMediaHandler()}],
+                   "confluence_incremental": False})
+    for service in ("confluence", "embedding", "azure_search"):
+        config[f"{service}_max_rps"] = 10000
+        config[f"{service}_max_concurrency"] = 64
+    config.update(overrides)
+    return config
+
+
+def make_indexer(config: Dict, client: Optional[FakeSearchClient], embedder: HashingEmbedder
+                 ) -> AzureAISearchIndexer:
+    """The indexer of the config with the embedding model, and the search client if given, replaced by the fakes"""
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    indexer = search_indexer_from_config(config)
+    if client is not None:
+        indexer.client = client
+        indexer.writer.client = client
+    indexer.embedder = embedder
+    indexer.embedding_batcher.embedder = embedder
+    try:
+        get_encoding(config["azure_search_embedding_model"]).encode("tiktoken")
+    except Exception:
+        # The encodings are downloaded on first use, estimate the tokens when that is not possible
+        logging.warning("tiktoken encoding not available, estimating token counts")
+        indexer.embedding_batcher.count_tokens = lambda text: len(text) // 4 + 1
+    return indexer
+
+
+def sync_sharded(config: Dict, client: FakeSearchClient, embedder: HashingEmbedder, workers: int) -> Dict:
+    """The coordinator of the distributed mode with worker threads, each with an indexer of its own"""
+    with ThreadPoolExecutor(max_workers=workers + 1) as pool:
+        coordinator = pool.submit(coordinate, config, workers=0, search=make_indexer(config, client, embedder),
+                                  poll_seconds=0.01)
+        # The workers wait for the shards of this run, the queue does not exist yet
+        while not os.path.exists(config["shard_queue_path"]):
+            time.sleep(0.01)
+        for n in range(workers):
+            pool.submit(run_worker, config, worker=f"worker-{n}", search=make_indexer(config, client, embedder),
+                        poll_seconds=0.01)
+        return coordinator.result()
+
+
+def measure(name: str, server: FakeConfluenceServer, client: Optional[FakeSearchClient], embedder: HashingEmbedder,
+            config: Dict, shard_workers: int = 0) -> Dict:
+    confluence_requests = dict(server.requests)
+    search_requests = dict(client.requests) if client else {}
+    embedded = embedder.texts
+    indexer = make_indexer(config, client, embedder)
+    start = time.perf_counter()
+    if shard_workers:
+        diagnostics = sync_sharded(config, client, embedder, shard_workers)
+    else:
+        diagnostics = sync(config=config, search=indexer)
+    seconds = time.perf_counter() - start
+    counts = diagnostics["counts"]
+    pages = len(server.wiki.spaces) * server.wiki.pages_per_space
+    indexed = counts["create"] + counts["update"]
+    http_calls = {key: value - confluence_requests.get(key, 0) for key, value in server.requests.items()}
+    return {"name": name,
+            "seconds": round(seconds, 3),
+            "pages": pages,
+            "pages_indexed": indexed,
+            "pages_per_second": round(pages / seconds, 2),
+            "indexed_pages_per_second": round(indexed / seconds, 2),
+            "confluence_requests": http_calls,
+            "confluence_requests_per_page": round(sum(http_calls.values()) / pages, 3),
+            "search_requests": {key: value - search_requests.get(key, 0)
+                                for key, value in (client.requests if client else {}).items()},
+            "texts_embedded": embedder.texts - embedded,
+            "documents_in_index": len(indexer.client.documents),
+            # ru_maxrss is in kilobytes on linux
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "counts": counts,
+            "stages": diagnostics["pipeline"],
+            "embedding": diagnostics["embedding"],
+            "upload": diagnostics["upload"],
+            "dedup": diagnostics["dedup"],
+            "attachments": diagnostics["attachments"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--spaces", type=int, default=2)
+    parser.add_argument("--pages", type=int, default=100, help="pages per space")
+    parser.add_argument("--attachments", type=int, default=0, help="attachments per page")
+    parser.add_argument("--page-bytes", type=int, default=4000, help="median page size")
+    parser.add_argument("--page-bytes-sigma", type=float, default=0.8, help="sigma of the log-normal page size")
+    parser.add_argument("--attachment-bytes", type=int, default=8000)
+    parser.add_argument("--templates", type=int, default=0,
+                        help="pages are made from this many templates and share a footer")
+    parser.add_argument("--dedup", choices=["off", "exact", "near"], default="off", help="DEDUP_CHUNKS")
+    parser.add_argument("--dedup-drop-after", type=int, default=0, help="DEDUP_DROP_AFTER")
+    parser.add_argument("--confluence-latency", type=float, default=0.0, help="seconds per confluence request")
+    parser.add_argument("--search-latency", type=float, default=0.0, help="seconds per search request")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per embedding request")
+    parser.add_argument("--embedding-latency-per-text", type=float, default=0.001)
+    parser.add_argument("--extraction-latency", type=float, default=0.0, help="seconds per attachment extraction")
+    parser.add_argument("--attachment-workers", type=int, default=8)
+    parser.add_argument("--edit-fraction", type=float, default=0.0,
+                        help="edit this fraction of the pages and sync again")
+    parser.add_argument("--local-index", help="sync to a local vector store in this directory instead of the fake "
+                                              "Azure AI Search client")
+    parser.add_argument("--shard-workers", type=int, default=0,
+                        help="index with the distributed mode and this many workers")
+    parser.add_argument("--shard-buckets", type=int, default=1, help="shards per space of the distributed mode")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    wiki = FakeWiki(spaces=args.spaces, pages=args.pages, attachments=args.attachments, page_bytes=args.page_bytes,
+                    page_bytes_sigma=args.page_bytes_sigma, attachment_bytes=args.attachment_bytes,
+                    templates=args.templates, seed=args.seed)
+    client = None if args.local_index else FakeSearchClient(latency=args.search_latency)
+    embedder = HashingEmbedder(latency=args.embedding_latency, latency_per_text=args.embedding_latency_per_text)
+    with FakeConfluenceServer(wiki, latency=args.confluence_latency) as server:
+        config = make_config(server, media_handlers=[{"text/plain": TextMediaHandler(latency=args.extraction_latency)}],
+                             attachment_workers=args.attachment_workers, dedup_chunks=args.dedup,
+                             dedup_drop_after=args.dedup_drop_after)
+        if args.local_index:
+            config.update({"search_type": "LOCAL", "local_index_path": args.local_index})
+        shard_dir = tempfile.TemporaryDirectory()
+        config.update({"shard_queue_path": os.path.join(shard_dir.name, "shards.db"),
+                       "shard_buckets": args.shard_buckets})
+        runs = [measure("full", server, client, embedder, config, args.shard_workers)]
+        if args.edit_fraction:
+            wiki.edit(args.edit_fraction, seed=args.seed)
+            runs.append(measure("edit", server, client, embedder, config, args.shard_workers))
+        shard_dir.cleanup()
+    results = json.dumps({"parameters": vars(args), "runs": runs}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(results)
+    else:
+        print(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Compares the size of the index and of the uploads for vector dimensions, title vectors and quantization.
+
+Each combination of EMBEDDING_DIMENSIONS and TITLE_VECTOR_CHUNKS syncs a generated wiki to the in-memory search
+client, which gives the bytes uploaded, and to local vector stores with float32 and int8 vectors, which gives their
+size on disk. The vector index of Azure AI Search is estimated from the number of vectors: 4 bytes per dimension,
+1 with scalar (int8) and 1/8 with binary quantization. The full precision vectors that rescoring uses are kept on
+disk next to them, outside of the vector index quota.
+
+    python -m benchmarks.vector_storage --spaces 2 --pages 100 --dimensions 1536 1024 256
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+from typing import Dict
+
+from benchmarks.fakes import FakeConfluenceServer, FakeSearchClient, FakeWiki, HashingEmbedder
+from benchmarks.sync_benchmark import make_config, make_indexer
+from confluence_vector_sync.sync import sync
+
+# Bytes per dimension of a vector in the vector index, by AZURE_SEARCH_VECTOR_COMPRESSION
+COMPRESSION_BYTES = {"none": 4, "scalar": 1, "binary": 1 / 8}
+
+
+def directory_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def measure(server: FakeConfluenceServer, dimensions: int, title_vector_chunks: str) -> Dict:
+    embedder = HashingEmbedder(dimensions=dimensions)
+    config = make_config(server, embedding_dimensions=dimensions, title_vector_chunks=title_vector_chunks)
+    client = FakeSearchClient()
+    diagnostics = sync(config=config, search=make_indexer(config, client, embedder))
+    vectors = sum(1 for doc in client.documents.values() for field in ("titleVector", "chunkVector") if doc[field])
+    result = {"dimensions": dimensions,
+              "title_vector_chunks": title_vector_chunks,
+              "documents": len(client.documents),
+              "vectors": vectors,
+              "upload_bytes": diagnostics["upload"]["bytes"],
+              "azure_vector_index_bytes": {compression: round(vectors * dimensions * size)
+                                           for compression, size in COMPRESSION_BYTES.items()},
+              "local_index_bytes": {}}
+    for quantization in ("float32", "int8"):
+        with tempfile.TemporaryDirectory() as path:
+            local = dict(config, search_type="LOCAL", local_index_path=path, local_index_quantization=quantization)
+            sync(config=local, search=make_indexer(local, None, embedder))
+            result["local_index_bytes"][quantization] = directory_size(path)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--spaces", type=int, default=2)
+    parser.add_argument("--pages", type=int, default=100, help="pages per space")
+    parser.add_argument("--page-bytes", type=int, default=4000, help="median page size")
+    parser.add_argument("--dimensions", type=int, nargs="+", default=[1536, 1024, 256])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    wiki = FakeWiki(spaces=args.spaces, pages=args.pages, page_bytes=args.page_bytes, seed=args.seed)
+    with FakeConfluenceServer(wiki) as server:
+        runs = [measure(server, dimensions, title_vector_chunks)
+                for dimensions in args.dimensions for title_vector_chunks in ("all", "first")]
+    print(json.dumps({"parameters": vars(args), "runs": runs}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,74 @@
+import contextvars
+import hashlib
+import io
 import logging
-from typing import List
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Tuple
 
-from langchain_core.documents import Document
+from confluence_vector_sync import otel
+from confluence_vector_sync.extraction_cache import ExtractionCache, content_key, version_key
+from confluence_vector_sync.handlers import LazyMediaHandler
+
+if TYPE_CHECKING:
+    # langchain is imported by the media handlers, when they are used
+    from langchain_core.documents import Document
+
+
+class SpooledDownload:
+    """A downloaded attachment, kept in memory up to spool_bytes and written to a temporary file when it is larger"""
+
+    def __init__(self, spool_bytes: int):
+        self.spool_bytes = spool_bytes
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self.path: Optional[str] = None
+        self.buffer = io.BytesIO()
+        self.file = None
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        self.digest.update(chunk)
+        if self.file is None and self.size > self.spool_bytes:
+            self.file = tempfile.NamedTemporaryFile(delete=False)
+            self.path = self.file.name
+            self.file.write(self.buffer.getvalue())
+            self.buffer = None
+        if self.file is not None:
+            self.file.write(chunk)
+        else:
+            self.buffer.write(chunk)
+
+    def finish(self):
+        if self.file is not None:
+            self.file.close()
+
+    @property
+    def in_memory(self) -> bool:
+        return self.buffer is not None
+
+    def getvalue(self) -> bytes:
+        if self.in_memory:
+            return self.buffer.getvalue()
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def to_file(self) -> str:
+        """Path of the content, for handlers that read files. Spooled content is written out first"""
+        if self.path is None:
+            with tempfile.NamedTemporaryFile(delete=False) as f:
+                f.write(self.buffer.getvalue())
+            self.path = f.name
+        return self.path
+
+    def close(self):
+        self.finish()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        self.buffer = None
 
 
 class AttachmentLoader:
@@ -9,19 +76,159 @@ class AttachmentLoader:
 
     handlers = {}
 
-    def __init__(self, media_handlers: List):
+    def __init__(self, media_handlers: List, cache: ExtractionCache = None):
         # It's a list of key-value pair dicts, but we want a single dict
         self.handlers = {k: v for d in media_handlers for k, v in d.items()}
+        self.cache = cache
 
-    def load(self, file_path: str, media_type: str) -> List[Document]:
+    def load(self, file_path: str, media_type: str) -> List['Document']:
         """Index attached file with the appropriate handler."""
 
         if self.can_handle(media_type):
-            return self.handlers[media_type].handle(file_path)
+            return self.handler(media_type).handle(file_path)
         else:
             logging.warning(f"No handler for mediatype {media_type} found")
 
+    def cached(self, attachment: Dict) -> Optional[List['Document']]:
+        """Documents extracted before from this version of the attachment, None when it has to be downloaded"""
+        if self.cache is None:
+            return None
+        documents = self.cache.get(version_key(attachment, self.handler(attachment["metadata"]["mediaType"])))
+        if documents is not None:
+            self.cache.count("hits")
+        return documents
+
+    def load_download(self, download: SpooledDownload, media_type: str, attachment: Dict = None) -> List['Document']:
+        """Index a downloaded attachment, from memory when the handler has handle_bytes.
+
+        With a cache, the same content extracted before (under another version) is not extracted again.
+        """
+        handler = self.handler(media_type) if self.can_handle(media_type) else None
+        keys = []
+        if self.cache is not None and attachment is not None:
+            keys = [version_key(attachment, handler), content_key(download.digest.hexdigest(), handler)]
+            documents = self.cache.get(keys[1])
+            if documents is not None:
+                self.cache.count("content_hits")
+                self.cache.put(keys[:1], documents)
+                return documents
+            self.cache.count("misses")
+        if download.in_memory and hasattr(handler, "handle_bytes"):
+            documents = handler.handle_bytes(download.getvalue())
+        else:
+            documents = self.load(download.to_file(), media_type)
+        # Empty results are not cached, handlers also return nothing when the extraction failed
+        if keys and documents:
+            self.cache.put(keys, documents)
+        return documents
+
+    def handler(self, media_type: str):
+        """The handler of the media type, a lazy handler is imported and created here"""
+        handler = self.handlers[media_type]
+        return handler.get() if isinstance(handler, LazyMediaHandler) else handler
+
     def can_handle(self, media_type: str) -> bool:
         """Check if a handler for the given mediatype exists."""
 
         return media_type in self.handlers
+
+
+class ByteBudget:
+    """Bounds the bytes of the attachments that are downloaded or extracted at the same time.
+
+    An attachment larger than the budget is let through when nothing else is in flight.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size: int):
+        with self.condition:
+            while self.in_flight and self.in_flight + size > self.max_bytes:
+                self.condition.wait()
+            self.in_flight += size
+            self.peak = max(self.peak, self.in_flight)
+
+    def release(self, size: int):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+
+class AttachmentExtractor:
+    """Downloads and extracts the attachments of a page concurrently.
+
+    Each attachment is downloaded and then handed to its media handler by a worker of a pool that is shared by
+    all pages, so downloads overlap with the (remote) extraction of other attachments. Small attachments stay in
+    memory, the budget on in-flight bytes keeps the memory and disk use bounded.
+    """
+
+    def __init__(self, confluence, loader: AttachmentLoader, workers: int = 8,
+                 max_in_flight_bytes: int = 64 * 1024 * 1024, spool_bytes: int = 1024 * 1024):
+        self.confluence = confluence
+        self.loader = loader
+        self.workers = workers
+        self.spool_bytes = spool_bytes
+        self.budget = ByteBudget(max_in_flight_bytes)
+        self.pool = None
+        self.lock = threading.Lock()
+        # Attachments downloaded and extracted, not taken from the cache, their bytes and chunks and the seconds
+        self.stats = {"extracted": 0, "bytes": 0, "chunks": 0, "seconds": 0.0}
+
+    def extract(self, attachments: Iterable[Dict]) -> Iterator[Tuple[Dict, List['Document']]]:
+        """Yields (attachment, chunks) in the order of the attachments, errors are raised"""
+        attachments = list(attachments)
+        if self.workers <= 0 or len(attachments) < 2:
+            for attachment in attachments:
+                yield attachment, self.extract_one(attachment)
+            return
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="attachment")
+        # The workers run in a copy of the caller's context, so their spans nest under the page
+        futures = [self.pool.submit(contextvars.copy_context().run, self.extract_one, attachment)
+                   for attachment in attachments]
+        try:
+            for attachment, future in zip(attachments, futures):
+                yield attachment, future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def extract_one(self, attachment: Dict) -> List['Document']:
+        media_type = attachment["metadata"]["mediaType"]
+        cached = self.loader.cached(attachment)
+        if cached is not None:
+            return cached
+        size = attachment_size(attachment) or self.spool_bytes
+        self.budget.acquire(size)
+        download = None
+        documents = []
+        start = time.perf_counter()
+        try:
+            download = self.confluence.download_attachment(attachment, self.spool_bytes)
+            with otel.stage("attachment.extract", media_type=media_type, in_memory=download.in_memory):
+                documents = self.loader.load_download(download, media_type, attachment) or []
+            return documents
+        finally:
+            if download is not None:
+                download.close()
+            self.budget.release(size)
+            with self.lock:
+                self.stats["extracted"] += 1
+                self.stats["bytes"] += download.size if download is not None else 0
+                self.stats["chunks"] += len(documents)
+                self.stats["seconds"] += time.perf_counter() - start
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def attachment_size(attachment: Dict) -> Optional[int]:
+    """The file size that confluence reports in the attachment listing, if any"""
+    return (attachment.get("extensions") or {}).get("fileSize") or attachment.get("fileSize")
@@ -1,173 +1,560 @@
 import base64
+import hashlib
 import json
 import logging
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timezone
-from typing import List, Dict
+from multiprocessing import get_context
+from typing import Callable, List, Dict, Iterable, Iterator, Optional, Set, Tuple
 
 import requests
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import ResourceNotFoundError
 from azure.identity import DefaultAzureCredential
 from azure.search.documents import SearchClient
-from langchain_openai import AzureOpenAIEmbeddings, OpenAIEmbeddings
 
-from confluence_vector_sync.confluence import get_last_modified_attachment
+from confluence_vector_sync import otel
+from confluence_vector_sync.attachment_loader import AttachmentExtractor
+from confluence_vector_sync.azure_ai_search_writer import SearchDocumentWriter
+from confluence_vector_sync.confluence import PageHeader, get_last_modified_attachment
+from confluence_vector_sync.dedup import ChunkDeduplicator
+from confluence_vector_sync.embedding import EmbeddingBatcher, LazyEmbedder
+from confluence_vector_sync.embedding_cache import EmbeddingCache
+from confluence_vector_sync.parsing import split_storage_format
+from confluence_vector_sync.pipeline import Pipeline, Stage
+from confluence_vector_sync.ratelimit import rate_limiter_from_config
+
+# id -> (document_id, content_hash) of the chunks in the index
+IndexedChunks = Dict[str, Tuple[str, Optional[str]]]
+# Dimensions of the vector fields when EMBEDDING_DIMENSIONS is not set, those of text-embedding-ada-002
+DEFAULT_DIMENSIONS = 1536
+# AZURE_SEARCH_VECTOR_COMPRESSION -> compression of the vector fields in the index
+VECTOR_COMPRESSIONS = {"scalar": {"kind": "scalarQuantization",
+                                  "scalarQuantizationParameters": {"quantizedDataType": "int8"}},
+                       "binary": {"kind": "binaryQuantization"}}
+# Fields that do not change what a chunk is, they are left out of its content hash
+UNHASHED_FIELDS = {"titleVector", "chunkVector", "last_modified_date", "last_indexed_date", "content_hash"}
+# Pages whose documents are looked up with one search.in filter when they are removed
+REMOVE_BATCH_SIZE = 100
+
+
+def content_hash(doc: Dict) -> str:
+    """Hash of what is indexed for a chunk, an unchanged hash means that the chunk and its vectors are unchanged"""
+    content = {key: value for key, value in doc.items() if key not in UNHASHED_FIELDS}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def document_page_ids(docs: Iterable[Dict]) -> Set[str]:
+    """The pages of the documents, an attachment belongs to the page it is attached to"""
+    return {doc["attachment_page_id"] or doc["document_id"] for doc in docs}
+
+
+def create_embedder(config):
+    """The embedding model of the config, langchain_openai is imported here"""
+    from langchain_openai import AzureOpenAIEmbeddings, OpenAIEmbeddings
+    # Only the text-embedding-3 models can shorten their vectors, the others use their own dimensions
+    dimensions = {"dimensions": config["embedding_dimensions"]} if config["embedding_dimensions"] else {}
+    # Check if env value contains 'azure'
+    if os.getenv("OPENAI_API_BASE", "").find("azure") > -1 or os.getenv("AZURE_OPENAI_ENDPOINT", None) is not None:
+        if os.getenv("AZURE_OPENAI_ENDPOINT ", None) is None:
+            os.environ["AZURE_OPENAI_ENDPOINT"] = os.getenv("OPENAI_API_BASE")
+            del os.environ["OPENAI_API_BASE"]
+        # Throttling is retried by the rate limiter, not by the openai client
+        return AzureOpenAIEmbeddings(azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
+                                     deployment=config["azure_search_embedding_model"],
+                                     chunk_size=config["embedding_batch_size"],
+                                     max_retries=0,
+                                     **dimensions)
+    return OpenAIEmbeddings(deployment=config["azure_search_embedding_model"],
+                            chunk_size=config["embedding_batch_size"],
+                            max_retries=0,
+                            **dimensions)
 
 
 class AzureAISearchIndexer:
     datetime_format = '%Y-%m-%dT%H:%M:%S.%fZ'
 
     def __init__(self, config):
-        self.attachment_cache = {}
+        # space -> ids of the attachments listed in this run
+        self.attachment_cache: Dict[str, set] = {}
+        # document_id -> (last_indexed_date, last_modified_date) of the first chunk, loaded per space
+        self.indexing_state: Dict[str, Tuple[datetime, datetime]] = {}
+        # page id -> ids of its attachments in the index
+        self.indexed_attachments: Dict[str, set] = {}
+        # space -> ids of its pages in the index
+        self.indexed_pages: Dict[str, set] = {}
+        self.prefetched_spaces = set()
         self.diagnostics = None
         self.headers = {'Content-Type': 'application/json', 'api-key': config["azure_search_key"]}
         self.params = {'api-version': config["azure_search_api_version"]}
         self.endpoint = config["azure_search_endpoint"]
         self.index_name = config["azure_search_confluence_index"]
-        self.spaces_indexed = []
         self.full_reindex = config["azure_search_full_reindex"]
-        # Check if env value contains 'azure'
-        if os.getenv("OPENAI_API_BASE", "").find("azure") > -1 or os.getenv("AZURE_OPENAI_ENDPOINT", None) is not None:
-            if os.getenv("AZURE_OPENAI_ENDPOINT ", None) is None:
-                os.environ["AZURE_OPENAI_ENDPOINT"] = os.getenv("OPENAI_API_BASE")
-                del os.environ["OPENAI_API_BASE"]
-            self.embedder = AzureOpenAIEmbeddings(azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
-                                                  deployment=config["azure_search_embedding_model"],
-                                                  chunk_size=1)
-        else:
-            self.embedder = OpenAIEmbeddings(deployment=config["azure_search_embedding_model"],
-                                         chunk_size=1,
-                                         )
+        self.vector_dimensions = config["embedding_dimensions"] or DEFAULT_DIMENSIONS
+        self.vector_compression = config["azure_search_vector_compression"]
+        if self.vector_compression not in ("none", *VECTOR_COMPRESSIONS):
+            raise ValueError(f"Unknown vector compression {self.vector_compression}, use none, scalar or binary")
+        if self.vector_compression != "none" and self.params["api-version"] < "2024-07-01":
+            # The index would be rejected when it is created
+            raise ValueError(f"Vector compression needs AZURE_SEARCH_API_VERSION 2024-07-01 or later, "
+                             f"not {self.params['api-version']}")
+        self.vector_oversampling = config["azure_search_vector_oversampling"]
+        self.title_vector_chunks = config["title_vector_chunks"]
+        # The embedding model client (and openai) is only loaded when a run has something to embed
+        self.embedder = LazyEmbedder(lambda: create_embedder(config))
+        self.embedding_limiter = rate_limiter_from_config(config, "embedding")
+        self.search_limiter = rate_limiter_from_config(config, "azure_search")
+        self.embedding_cache = None
+        if config["embedding_cache_path"]:
+            # Shortened vectors are other vectors than the full ones of the model, they are cached apart
+            cache_model = config["azure_search_embedding_model"]
+            if config["embedding_dimensions"]:
+                cache_model = f"{cache_model}:{config['embedding_dimensions']}"
+            self.embedding_cache = EmbeddingCache(config["embedding_cache_path"], model=cache_model,
+                                                  max_entries=config["embedding_cache_max_entries"])
+        self.dedup = None
+        if config["dedup_chunks"] != "off":
+            self.dedup = ChunkDeduplicator(near=config["dedup_chunks"] == "near",
+                                           threshold=config["dedup_threshold"],
+                                           max_entries=config["dedup_max_entries"],
+                                           drop_after=config["dedup_drop_after"])
+        self.embedding_batcher = EmbeddingBatcher(self.embedder,
+                                                  model=config["azure_search_embedding_model"],
+                                                  batch_size=config["embedding_batch_size"],
+                                                  max_batch_tokens=config["embedding_batch_max_tokens"],
+                                                  cache=self.embedding_cache,
+                                                  rate_limiter=self.embedding_limiter,
+                                                  dedup=self.dedup,
+                                                  on_error=self.on_embedding_error)
         self.now = datetime.utcnow().strftime(self.datetime_format)
-        self.credential = AzureKeyCredential(config["azure_search_key"]) if config[
-            "azure_search_key"] else DefaultAzureCredential()
-        self.client = SearchClient(endpoint=self.endpoint, index_name=self.index_name, credential=self.credential)
+        self.client = self.create_client(config)
+        self.writer = SearchDocumentWriter(self.client,
+                                           max_documents=config["azure_search_upload_batch_size"],
+                                           max_bytes=config["azure_search_upload_batch_bytes"],
+                                           rate_limiter=self.search_limiter)
+        self.writer.on_flush = self.on_flush
         self.confluence = None
+        self.fetch_workers = config["pipeline_fetch_workers"]
+        self.parse_workers = config["pipeline_parse_workers"]
+        self.embed_workers = config["pipeline_embed_workers"]
+        self.queue_size = config["pipeline_queue_size"]
+        self.parse_pool = None
+        self.attachment_workers = config["attachment_workers"]
+        self.attachment_max_bytes = config["attachment_in_flight_bytes"]
+        self.attachment_spool_bytes = config["attachment_spool_bytes"]
+        self.attachment_extractor = None
+        self.reconcile_workers = config["reconcile_workers"]
+        # Optional RunJournal of the pages that are done, set by the sync. It learns of the flushes from on_flush
+        self.journal = None
+        self.lock = threading.Lock()
         self.reset()
 
-    def index(self, changeset: Dict[str, List]):
+    def create_client(self, config) -> SearchClient:
+        credential = AzureKeyCredential(config["azure_search_key"]) if config[
+            "azure_search_key"] else DefaultAzureCredential()
+        # retry_status=0: throttling is retried by the rate limiter, connection errors still by azure-core
+        return SearchClient(endpoint=self.endpoint, index_name=self.index_name, credential=credential,
+                            retry_status=0)
+
+    def index(self, changeset: Dict[str, List[PageHeader]]):
         """List all documents in the index and map to spaces with their pages"""
         # First go through all upserts and update latest_updates for each new space
         # Sor them by date first
         create = []
         update = []
-        upserts = sorted(changeset["upsert"], key=lambda x: x["last_modified"], reverse=True)
+        upserts = sorted(changeset["upsert"], key=lambda x: x.last_modified, reverse=True)
+        for space in {upsert.space for upsert in upserts}:
+            self.prefetch_indexing_metadata(space)
         for upsert in upserts:
-            space = upsert["space"]["key"]
-            if space in self.spaces_indexed:
+            space = upsert.space
+            # The listed attachments exist, purge_attachments does not need to check them
+            for attachment in upsert.attachments or []:
+                self.add_to_attachment_cache(space, attachment)
+            if self.journal and self.journal.is_done(upsert):
+                # Indexed by the previous run before it was interrupted
                 continue
-            page_id = upsert["id"]
+            # Half indexed by an earlier run, its dates in the index can not be trusted
+            redo = self.journal is not None and self.journal.is_unfinished(upsert.id)
+            page_id = upsert.id
             # Check if document exists (the first chunk)
-            last_indexed_date, last_modified_date_in_index = self.get_indexing_metadata(page_id)
+            last_indexed_date, last_modified_date_in_index = self.get_indexing_metadata(page_id, space)
             if last_indexed_date is None:
                 create.append(upsert)
             else:
-                modified_in_confluence = upsert["last_modified"]
-                if last_modified_date_in_index < modified_in_confluence or self.full_reindex:
+                modified_in_confluence = upsert.last_modified
+                # Every page is checked, the dates of the space are prefetched. Older pages are not assumed to be
+                # indexed because a newer one is, they may have failed in an earlier run
+                if last_modified_date_in_index < modified_in_confluence or self.full_reindex or redo:
                     update.append(upsert)
-                if last_indexed_date > modified_in_confluence and not self.full_reindex:
-                    self.spaces_indexed.append(upsert["space"]["key"])
 
         # remove items in changeset remove
-        for item in changeset["remove"]:
-            count = self.remove_item(item)
-            if count > 0:  # The count is number of chunks, not documents
-                self.diagnostics["counts"]["remove"] += 1
-        # remove items that need to be updated ->
-        # document is split in multiple search entries and we dont know how its going to chuck this time ->
-        # easier to remove existing chunks and reindex
-        for item in update:
-            self.diagnostics["counts"]["update"] += 1
-            self.remove_item(item)
-            self.create_item(item)
-        # create new items
-        for item in create:
-            self.diagnostics["counts"]["create"] += 1
-            self.create_item(item)
-
-    def get_indexing_metadata(self, page_id):
+        removes = [item for item in changeset["remove"] if not (self.journal and self.journal.is_done(item))]
+        if self.journal:
+            self.journal.plan(removes, "remove")
+            self.journal.plan(update + create, "upsert")
+        if removes:
+            self.count("remove", self.remove_items(removes))
+            if self.journal:
+                self.journal.embedded([item.id for item in removes])
+        # Updated pages are chunked again and compared with their chunks in the index by content hash,
+        # only new and changed chunks are embedded and uploaded
+        if update or create:
+            updated = {item.id for item in update}
+            # Page bodies are fetched in bulk while the pipeline runs, instead of one request per page
+            self.run_pipeline((item, item.id in updated)
+                              for item in self.confluence.with_page_bodies(update + create))
+
+    def run_pipeline(self, work: Iterable[Tuple[PageHeader, bool]]):
+        """Fetch, parse, embed and upload the (item, is update) pairs concurrently"""
+        if self.parse_workers > 0 and self.parse_pool is None:
+            # spawn, forking a process that runs threads is not safe. The pool lives until close()
+            self.parse_pool = ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=get_context("spawn"))
+        pipeline = Pipeline([Stage("fetch", self.fetch_stage, self.fetch_workers),
+                             Stage("parse", self.parse_stage, self.parse_workers),
+                             Stage("embed", self.embed_stage, self.embed_workers),
+                             Stage("upload", self.upload_stage)],
+                            queue_size=self.queue_size,
+                            on_error=self.on_pipeline_error)
+        pipeline.run(work)
+        for name, stats in pipeline.stats.items():
+            totals = self.diagnostics["pipeline"].setdefault(name, dict.fromkeys(stats, 0))
+            for key, value in stats.items():
+                totals[key] = value if key == "workers" else totals[key] + value
+
+    def get_indexing_metadata(self, page_id, space: str = None):
         # not found, set olden times
         last_modified_date_in_index = datetime(1900, 1, 1, 1, 1, tzinfo=timezone.utc)
         last_indexed_date = None
-        try:
-            doc = self.client.get_document(key=f"{page_id}_0",
-                                            selected_fields=["id", "last_indexed_date", "last_modified_date"])
-            last_modified_date_in_index = datetime.fromisoformat(doc["last_modified_date"])
-            last_indexed_date = datetime.fromisoformat(doc["last_indexed_date"])
-        except:
-            # not found in ai-search
-            pass
+        if page_id in self.indexing_state:
+            last_indexed_date, last_modified_date_in_index = self.indexing_state[page_id]
+        elif space not in self.prefetched_spaces:
+            try:
+                doc = self.search_limiter.call(self.client.get_document, key=f"{page_id}_0",
+                                               selected_fields=["id", "last_indexed_date", "last_modified_date"])
+                last_modified_date_in_index = datetime.fromisoformat(doc["last_modified_date"])
+                last_indexed_date = datetime.fromisoformat(doc["last_indexed_date"])
+            except ResourceNotFoundError:
+                # not found in ai-search
+                pass
         return last_indexed_date, last_modified_date_in_index
 
-    def remove_item(self, item):
-        # Get all documents that match the document_id
-        results = list(self.client.search(search_text="*",
-                                          filter="document_id eq '" + item["id"] + "'"))
-        attachment_results = list(self.client.search(search_text="*",
-                                                     filter="attachment_page_id eq '" + item["id"] + "'"))
-        results.extend(attachment_results)
-        to_be_deleted = list(map(lambda x: {'id': x['id']}, results))
-        if len(to_be_deleted) > 0:
-            self.client.delete_documents(documents=to_be_deleted)
-        return len(to_be_deleted)
-
-    def create_item(self, item):
-        # Handle attachments
-        docs = []
-        for attachment in item.get("attachments", []):
-            self.add_to_attachment_cache(item["space"]["key"], attachment)
-            create = False
+    def prefetch_indexing_metadata(self, space: str):
+        """Load the indexing dates of all pages and attachments of a space, instead of one lookup per item"""
+        if space in self.prefetched_spaces:
+            return
+        for doc in self.iterate_documents(filter=f"space eq '{space}'",
+                                          select=["id", "document_id", "attachment_page_id",
+                                                  "last_modified_date", "last_indexed_date"]):
+            # The dates are the same in every chunk, only the first one is needed
+            if doc["id"] != f'{doc["document_id"]}_0':
+                continue
+            self.indexing_state[doc["document_id"]] = (datetime.fromisoformat(doc["last_indexed_date"]),
+                                                       datetime.fromisoformat(doc["last_modified_date"]))
+            if doc["attachment_page_id"]:
+                self.indexed_attachments.setdefault(doc["attachment_page_id"], set()).add(doc["document_id"])
+            else:
+                self.indexed_pages.setdefault(space, set()).add(doc["document_id"])
+        self.prefetched_spaces.add(space)
+
+    def indexed_page_ids(self, space: str) -> set:
+        """Ids of the pages of the space that are in the index"""
+        self.prefetch_indexing_metadata(space)
+        return self.indexed_pages.get(space, set())
+
+    def iterate_documents(self, filter: str, select: List[str], page_size: int = 1000) -> Iterator[Dict]:
+        """Page through all documents matching the filter in id order (not limited by the $skip maximum)"""
+        last_id = None
+        while True:
+            page_filter = filter if last_id is None else f"({filter}) and id gt '{last_id}'"
+            results = self.search(filter=page_filter, select=select, order_by=["id asc"], top=page_size)
+            yield from results
+            if len(results) < page_size:
+                break
+            last_id = results[-1]["id"]
+
+    def release_space(self, space: str):
+        """Drop the prefetched indexing state of a space that is done, it is not needed anymore in this run"""
+        for page_id in self.indexed_pages.pop(space, set()):
+            self.indexing_state.pop(page_id, None)
+            for attachment_id in self.indexed_attachments.pop(page_id, set()):
+                self.indexing_state.pop(attachment_id, None)
+        self.prefetched_spaces.discard(space)
+
+    def remove_items(self, items: List[PageHeader]) -> int:
+        """Remove the pages and their attachments from the index, returns how many of the pages were in it"""
+        removed = 0
+        for start in range(0, len(items), REMOVE_BATCH_SIZE):
+            ids = ",".join(item.id for item in items[start:start + REMOVE_BATCH_SIZE])
+            # The chunks of the pages and of their attachments, grouped by page
+            chunks = self.indexed_items(f"search.in(document_id, '{ids}', ',') or "
+                                        f"search.in(attachment_page_id, '{ids}', ',')", by="attachment_page_id")
+            removed += self.delete_items(chunks)
+        for item in items:
+            self.indexing_state.pop(item.id, None)
+            for attachment_id in self.indexed_attachments.pop(item.id, set()):
+                self.indexing_state.pop(attachment_id, None)
+        return removed
+
+    def indexed_items(self, filter: str, by: str = "document_id") -> Dict[str, List[str]]:
+        """The ids of the chunks matching the filter grouped by the by field, or the document_id where it is empty"""
+        chunks = {}
+        for doc in self.iterate_documents(filter=filter, select=["id", "document_id", "attachment_page_id"]):
+            chunks.setdefault(doc[by] or doc["document_id"], []).append(doc["id"])
+        return chunks
+
+    def missing_items(self, item_ids: List[str], exists: Callable[[str], bool]) -> List[str]:
+        """The items that are not in confluence anymore, checked concurrently"""
+        if not item_ids:
+            return []
+        with ThreadPoolExecutor(max_workers=self.reconcile_workers) as pool:
+            return [item_id for item_id, found in zip(item_ids, pool.map(exists, item_ids)) if not found]
+
+    def delete_items(self, chunks: Dict[str, List[str]]) -> int:
+        """Delete the chunks of the items, the writer sends them in bounded batches. Returns the number of items"""
+        for chunk_ids in chunks.values():
+            self.writer.delete(chunk_ids)
+        return len(chunks)
+
+    def create_item(self, item: PageHeader):
+        """Index a single item without the pipeline"""
+        self.upload_stage(self.embed_stage(self.parse_stage(self.fetch_stage((item, False)))))
+
+    def fetch_stage(self, work: Tuple[PageHeader, bool]
+                    ) -> Tuple[PageHeader, Optional[IndexedChunks], str, List[Dict]]:
+        item, is_update = work
+        # An updated page is compared chunk by chunk with what is in the index, None for a new page
+        indexed = self.indexed_chunks(item) if is_update else None
+        docs = self.attachments_to_documents(item)
+        return item, indexed, self.confluence.get_page_content(item), docs
+
+    def parse_stage(self, work: Tuple[PageHeader, Optional[IndexedChunks], str, List[Dict]]
+                    ) -> Tuple[PageHeader, Optional[IndexedChunks], List[Dict], List[Dict]]:
+        item, indexed, content, docs = work
+        split_args = (self.confluence.chunk_size, self.confluence.chunk_overlap, self.confluence.chunk_tokenizer)
+        # The page is parsed and split in one pass
+        with otel.stage("parse_split", page=item.id):
+            if self.parse_pool:
+                page_chunks = self.parse_pool.submit(split_storage_format, content, *split_args).result()
+            else:
+                page_chunks = split_storage_format(content, *split_args)
+        return item, indexed, page_chunks, docs
+
+    def embed_stage(self, work: Tuple[PageHeader, Optional[IndexedChunks], List[Dict], List[Dict]]) -> List[Dict]:
+        item, indexed, page_chunks, docs = work
+        docs.extend(self.chunks_to_documents(page_chunks, item))
+        stale, unchanged = [], []
+        if indexed is not None:
+            docs, stale, unchanged = self.diff_documents(item, docs, indexed)
+        if self.dedup:
+            docs, dropped = self.dedup.drop_boilerplate(item.id, docs)
+            # A chunk that became boilerplate does not keep its earlier text in the index
+            stale.extend(doc["id"] for doc in dropped if indexed and doc["id"] in indexed)
+        self.count("create" if indexed is None else "update")
+        self.hold(item.id, docs, stale, unchanged)
+        if self.journal:
+            self.journal.expect(item.id, docs)
+        # Chunks split by tokens know their token count, the batcher does not need to count them again
+        token_counts = {chunk["text"]: chunk["tokens"] for chunk in page_chunks if "tokens" in chunk}
+        # Vectors are filled in batches across pages, pass on whatever the batcher completed
+        return self.embedding_batcher.add(docs, token_counts) or None
+
+    def indexed_chunks(self, item: PageHeader) -> IndexedChunks:
+        """The chunks of the page and of its attachments that are in the index"""
+        results = self.search(filter=f"document_id eq '{item.id}' or attachment_page_id eq '{item.id}'",
+                              select=["id", "document_id", "content_hash"])
+        return {result["id"]: (result["document_id"], result.get("content_hash")) for result in results}
+
+    def diff_documents(self, item: PageHeader, docs: List[Dict], indexed: IndexedChunks
+                       ) -> Tuple[List[Dict], List[str], List[Dict]]:
+        """The documents of an updated page that changed and need to be embedded and uploaded, the ids of the
+        chunks that are not produced anymore and need to be deleted, and the date merges of the unchanged chunks.
+
+        Attachments that were not loaded again (not modified) keep their chunks while they are attached.
+        """
+        ids = {doc["id"] for doc in docs}
+        loaded = {doc["document_id"] for doc in docs} | {item.id}
+        attached = {attachment["id"] for attachment in item.attachments or []}
+        stale = [chunk_id for chunk_id, (document_id, _) in indexed.items()
+                 if chunk_id not in ids and (document_id in loaded or document_id not in attached)]
+        changed = []
+        unchanged = []
+        for doc in docs:
+            if not self.full_reindex and indexed.get(doc["id"], (None, None))[1] == doc["content_hash"]:
+                unchanged.append({"id": doc["id"],
+                                  "last_modified_date": doc["last_modified_date"],
+                                  "last_indexed_date": doc["last_indexed_date"]})
+            else:
+                changed.append(doc)
+        self.count("chunk-stale", len(stale))
+        self.count("chunk-unchanged", len(unchanged))
+        return changed, stale, unchanged
+
+    def hold(self, page_id: str, docs: List[Dict], deletes: List[str], merges: List[Dict]):
+        """Keep the documents, deletes and merges of a page until all its documents are embedded, then hand them
+        to the writer together. Nothing is written for a page that fails, it stays as it is in the index.
+
+        The merges are sent only when the uploads succeed, the dates of the first chunk decide whether the next
+        run indexes the page again.
+        """
+        held = {"documents": len(docs), "uploads": [], "ids": [doc["id"] for doc in docs], "deletes": deletes,
+                "merges": merges}
+        if docs:
+            with self.lock:
+                self.held[page_id] = held
+        else:
+            self.write_held(page_id, held)
+
+    def write_held(self, page_id: str, held: Dict):
+        with self.lock:
+            # The pages of the keys that the writer could not write, see on_flush
+            for key in held["ids"] + held["deletes"] + [doc["id"] for doc in held["merges"]]:
+                self.owners[key.rsplit("_", 1)[0]] = page_id
+        if held["deletes"]:
+            self.writer.delete(held["deletes"])
+        self.upload_documents(held["uploads"])
+        if held["merges"]:
+            self.writer.merge(held["merges"], after=held["ids"])
+
+    def upload_stage(self, docs: List[Dict]):
+        ready = []
+        with self.lock:
+            for doc in docs or []:
+                page_id = doc["attachment_page_id"] or doc["document_id"]
+                held = self.held.get(page_id)
+                if held is None:
+                    # The page failed
+                    continue
+                held["uploads"].append(doc)
+                held["documents"] -= 1
+                if held["documents"] == 0:
+                    ready.append((page_id, self.held.pop(page_id)))
+        for page_id, held in ready:
+            self.write_held(page_id, held)
+            if self.journal:
+                self.journal.completed(held["uploads"])
+
+    def on_flush(self, failed_keys: Set[str]):
+        """The writer sent what it had, the pages of the documents it could not write failed"""
+        if failed_keys:
+            with self.lock:
+                page_ids = {self.owners.get(key.rsplit("_", 1)[0]) for key in failed_keys} - {None}
+            logging.warning(f"Could not write the documents of {', '.join(sorted(page_ids))}")
+            self.fail_pages(page_ids)
+        if self.journal:
+            self.journal.flushed(failed_keys)
+
+    def on_pipeline_error(self, stage: str, work, error: Exception):
+        # A failed page is not indexed (instead of being indexed empty) and is retried on the next run
+        # The upload stage gets the documents of any number of pages
+        page_ids = {work[0].id} if stage != "upload" else document_page_ids(work)
+        logging.warning(f"Could not index {', '.join(sorted(page_ids))} in stage {stage}: {error}")
+        self.fail_pages(page_ids)
+
+    def on_embedding_error(self, docs: List[Dict], error: Exception):
+        # An embedding batch mixes the documents of several pages, none of them is complete now
+        page_ids = document_page_ids(docs)
+        logging.warning(f"Could not embed {', '.join(sorted(page_ids))}: {error}")
+        self.fail_pages(page_ids)
+
+    def fail_pages(self, page_ids: Iterable[str]):
+        """Count each failed page once, it can lose documents in several stages or batches"""
+        page_ids = set(page_ids)
+        with self.lock:
+            new = page_ids - self.failed_pages
+            self.failed_pages.update(new)
+            # Their chunks in the index stay as they are
+            for page_id in page_ids:
+                self.held.pop(page_id, None)
+            self.diagnostics["counts"]["failed"] += len(new)
+
+    def attachments_to_documents(self, item: PageHeader) -> List[Dict]:
+        modified = []
+        created = set()
+        for attachment in item.attachments or []:
+            self.add_to_attachment_cache(item.space, attachment)
             # check if we can handle it, otherwise don't download
             if self.attachment_loader.can_handle(attachment["metadata"]["mediaType"]):
                 # Check if attachment has been modified since last index
-                last_indexed_date, last_modified_date_in_index = self.get_indexing_metadata(attachment["id"])
+                last_indexed_date, last_modified_date_in_index = self.get_indexing_metadata(attachment["id"],
+                                                                                            item.space)
                 if last_indexed_date is None:
-                    create = True
+                    created.add(attachment["id"])
 
                 last_modified_in_confluence = get_last_modified_attachment(attachment)
                 if last_modified_date_in_index < last_modified_in_confluence:
-                    tmp_file = self.confluence.download_to_tempfile(attachment)
-                    attachment_chunks = self.attachment_loader.load(tmp_file, attachment["metadata"]["mediaType"])
-                    os.remove(tmp_file)
-                    if attachment_chunks:
-                        docs.extend(self.chunks_to_documents(attachment_chunks, item,
-                                                             attachment=attachment))
-                        if create:
-                            self.diagnostics["counts"]["attachment-create"] += 1
-                        else:
-                            self.diagnostics["counts"]["attachment-update"] += 1
-        # Create a new document
-        page_chunks = self.confluence.chunk_page(item)
-        docs.extend(self.chunks_to_documents(page_chunks, item))
-        try:
-            for doc in docs:
-                resp = self.client.upload_documents(documents=[doc])
-                if not resp[0].succeeded:
-                    logging.warning(f"Could not index document {doc['url']} to Azure Search: {resp[0].errors}")
-        except Exception as e:
-            logging.warning(f"Could not index documents to Azure Search: {e}")
+                    modified.append(attachment)
+        docs = []
+        if not modified:
+            return docs
+        # The modified attachments are downloaded and extracted concurrently
+        for attachment, attachment_chunks in self.get_attachment_extractor().extract(modified):
+            if attachment_chunks:
+                docs.extend(self.chunks_to_documents(attachment_chunks, item,
+                                                     attachment=attachment))
+                if attachment["id"] in created:
+                    self.count("attachment-create")
+                else:
+                    self.count("attachment-update")
+        return docs
+
+    def get_attachment_extractor(self) -> AttachmentExtractor:
+        with self.lock:
+            if self.attachment_extractor is None:
+                self.attachment_extractor = AttachmentExtractor(self.confluence, self.attachment_loader,
+                                                                workers=self.attachment_workers,
+                                                                max_in_flight_bytes=self.attachment_max_bytes,
+                                                                spool_bytes=self.attachment_spool_bytes)
+            return self.attachment_extractor
+
+    def count(self, name: str, n: int = 1):
+        with self.lock:
+            self.diagnostics["counts"][name] += n
+
+    def upload_documents(self, docs: List[Dict]):
+        if docs:
+            self.writer.upload(docs)
+
+    def close(self):
+        """Embed and upload everything still buffered, call at the end of the run"""
+        self.upload_stage(self.embedding_batcher.flush())
+        self.writer.close()
+        if self.parse_pool:
+            self.parse_pool.shutdown()
+            self.parse_pool = None
+        if self.attachment_extractor:
+            self.diagnostics["attachments"]["peak_in_flight_bytes"] = self.attachment_extractor.budget.peak
+            stats = self.attachment_extractor.stats
+            self.diagnostics["attachments"].update(extracted=stats["extracted"], extract_bytes=stats["bytes"],
+                                                   extract_chunks=stats["chunks"], extract_seconds=stats["seconds"])
+            self.attachment_extractor.close()
+            self.attachment_extractor = None
+        # The prefetched indexing state is only valid for the run
+        self.indexing_state = {}
+        self.indexed_attachments = {}
+        self.indexed_pages = {}
+        self.prefetched_spaces = set()
 
     def chunks_to_documents(self,
                             chunks: List[Dict],
-                            item: Dict,
+                            item: PageHeader,
                             attachment: Dict = None
                             ) -> List[Dict]:
         docs = []
         attachment_page_url = ""
         attachment_page_id = ""
+        # None marks a vector that the embedding batcher still needs to fill in
         title_vector = []
-        if "title" in item:
-            title = item["title"]
-        else :
-            title = ""
+        title = item.title
         item_type = "page"
-        url = f'{item["_links"]["self"].split("rest")[0]}display/{item["space"]["key"]}/{item["_links"]["webui"].split("/")[-1]}'
-        item_id = item["id"]
+        url = self.confluence.get_page_url(item)
+        item_id = item.id
 
         if attachment is None:
-            last_modified_date = item["last_modified"].strftime(self.datetime_format)
-            if "title" in item:
-                title_vector = self.embedder.embed_query(item["title"])
+            last_modified_date = item.last_modified.strftime(self.datetime_format)
+            if title:
+                title_vector = None
         else:
             item_type = "attachment:" + attachment["metadata"]["mediaType"]
             attachment_page_url = url
@@ -189,46 +576,69 @@ class AzureAISearchIndexer:
             docs.append({
                 "id": document_id,
                 "document_id": item_id,
-                "space": item["space"]["key"],
+                "space": item.space,
                 "item_type": item_type,
                 "attachment_page_url": attachment_page_url,
                 "attachment_page_id": attachment_page_id,
                 "title": title,
-                "titleVector": title_vector,
+                # All chunks of a document have the same title, its vector is only stored with the first one
+                "titleVector": title_vector if i == 0 or self.title_vector_chunks == "all" else [],
                 "chunk": chunk_text,
-                "chunkVector": self.embedder.embed_query(chunk_text),
+                "chunkVector": None,
                 "last_modified_date": last_modified_date,
                 "last_indexed_date": self.now,
                 "url": url
             })
+            docs[-1]["content_hash"] = content_hash(docs[-1])
         return docs
 
 
-    def add_to_attachment_cache(self, space: str, attachment: Dict):
-        if not space in self.attachment_cache:
-            self.attachment_cache[space] = []
-        self.attachment_cache[space].append(attachment["id"])
+    def search(self, **kwargs) -> List[Dict]:
+        """All results of a search (search_text defaults to *), the paged requests go through the rate limiter"""
+        kwargs.setdefault("search_text", "*")
+        with otel.stage("search.query"):
+            return self.search_limiter.call(lambda: list(self.client.search(**kwargs)))
 
-    def purge_attachments(self, space):
-        results = list(self.client.search(search_text="*", filter=f"space eq '{space}' and item_type ne 'page'"))
-        ids = [result['id'] for result in results]
+    def attachment_exists(self, attachment_id: str) -> bool:
+        try:
+            return self.confluence.get_attachment_by_id(attachment_id) is not None
+        except Exception as e:
+            # Keep the attachment in the index when confluence can not tell
+            logging.warning(f"Could not check attachment {attachment_id} in confluence: {e}")
+            return True
 
-        # Filter out all attachments that are not in the cache
-        if space in self.attachment_cache:
-            ids = [id for id in ids if id.split("_")[0] not in self.attachment_cache[space]]
+    def add_to_attachment_cache(self, space: str, attachment: Dict):
+        with self.lock:
+            self.attachment_cache.setdefault(space, set()).add(attachment["id"])
 
-        # Check that the remaining items are in confluence
-        ids = [id for id in ids if self.confluence.get_attachment_by_id(id.split("_")[0]) is None]
+    def purge_attachments(self, space):
+        """Remove the attachments of the space that were deleted in confluence.
 
-        if ids:
-            to_be_deleted = [{'id': id} for id in ids]
-            self.client.delete_documents(documents=to_be_deleted)
-            self.diagnostics["counts"]["remove"] += len(ids)
+        Attachments that were listed in this run exist, the others are checked in confluence once per attachment.
+        """
+        # The attachments of removed pages are not in the index anymore
+        self.writer.flush_deletes()
+        chunks = self.indexed_items(f"space eq '{space}' and item_type ne 'page'")
+        listed = self.attachment_cache.get(space, set())
+        removed = self.missing_items([attachment_id for attachment_id in chunks if attachment_id not in listed],
+                                     self.attachment_exists)
+        self.count("remove", self.delete_items({attachment_id: chunks[attachment_id] for attachment_id in removed}))
 
     def create_or_update_index(self):
         """Create or update the index with the latest schema
             the operation is idempotent and can be invoked multiple times without any side effects
         """
+        schema = self.index_schema()
+        resp = requests.put(self.endpoint + "/indexes/" + self.index_name, data=json.dumps(schema),
+                            headers=self.headers, params=self.params)
+
+        if resp.status_code > 299:
+            print(f'Could not create or update index, error {resp.text}')
+            logging.error(f'Could not create or update index, error {resp.text}')
+            exit(-1)
+
+    def index_schema(self) -> Dict:
+        """The index definition, with the vector dimensions and compression of the config"""
         schema = {
             "name": self.index_name,
             "fields": [
@@ -246,15 +656,17 @@ class AzureAISearchIndexer:
                  "filterable": "true"},
                 {"name": "title", "type": "Edm.String", "searchable": "true", "retrievable": "true"},
                 {"name": "titleVector", "type": "Collection(Edm.Single)", "searchable": "true", "retrievable": "true",
-                 "dimensions": 1536, "vectorSearchProfile": "default-vector-profile"},
+                 "dimensions": self.vector_dimensions, "vectorSearchProfile": "default-vector-profile"},
                 {"name": "chunk", "type": "Edm.String", "searchable": "true", "retrievable": "true"},
                 {"name": "chunkVector", "type": "Collection(Edm.Single)", "searchable": "true", "retrievable": "true",
-                 "dimensions": 1536, "vectorSearchProfile": "default-vector-profile"},
+                 "dimensions": self.vector_dimensions, "vectorSearchProfile": "default-vector-profile"},
                 {"name": "last_modified_date", "type": "Edm.DateTimeOffset", "searchable": "false",
                  "retrievable": "true", "filterable": "true"},
                 {"name": "last_indexed_date", "type": "Edm.DateTimeOffset", "searchable": "false",
                  "retrievable": "true", "filterable": "true"},
-                {"name": "url", "type": "Edm.String", "searchable": "false", "retrievable": "true"}
+                {"name": "url", "type": "Edm.String", "searchable": "false", "retrievable": "true"},
+                {"name": "content_hash", "type": "Edm.String", "searchable": "false", "retrievable": "true",
+                 "filterable": "false"}
             ],
             "vectorSearch": {
                 "algorithms": [
@@ -288,13 +700,14 @@ class AzureAISearchIndexer:
                 ]
             }
         }
-        resp = requests.put(self.endpoint + "/indexes/" + self.index_name, data=json.dumps(schema),
-                            headers=self.headers, params=self.params)
-
-        if resp.status_code > 299:
-            print(f'Could not create or update index, error {resp.text}')
-            logging.error(f'Could not create or update index, error {resp.text}')
-            exit(-1)
+        if self.vector_compression in VECTOR_COMPRESSIONS:
+            # The quantized vectors are searched, the best oversampling * k of them are rescored with the originals
+            schema["vectorSearch"]["compressions"] = [{"name": "vector-compression",
+                                                       **VECTOR_COMPRESSIONS[self.vector_compression],
+                                                       "rerankWithOriginalVectors": True,
+                                                       "defaultOversampling": self.vector_oversampling}]
+            schema["vectorSearch"]["profiles"][0]["compression"] = "vector-compression"
+        return schema
 
     def drop_index(self):
         resp = requests.delete(self.endpoint + "/indexes/" + self.index_name, headers=self.headers, params=self.params)
@@ -306,10 +719,42 @@ class AzureAISearchIndexer:
         return base64_text
 
     def reset(self):
-        self.spaces_indexed = []
+        self.failed_pages = set()
+        # page id -> documents, deletes and merges of the page that wait for all its documents, see hold()
+        self.held: Dict[str, Dict] = {}
+        # document id -> page id of the documents handed to the writer
+        self.owners: Dict[str, str] = {}
+        self.attachment_cache = {}
+        self.indexing_state = {}
+        self.indexed_attachments = {}
+        self.indexed_pages = {}
+        self.prefetched_spaces = set()
+        self.embedding_batcher.reset()
+        self.writer.reset()
+        self.embedding_limiter.reset()
+        self.search_limiter.reset()
+        if self.embedding_cache:
+            self.embedding_cache.reset()
+        if self.dedup:
+            self.dedup.reset()
         self.diagnostics = {"counts": {"create": 0,
                                        "update": 0,
                                        "remove": 0,
                                        "attachment-create": 0,
-                                       "attachment-update": 0}
+                                       "attachment-update": 0,
+                                       "chunk-unchanged": 0,
+                                       "chunk-stale": 0,
+                                       "failed": 0},
+                            "embedding": self.embedding_batcher.stats,
+                            "upload": self.writer.stats,
+                            "pipeline": {},
+                            "attachments": {"peak_in_flight_bytes": 0,
+                                            "extracted": 0,
+                                            "extract_bytes": 0,
+                                            "extract_chunks": 0,
+                                            "extract_seconds": 0.0},
+                            "rate_limits": {"embedding": self.embedding_limiter.stats,
+                                            "azure_search": self.search_limiter.stats},
+                            "embedding_cache": self.embedding_cache.stats if self.embedding_cache else None,
+                            "dedup": self.dedup.stats if self.dedup else None
                             }
@@ -0,0 +1,203 @@
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from azure.core.exceptions import AzureError
+
+from confluence_vector_sync import otel
+from confluence_vector_sync.ratelimit import THROTTLE_STATUS_CODES
+
+# Status codes of a single document in IndexingResult that are worth retrying
+RETRIABLE_STATUS_CODES = {409, 422, 429, 503}
+# Stats counter of the documents that succeeded, per action
+DONE_STATS = {"upload": "uploaded", "merge": "merged", "delete": "deleted"}
+
+
+class SearchDocumentWriter:
+    """Buffers uploads, merges and deletes to Azure AI Search and sends them in batches.
+
+    Batches are bounded by document count and by the serialized payload size (vectors make documents large).
+    Only the documents that failed in a batch are retried. Deletes are sent before uploads, so a document
+    that is removed and created again in the same run ends up in the index. Merges are sent after the uploads,
+    a merge can wait for uploads and is given up (failed) when one of them could not be written.
+    """
+
+    key_field = "id"
+
+    def __init__(self, client, max_documents: int = 1000, max_bytes: int = 8 * 1024 * 1024, max_retries: int = 3,
+                 rate_limiter=None):
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.lock = threading.RLock()
+        self.uploads: Dict[str, Dict] = {}
+        self.upload_sizes: Dict[str, int] = {}
+        self.deletes: Dict[str, None] = {}
+        self.merges: Dict[str, Dict] = {}
+        # Key of a merge -> keys of the uploads it is only sent after
+        self.merge_after: Dict[str, Set[str]] = {}
+        self.pending_bytes = 0
+        # Keys of the documents that could not be written since the last flush, and in the whole run
+        self.failed_keys: Set[str] = set()
+        self.given_up: Set[str] = set()
+        # Called after every flush with the failed keys, everything else buffered before the flush has been sent
+        self.on_flush: Optional[Callable[[Set[str]], None]] = None
+        self.stats = None
+        self.reset()
+
+    def reset(self):
+        """Start over, what a failed run left in the buffers is dropped"""
+        with self.lock:
+            self.uploads = {}
+            self.upload_sizes = {}
+            self.deletes = {}
+            self.merges = {}
+            self.merge_after = {}
+            self.pending_bytes = 0
+            self.failed_keys = set()
+        self.given_up = set()
+        self.stats = {"upload_batches": 0,
+                      "delete_batches": 0,
+                      "merge_batches": 0,
+                      "uploaded": 0,
+                      "deleted": 0,
+                      "merged": 0,
+                      "retried": 0,
+                      "failed": 0,
+                      "bytes": 0,
+                      "seconds": 0.0}
+
+    def upload(self, docs: List[Dict]):
+        with self.lock:
+            for doc in docs:
+                key = doc[self.key_field]
+                self.deletes.pop(key, None)
+                self.pending_bytes -= self.upload_sizes.get(key, 0)
+                self.uploads[key] = doc
+                self.upload_sizes[key] = len(json.dumps(doc))
+                self.pending_bytes += self.upload_sizes[key]
+            if len(self.uploads) >= self.max_documents or self.pending_bytes >= self.max_bytes:
+                self.flush()
+
+    def merge(self, docs: List[Dict], after: Iterable[str] = ()):
+        """Update some fields of existing documents, the fields that are not given keep their value.
+
+        The merges are not sent if one of the uploads with the keys in after could not be written.
+        """
+        after = set(after)
+        with self.lock:
+            for doc in docs:
+                self.merges[doc[self.key_field]] = doc
+                if after:
+                    self.merge_after[doc[self.key_field]] = after
+            if len(self.uploads) + len(self.merges) >= self.max_documents:
+                self.flush()
+
+    def delete(self, keys: List[str]):
+        with self.lock:
+            for key in keys:
+                if key in self.uploads:
+                    del self.uploads[key]
+                    self.pending_bytes -= self.upload_sizes.pop(key)
+                self.merges.pop(key, None)
+                self.merge_after.pop(key, None)
+                self.deletes[key] = None
+            if len(self.deletes) >= self.max_documents:
+                self.flush_deletes()
+
+    def flush(self):
+        with self.lock:
+            self.flush_deletes()
+            self.send_batches("upload", [(doc, self.upload_sizes[key]) for key, doc in self.uploads.items()])
+            self.given_up.update(self.failed_keys)
+            merges = []
+            for key, doc in self.merges.items():
+                if self.merge_after.get(key, set()) & self.given_up:
+                    self.stats["failed"] += 1
+                    self.failed_keys.add(key)
+                    logging.warning(f"Not merging document {key} to Azure Search, its uploads failed")
+                else:
+                    merges.append((doc, len(json.dumps(doc))))
+            self.send_batches("merge", merges)
+            self.given_up.update(self.failed_keys)
+            self.stats["bytes"] += self.pending_bytes
+            self.uploads, self.upload_sizes, self.merges, self.merge_after, self.pending_bytes = {}, {}, {}, {}, 0
+            failed_keys, self.failed_keys = self.failed_keys, set()
+            if self.on_flush:
+                self.on_flush(failed_keys)
+
+    def send_batches(self, action: str, docs: List[Tuple[Dict, int]]):
+        """Send the (document, size) pairs in batches bounded by count and bytes"""
+        batch, batch_bytes = [], 0
+        for doc, size in docs:
+            if batch and (len(batch) >= self.max_documents or batch_bytes + size > self.max_bytes):
+                otel.payload_size.record(batch_bytes, {"kind": action})
+                self.send(action, batch)
+                batch, batch_bytes = [], 0
+            batch.append(doc)
+            batch_bytes += size
+        if batch:
+            otel.payload_size.record(batch_bytes, {"kind": action})
+            self.send(action, batch)
+
+    def flush_deletes(self):
+        with self.lock:
+            keys = list(self.deletes)
+            self.deletes = {}
+            for i in range(0, len(keys), self.max_documents):
+                self.send("delete", [{self.key_field: key} for key in keys[i:i + self.max_documents]])
+
+    def close(self):
+        self.flush()
+
+    def send(self, action: str, docs: List[Dict]):
+        """Send one batch, retrying the documents that failed with a transient error."""
+        start = time.perf_counter()
+        with otel.stage(f"search.{action}", documents=len(docs)):
+            self.send_with_retries(action, docs)
+        self.stats["seconds"] += time.perf_counter() - start
+
+    def send_with_retries(self, action: str, docs: List[Dict]):
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self.stats["retried"] += len(docs)
+                time.sleep(2 ** attempt)
+            try:
+                send = getattr(self.client, f"{action}_documents")
+                if self.rate_limiter:
+                    results = self.rate_limiter.call(send, documents=docs)
+                else:
+                    results = send(documents=docs)
+            except AzureError as e:
+                # Connection errors (ServiceRequestError, ServiceResponseError) have no status code and are retried
+                logging.warning(f"Could not {action} batch of {len(docs)} documents to Azure Search: {e}")
+                status_code = getattr(e, "status_code", None)
+                if status_code is not None and status_code not in RETRIABLE_STATUS_CODES:
+                    break
+                if self.rate_limiter and status_code in THROTTLE_STATUS_CODES:
+                    # The rate limiter already retried the throttled request until it gave up
+                    break
+                continue
+            self.stats[f"{action}_batches"] += 1
+            by_key = {doc[self.key_field]: doc for doc in docs}
+            retry = []
+            for result in results:
+                if result.succeeded:
+                    self.stats[DONE_STATS[action]] += 1
+                elif result.status_code in RETRIABLE_STATUS_CODES:
+                    retry.append(by_key[result.key])
+                else:
+                    self.stats["failed"] += 1
+                    self.failed_keys.add(result.key)
+                    logging.warning(f"Could not {action} document {result.key} to Azure Search: "
+                                    f"{result.error_message}")
+            docs = retry
+            if not docs:
+                return
+        self.stats["failed"] += len(docs)
+        self.failed_keys.update(doc[self.key_field] for doc in docs)
+        logging.warning(f"Giving up {action} of {len(docs)} documents to Azure Search")
@@ -1,8 +1,6 @@
 import os
-# All the different handlers must be imported so that the dynamic loading works
-# Todo: Find a better way to do this
-from confluence_vector_sync.gpt_vision import GPTVisionMediaHandler
-from confluence_vector_sync.azure_document_intelligence import AzureDocumentIntelligenceMediaHandler
+
+from confluence_vector_sync.handlers import LazyMediaHandler, check_media_handler
 
 
 def get_config():
@@ -12,19 +10,50 @@ def get_config():
         if key.startswith("CONFLUENCE_EXTRA_HEADER_KEY_"):
             extra_headers.append({os.environ[key]: os.environ[key.replace('KEY', 'VALUE')]})
         if key.startswith("MEDIA_HANDLER_KEY_"):
-            handler = globals()[os.environ[key.replace('KEY', 'VALUE')]]
-            config = os.environ[key.replace('KEY', 'CONFIG')]
+            name = os.environ[key.replace('KEY', 'VALUE')]
+            check_media_handler(name)
+            # Imported and created when the first attachment of one of its media types is extracted
+            handler = LazyMediaHandler(name, os.environ[key.replace('KEY', 'CONFIG')])
             media_types = os.environ[key].split(",")
             for media_type in media_types:
-                media_handlers.append({media_type: handler(config)})
+                media_handlers.append({media_type: handler})
     return {
         "search_type": os.getenv("SEARCH_TYPE", "AZURE_COGNITIVE_SEARCH"),
+        "local_index_path": os.getenv("LOCAL_INDEX_PATH", "local_index"),
+        "local_index_quantization": os.getenv("LOCAL_INDEX_QUANTIZATION", "float32").lower(),
+        "local_index_type": os.getenv("LOCAL_INDEX_TYPE", "flat").lower(),
+        "local_index_nprobe": int(os.getenv("LOCAL_INDEX_NPROBE", "8")),
         "azure_search_endpoint": os.getenv("AZURE_SEARCH_ENDPOINT"),
         "azure_search_key": os.getenv("AZURE_SEARCH_KEY"),
         "azure_search_full_reindex": os.getenv("AZURE_SEARCH_FULL_REINDEX", "false").lower() == "true",
         "azure_search_embedding_model": os.getenv("AZURE_SEARCH_EMBEDDING_MODEL", "text-embedding-ada-002"),
         "azure_search_api_version": os.getenv("AZURE_SEARCH_API_VERSION", "2023-11-01"),
+        "azure_search_vector_compression": os.getenv("AZURE_SEARCH_VECTOR_COMPRESSION", "none").lower(),
+        "azure_search_vector_oversampling": float(os.getenv("AZURE_SEARCH_VECTOR_OVERSAMPLING", "10")),
+        "embedding_dimensions": int(os.getenv("EMBEDDING_DIMENSIONS", "0")),
+        "title_vector_chunks": os.getenv("TITLE_VECTOR_CHUNKS", "first").lower(),
         "azure_search_confluence_index": os.getenv("AZURE_SEARCH_CONFLUENCE_INDEX", "confluence"),
+        "azure_search_upload_batch_size": int(os.getenv("AZURE_SEARCH_UPLOAD_BATCH_SIZE", "1000")),
+        "azure_search_upload_batch_bytes": int(os.getenv("AZURE_SEARCH_UPLOAD_BATCH_BYTES", str(8 * 1024 * 1024))),
+        "embedding_batch_size": int(os.getenv("EMBEDDING_BATCH_SIZE", "16")),
+        "embedding_batch_max_tokens": int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "50000")),
+        "embedding_cache_path": os.getenv("EMBEDDING_CACHE_PATH", ""),
+        "embedding_cache_max_entries": int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "500000")),
+        "dedup_chunks": os.getenv("DEDUP_CHUNKS", "off").lower(),
+        "dedup_threshold": float(os.getenv("DEDUP_THRESHOLD", "0.9")),
+        "dedup_max_entries": int(os.getenv("DEDUP_MAX_ENTRIES", "10000")),
+        "dedup_drop_after": int(os.getenv("DEDUP_DROP_AFTER", "0")),
+        "pipeline_fetch_workers": int(os.getenv("PIPELINE_FETCH_WORKERS", "4")),
+        "pipeline_parse_workers": int(os.getenv("PIPELINE_PARSE_WORKERS", "0")),
+        "pipeline_embed_workers": int(os.getenv("PIPELINE_EMBED_WORKERS", "2")),
+        "pipeline_queue_size": int(os.getenv("PIPELINE_QUEUE_SIZE", "32")),
+        "confluence_max_rps": float(os.getenv("CONFLUENCE_MAX_RPS", "10")),
+        "confluence_max_concurrency": int(os.getenv("CONFLUENCE_MAX_CONCURRENCY", "8")),
+        "embedding_max_rps": float(os.getenv("EMBEDDING_MAX_RPS", "10")),
+        "embedding_max_concurrency": int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "4")),
+        "azure_search_max_rps": float(os.getenv("AZURE_SEARCH_MAX_RPS", "20")),
+        "azure_search_max_concurrency": int(os.getenv("AZURE_SEARCH_MAX_CONCURRENCY", "4")),
+        "rate_limit_max_retries": int(os.getenv("RATE_LIMIT_MAX_RETRIES", "6")),
         "confluence_url": os.getenv("CONFLUENCE_URL"),
         "confluence_user_name": os.getenv("CONFLUENCE_USER_NAME"),
         "confluence_password": os.getenv("CONFLUENCE_PASSWORD"),
@@ -32,8 +61,28 @@ def get_config():
         "confluence_test_space": os.getenv("CONFLUENCE_TEST_SPACE"),
         "confluence_auth_method": os.getenv("CONFLUENCE_AUTH_METHOD", "PASSWORD"),
         "confluence_extra_headers": extra_headers,
+        "confluence_incremental": os.getenv("CONFLUENCE_INCREMENTAL", "false").lower() == "true",
+        "confluence_reconcile_hours": float(os.getenv("CONFLUENCE_RECONCILE_HOURS", "24")),
+        "confluence_api_version": os.getenv("CONFLUENCE_API_VERSION", "v1").lower(),
+        "confluence_page_size": int(os.getenv("CONFLUENCE_PAGE_SIZE", "100")),
+        "confluence_body_batch_size": int(os.getenv("CONFLUENCE_BODY_BATCH_SIZE", "25")),
+        "chunk_unit": os.getenv("CHUNK_UNIT", "characters").lower(),
+        "chunk_size": int(os.getenv("CHUNK_SIZE", "0")),
+        "chunk_overlap": int(os.getenv("CHUNK_OVERLAP", "-1")),
+        "sync_state_path": os.getenv("SYNC_STATE_PATH", "sync_state.json"),
+        "run_journal_path": os.getenv("RUN_JOURNAL_PATH", ""),
+        "run_profile_path": os.getenv("RUN_PROFILE_PATH", ""),
+        "shard_queue_path": os.getenv("SHARD_QUEUE_PATH", "shards.db"),
+        "shard_buckets": int(os.getenv("SHARD_BUCKETS", "1")),
+        "shard_lease_seconds": float(os.getenv("SHARD_LEASE_SECONDS", "600")),
         "index_attachments": os.getenv("INDEX_ATTACHMENTS", "false").lower() == "true",
         "attachment_indexer_type": os.getenv("ATTACHMENT_INDEXER_TYPE", "AZURE_DOCUMENT_INTELLIGENCE"),
         "media_handlers": media_handlers,
+        "attachment_workers": int(os.getenv("ATTACHMENT_WORKERS", "8")),
+        "attachment_in_flight_bytes": int(os.getenv("ATTACHMENT_IN_FLIGHT_BYTES", str(64 * 1024 * 1024))),
+        "extraction_cache_path": os.getenv("EXTRACTION_CACHE_PATH", ""),
+        "extraction_cache_max_bytes": int(os.getenv("EXTRACTION_CACHE_MAX_BYTES", str(512 * 1024 * 1024))),
+        "reconcile_workers": int(os.getenv("RECONCILE_WORKERS", "8")),
+        "attachment_spool_bytes": int(os.getenv("ATTACHMENT_SPOOL_BYTES", str(1024 * 1024))),
         "ignore_confluence_cert": os.getenv("IGNORE_CONFLUENCE_CERT", "false").lower() == "true"
     }
@@ -1,13 +1,50 @@
 import json
-from typing import Dict, List
+import logging
+from dataclasses import dataclass
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+from urllib.parse import urljoin
 import os
-from datetime import datetime, timezone
-import tempfile
+from datetime import datetime, timedelta, timezone
 import requests
 import urllib3
 from atlassian import Confluence
-from bs4 import BeautifulSoup
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from confluence_vector_sync import otel
+from confluence_vector_sync.attachment_loader import SpooledDownload
+from confluence_vector_sync.parsing import split_storage_format
+from confluence_vector_sync.ratelimit import AdaptiveRateLimiter, RateLimitedSession, rate_limiter_from_config
+from confluence_vector_sync.state import SyncState
+
+
+# Default chunk size and overlap when they are counted in tokens, about the size of the default in characters
+TOKEN_CHUNK_SIZE = 512
+TOKEN_CHUNK_OVERLAP = 128
+
+
+@dataclass(slots=True)
+class PageHeader:
+    """What the sync needs to know about a page, much smaller than the page of the api with its expansions"""
+    id: str
+    space: str
+    status: str
+    title: str = ""
+    last_modified: Optional[datetime] = None
+    webui: str = ""
+    attachments: Optional[List[Dict]] = None
+    # Filled by with_page_bodies just before the page is indexed, dropped when it is read
+    body: Optional[str] = None
+
+
+@dataclass(slots=True)
+class SpacePages:
+    """A space and the lazy listing of its pages.
+
+    reconciled: all pages of the space are listed, indexed pages missing from the listing were deleted.
+    """
+    key: str
+    reconciled: bool
+    pages: Iterator[PageHeader]
 
 
 class ConfluenceWrapper:
@@ -15,11 +52,28 @@ class ConfluenceWrapper:
     space_filter: List[str] = []
     chunk_size = 2000
     chunk_overlap = 500
+    # Model whose tokens the chunk size and overlap are counted in, None counts characters
+    chunk_tokenizer: Optional[str] = None
     handle_attachments = False
     datetime_format = '%Y-%m-%dT%H:%M:%S.%fZ'
+    # Incremental mode lists only pages changed after the watermark of the previous run (kept in state)
+    incremental = False
+    state: SyncState = None
+    reconcile_interval = timedelta(hours=24)
+    # v2 lists pages with cursors, v1 with offsets (also supported by confluence server / data center)
+    api_version = "v1"
+    page_size = 100
+    body_batch_size = 25
+    download_chunk_size = 64 * 1024
 
-    def __init__(self, url, username, password, auth_method="PASSWORD", extra_headers=[], ignore_ssl=False):
-        session = requests.Session()
+    def __init__(self, url, username, password, auth_method="PASSWORD", extra_headers=[], ignore_ssl=False,
+                 rate_limiter: AdaptiveRateLimiter = None, api_version: str = "v1", page_size: int = 100,
+                 body_batch_size: int = 25):
+        self.api_version = api_version
+        self.page_size = page_size
+        self.body_batch_size = body_batch_size
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter("confluence")
+        session = RateLimitedSession(self.rate_limiter)
         verify_ssl = not ignore_ssl
         for extra in extra_headers:
             session.headers.update(extra)
@@ -38,109 +92,267 @@ class ConfluenceWrapper:
                                          verify_ssl=verify_ssl)
         self.session = session
 
-    def create_space_page_map(self) -> Dict[str, Dict]:
-        """Creates a map of spaces with their pages"""
-        results = []
-        i = 0
+    def iter_space_pages(self) -> Iterator[SpacePages]:
+        """Yields the spaces one by one, each with a lazy listing of its pages"""
+        for space_key in self.iter_space_keys():
+            watermark = self.state.get_watermark(space_key) if self.incremental and self.state else None
+            reconciled = watermark is None or self.reconcile_due(space_key)
+            if reconciled:
+                listing = self.get_pages(space_key)
+            else:
+                listing = self.get_changed_pages(space_key, watermark)
+            yield SpacePages(key=space_key,
+                             reconciled=reconciled,
+                             pages=self.page_headers(listing, space_key, inventory=reconciled))
+
+    def iter_space_keys(self) -> Iterator[str]:
         if len(self.space_filter) > 0:
             for space_key in self.space_filter:
-                result = self.confluence.get_space(space_key=space_key)
-                results.append(result)
+                yield self.confluence.get_space(space_key=space_key)["key"]
         else:
-            while True:
-                iter_results = self.confluence.get_all_spaces(space_type='global', start=i, limit=i + 100, expand=None)[
-                    "results"]
-                if len(iter_results) == 0:
-                    break
-                results.extend(iter_results)
-                i += 100
-
-        space_page_map = {}
-        for space in results:
-            pages = self.get_pages(space["key"])
-            for page in pages:
-                if 'version' in page:
-                    page["last_modified"] = datetime.fromisoformat(page["version"]["when"])
-                if self.handle_attachments:
-                    try:
+            for space in self.paginate(lambda start, limit: self.confluence.get_all_spaces(
+                    space_type='global', start=start, limit=limit, expand=None)["results"]):
+                yield space["key"]
+
+    def page_headers(self, listing: Iterable[Dict], space_key: str, inventory: bool) -> Iterator[PageHeader]:
+        """Headers of the listed pages.
+
+        With inventory the attachments of the whole space are listed up front instead of with one request per page.
+        When only the changed pages are listed, a request for each of them is fewer requests.
+        """
+        attachments = None
+        if self.handle_attachments and inventory:
+            attachments = self.get_attachment_inventory(space_key)
+        for page in listing:
+            yield self.page_header(page, space_key, attachments)
+
+    def page_header(self, page: Dict, space_key: str, inventory: Optional[Dict[str, List[Dict]]] = None
+                    ) -> PageHeader:
+        """The compact header of a page of the api, with its attachments if they are handled.
+
+        The attachments are taken from the inventory of the space by page id when it is given.
+        """
+        header = PageHeader(id=page["id"],
+                            space=space_key,
+                            status=page["status"],
+                            title=page.get("title", ""),
+                            webui=page["_links"]["webui"])
+        if 'version' in page:
+            header.last_modified = datetime.fromisoformat(page["version"]["when"])
+        if self.handle_attachments:
+            if inventory is not None:
+                attachments_container = {"results": inventory.get(page["id"], [])}
+            else:
+                try:
+                    with otel.stage("confluence.attachments"):
                         attachments_container = self.confluence.get_attachments_from_content(page_id=page["id"])
-                    except:
-                        attachments_container = None
-                    if attachments_container and attachments_container["size"] > 0:
-                        page["attachments"] = attachments_container["results"]
-                        for result in attachments_container["results"]:
-                            if "_links" in result and "download" in result["_links"]:
-                                attachment_last_modified = get_last_modified_attachment(result)
-                                if attachment_last_modified > page["last_modified"]:
-                                    page["last_modified"] = attachment_last_modified
-
-            space_page_map[space["key"]] = {
-                "pages": pages,
-            }
-        return space_page_map
-
-    def get_pages(self, space_key: str) -> List[Dict]:
-        results = []
-        i = 0
+                except:
+                    attachments_container = None
+            if attachments_container and attachments_container["results"]:
+                header.attachments = [compact_attachment(result) for result in attachments_container["results"]]
+                for result in attachments_container["results"]:
+                    if "_links" in result and "download" in result["_links"]:
+                        attachment_last_modified = get_last_modified_attachment(result)
+                        if attachment_last_modified > header.last_modified:
+                            header.last_modified = attachment_last_modified
+        return header
+
+    def paginate(self, fetch: Callable[[int, int], List[Dict]]) -> Iterator[Dict]:
+        """Yields the results of a v1 listing, requesting fetch(start, limit) with a fixed page size"""
+        start = 0
         while True:
-            iter_results = self.confluence.get_all_pages_from_space(space_key, start=i, limit=i + 100, status='any',
-                                                                    expand='history,space,version', content_type='page')
-            if len(iter_results) == 0:
+            with otel.stage("confluence.list", start=start):
+                results = fetch(start, self.page_size)
+            if len(results) == 0:
                 break
-            results.extend(iter_results)
-            i += 100
-        return results
+            yield from results
+            # The server may return fewer results than asked for, continue after the last one
+            start += len(results)
 
-    def chunk_page(self, page_header: Dict) -> List[Dict]:
-        """Chunks a page into smaller pieces"""
+    def paginate_v2(self, path: str, params: Dict) -> Iterator[Dict]:
+        """Yields the results of a v2 listing, following the cursor in the next link"""
+        with otel.stage("confluence.list"):
+            response = self.confluence.get(path, params=params)
+        while True:
+            yield from response["results"]
+            next_link = response.get("_links", {}).get("next")
+            if not next_link:
+                break
+            # The next link is relative to the site, it contains the /wiki context path
+            with otel.stage("confluence.list"):
+                response = self.confluence.get(urljoin(self.confluence.url, next_link), absolute=True)
+
+    def get_pages(self, space_key: str) -> Iterator[Dict]:
+        """All pages of the space, in any status"""
+        if self.api_version == "v2":
+            return self.get_pages_v2(space_key)
+        return self.paginate(lambda start, limit: self.confluence.get_all_pages_from_space(
+            space_key, start=start, limit=limit, status='any', expand='history,space,version', content_type='page'))
+
+    def get_pages_v2(self, space_key: str) -> Iterator[Dict]:
+        space_id = self.confluence.get("api/v2/spaces", params={"keys": space_key})["results"][0]["id"]
+        for page in self.paginate_v2(f"api/v2/spaces/{space_id}/pages",
+                                     {"limit": self.page_size, "status": "current,archived,trashed"}):
+            yield page_from_v2(page)
+
+    def get_changed_pages(self, space_key: str, since: datetime) -> Iterator[Dict]:
+        """Pages of the space modified after since, found with CQL. Deleted pages are not included.
+
+        With attachments, also the pages of attachments modified after since, a new attachment does not modify
+        its page.
+        """
+        # CQL compares dates in the timezone of the user, step back a day to not miss anything
+        cql = f'space = "{space_key}" and type = page and lastmodified >= "{(since - timedelta(days=1)):%Y-%m-%d}"'
+        listed = set()
+        for result in self.paginate(lambda start, limit: self.confluence.cql(
+                cql, start=start, limit=limit, expand="content.history,content.space,content.version")["results"]):
+            listed.add(str(result["content"]["id"]))
+            yield result["content"]
+        if not self.handle_attachments:
+            return
+        containers = {str(attachment["container"]["id"]) for attachment in self.get_attachments(space_key, since)
+                      if attachment.get("container", {}).get("type", "page") == "page"}
+        pages = iter(sorted(containers - listed))
+        while batch := list(islice(pages, self.page_size)):
+            yield from self.confluence.get("rest/api/content/search",
+                                           params={"cql": f"id in ({','.join(batch)})",
+                                                   "expand": "history,space,version",
+                                                   "limit": len(batch)})["results"]
+
+    def get_attachments(self, space_key: str, since: datetime = None) -> Iterator[Dict]:
+        """The current attachments of the space, or those modified after since, with their page as container"""
+        cql = f'space = "{space_key}" and type = attachment'
+        if since:
+            cql += f' and lastmodified >= "{(since - timedelta(days=1)):%Y-%m-%d}"'
+        return self.paginate(lambda start, limit: self.confluence.get(
+            "rest/api/content/search", params={"cql": cql, "start": start, "limit": limit,
+                                               "expand": "container,metadata,extensions,version"})["results"])
+
+    def get_attachment_inventory(self, space_key: str) -> Optional[Dict[str, List[Dict]]]:
+        """The attachments of all pages of the space by page id, None when they could not be listed"""
+        inventory = {}
         try:
-            content = self.confluence.get_page_by_id(page_header["id"], expand="body.storage")["body"]["storage"][
-                "value"]
-            soup = BeautifulSoup(content, 'html.parser').get_text()
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=self.chunk_size,
-                chunk_overlap=self.chunk_overlap
-            )
-            chunks = text_splitter.split_text(soup)
-            doc_chunks = []
-            for i, chunk in enumerate(chunks):
-                doc_chunks.append({"text": chunk, "chunk": i})
-            return doc_chunks
-        except:
-            return []
+            with otel.stage("confluence.attachment_inventory", space=space_key):
+                for attachment in self.get_attachments(space_key):
+                    inventory.setdefault(str(attachment["container"]["id"]), []).append(
+                        compact_attachment(attachment))
+        except Exception as e:
+            logging.warning(f"Could not list the attachments of space {space_key}, listing them per page: {e}")
+            return None
+        return inventory
+
+    def get_page_bodies(self, page_ids: List[str]) -> Dict[str, str]:
+        """Bodies in storage format of the pages by id, fetched with a single request"""
+        with otel.stage("confluence.bodies", pages=len(page_ids)):
+            if self.api_version == "v2":
+                response = self.confluence.get("api/v2/pages", params={"id": ",".join(page_ids),
+                                                                       "body-format": "storage",
+                                                                       "limit": len(page_ids)})
+            else:
+                response = self.confluence.get("rest/api/content/search",
+                                               params={"cql": f"id in ({','.join(page_ids)})",
+                                                       "expand": "body.storage",
+                                                       "limit": len(page_ids)})
+        bodies = {str(page["id"]): page["body"]["storage"]["value"] for page in response["results"]
+                  if "storage" in page.get("body", {})}
+        for body in bodies.values():
+            record_download(len(body.encode()), "page")
+        return bodies
+
+    def with_page_bodies(self, pages: Iterable[PageHeader]) -> Iterator[PageHeader]:
+        """Yields the pages with their body filled in, fetched for body_batch_size pages per request"""
+        pages = iter(pages)
+        while batch := list(islice(pages, self.body_batch_size)):
+            try:
+                bodies = self.get_page_bodies([page.id for page in batch])
+            except Exception as e:
+                # get_page_content fetches the missing bodies one by one
+                logging.warning(f"Fetching the bodies of {len(batch)} pages failed: {e}")
+                bodies = {}
+            for page in batch:
+                page.body = bodies.get(page.id)
+                yield page
+
+    def reconcile_due(self, space_key: str) -> bool:
+        reconciled = self.state.get_reconciled(space_key)
+        return reconciled is None or datetime.now(timezone.utc) - reconciled > self.reconcile_interval
+
+    def get_page_content(self, page_header: PageHeader) -> str:
+        """Page body in confluence storage format"""
+        # Bodies fetched in bulk by with_page_bodies are used once, they are not kept in the page model
+        body, page_header.body = page_header.body, None
+        if body is not None:
+            return body
+        with otel.stage("confluence.body"):
+            body = self.confluence.get_page_by_id(page_header.id, expand="body.storage")["body"]["storage"]["value"]
+        record_download(len(body.encode()), "page")
+        return body
+
+    def chunk_page(self, page_header: PageHeader) -> List[Dict]:
+        """Chunks a page into smaller pieces"""
+        return split_storage_format(self.get_page_content(page_header), self.chunk_size, self.chunk_overlap,
+                                    self.chunk_tokenizer)
+
+    def get_page_url(self, page_header: PageHeader) -> str:
+        return f'{self.confluence.url.rstrip("/")}/display/{page_header.space}/{page_header.webui.split("/")[-1]}'
 
     def get_attachment_page_url(self, attachment: Dict) -> str:
         return self.confluence.url + attachment["_links"]["download"]
 
-    def get_attachment_by_id(self, attachment_id: str) -> str:
-        try:
-            url = self.confluence.url + "api/v2/attachments/" + attachment_id
-            request = self.session.get(url, stream=True)
-            if request.status_code == 200:
-                item = json.loads(request.text)
-                if item["status"] == "trashed":
-                    return None
-                return item
-            else:
-                return None
-        except:
+    def get_attachment_by_id(self, attachment_id: str) -> Optional[Dict]:
+        """The attachment, or None if it does not exist (anymore). Other errors are raised"""
+        url = self.confluence.url + "api/v2/attachments/" + attachment_id
+        request = self.session.get(url)
+        if request.status_code == 404:
             return None
+        request.raise_for_status()
+        item = json.loads(request.text)
+        if item["status"] == "trashed":
+            return None
+        return item
 
     def download_to_tempfile(self, attachment):
+        # Spooling nothing in memory, the content is always written to the temporary file
+        download = self.download_attachment(attachment, spool_bytes=0)
+        # Return the path of the temporary file
+        return download.to_file()
+
+    def download_attachment(self, attachment, spool_bytes: int) -> SpooledDownload:
+        """Streams the attachment into memory, or into a temporary file when it is larger than spool_bytes"""
         url = self.get_attachment_page_url(attachment)
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        download = SpooledDownload(spool_bytes)
+        with otel.stage("confluence.download", media_type=attachment["metadata"]["mediaType"]):
             # Send a HTTP request to the URL
             response = self.session.get(url, stream=True)
-
-            # Check if the request is successful
-            if response.status_code == 200:
-                # Write the content to the temporary file
-                for chunk in response.iter_content(chunk_size=1024):
+            # Do not index an error page as the attachment
+            response.raise_for_status()
+            try:
+                for chunk in response.iter_content(chunk_size=self.download_chunk_size):
                     if chunk:
-                        temp_file.write(chunk)
+                        download.write(chunk)
+                download.finish()
+            except Exception:
+                download.close()
+                raise
+        record_download(download.size, "attachment")
+        return download
 
-            # Return the path of the temporary file
-            return temp_file.name
+
+def record_download(size: int, kind: str):
+    otel.payload_size.record(size, {"kind": kind})
+    otel.bytes_downloaded.add(size, {"kind": kind})
+
+
+def compact_attachment(attachment: Dict) -> Dict:
+    """The fields of an attachment that the sync reads, the whole api object is much larger"""
+    metadata = attachment.get("metadata", {})
+    compact = {"id": attachment["id"],
+               "title": attachment.get("title", ""),
+               "metadata": {key: metadata[key] for key in ("mediaType", "comment") if key in metadata},
+               "_links": {key: value for key, value in attachment.get("_links", {}).items() if key == "download"}}
+    if "extensions" in attachment:
+        compact["extensions"] = {"fileSize": attachment["extensions"].get("fileSize")}
+    return compact
 
 
 def get_last_modified_attachment(attachment) -> datetime:
@@ -150,11 +362,32 @@ def get_last_modified_attachment(attachment) -> datetime:
                                   tz=timezone.utc)
 
 
+def page_from_v2(page: Dict) -> Dict:
+    """Converts a page of the v2 api to the v1 format read by page_header"""
+    return {"id": str(page["id"]),
+            "title": page["title"],
+            "status": page["status"],
+            "version": {"when": page["version"]["createdAt"]},
+            "_links": {"webui": page["_links"]["webui"]}}
+
+
 def confluence_from_config(config: Dict[str, str]) -> ConfluenceWrapper:
     """Creates a ConfluenceWrapper from a config"""
-    return ConfluenceWrapper(url=config["confluence_url"],
-                             username=config["confluence_user_name"],
-                             password=config["confluence_password"],
-                             auth_method=config["confluence_auth_method"],
-                             extra_headers=config["confluence_extra_headers"],
-                             ignore_ssl=config["ignore_confluence_cert"])
+    confluence = ConfluenceWrapper(url=config["confluence_url"],
+                                   username=config["confluence_user_name"],
+                                   password=config["confluence_password"],
+                                   auth_method=config["confluence_auth_method"],
+                                   extra_headers=config["confluence_extra_headers"],
+                                   ignore_ssl=config["ignore_confluence_cert"],
+                                   rate_limiter=rate_limiter_from_config(config, "confluence"),
+                                   api_version=config["confluence_api_version"],
+                                   page_size=config["confluence_page_size"],
+                                   body_batch_size=config["confluence_body_batch_size"])
+    if config["chunk_unit"] == "tokens":
+        confluence.chunk_tokenizer = config["azure_search_embedding_model"]
+        confluence.chunk_size, confluence.chunk_overlap = TOKEN_CHUNK_SIZE, TOKEN_CHUNK_OVERLAP
+    if config["chunk_size"] > 0:
+        confluence.chunk_size = config["chunk_size"]
+    if config["chunk_overlap"] >= 0:
+        confluence.chunk_overlap = config["chunk_overlap"]
+    return confluence
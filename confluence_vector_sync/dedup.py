@@ -0,0 +1,174 @@
+import json
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from confluence_vector_sync.embedding_cache import normalize_text
+
+MERSENNE_PRIME = (1 << 61) - 1
+SHINGLE_MULTIPLIER = np.uint64(0x9E3779B1)
+
+
+class Representative:
+    """A text that is embedded for itself and for its duplicates"""
+    __slots__ = ("text", "signature", "vector", "pages")
+
+    def __init__(self, text: str, signature: Optional[np.ndarray]):
+        self.text = text
+        self.signature = signature
+        self.vector: Optional[np.ndarray] = None
+        self.pages: Set[str] = set()
+
+
+class ChunkDeduplicator:
+    """Finds texts of a run that repeat an earlier text, identically or nearly, so that they are embedded once.
+
+    Texts are equal when their normalized forms are. Texts of at least min_words words are also compared by
+    MinHash: the signature of a text is the minimum of num_perm hash functions over its shingles (runs of
+    shingle_words words), and the fraction of equal minimums estimates the Jaccard similarity of two texts. The
+    signatures are cut in bands of band_rows hashes and only texts that share a band are compared (LSH). The
+    max_entries most recently used texts are kept, with their vectors once they are embedded.
+    """
+
+    def __init__(self, near: bool = True, threshold: float = 0.9, max_entries: int = 10000, drop_after: int = 0,
+                 num_perm: int = 64, band_rows: int = 4, shingle_words: int = 3, min_words: int = 20, seed: int = 1):
+        self.near = near
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.drop_after = drop_after
+        self.band_rows = band_rows
+        self.shingle_words = shingle_words
+        self.min_words = min_words
+        rng = np.random.default_rng(seed)
+        # (a * x + b) mod p stays below 2^64 for 32 bit shingle hashes x and a, b below 2^31
+        self.a = rng.integers(1, 1 << 31, size=(num_perm, 1), dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 31, size=(num_perm, 1), dtype=np.uint64)
+        self.lock = threading.Lock()
+        # normalized text -> representative, least recently used first
+        self.entries: "OrderedDict[str, Representative]" = OrderedDict()
+        # band -> normalized texts with that band in their signature
+        self.bands: List[Dict[bytes, Set[str]]] = [{} for _ in range(num_perm // band_rows)]
+        self.stats = None
+        self.reset()
+
+    def reset(self):
+        self.stats = {"exact": 0,
+                      "near": 0,
+                      "embeddings_saved": 0,
+                      "tokens_saved": 0,
+                      "dropped": 0,
+                      "dropped_bytes": 0}
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """MinHash of the shingles of a normalized text, None for texts too short to compare"""
+        words = text.lower().split()
+        if not self.near or len(words) < self.min_words:
+            return None
+        word_hashes = np.fromiter((zlib.crc32(word.encode("utf-8")) for word in words), dtype=np.uint64,
+                                  count=len(words))
+        # The hash of a shingle mixes the hashes of its words, wrapping around is fine for the low 32 bits
+        count = len(words) - self.shingle_words + 1
+        hashes = np.zeros(count, dtype=np.uint64)
+        for i in range(self.shingle_words):
+            hashes = hashes * SHINGLE_MULTIPLIER + word_hashes[i:i + count]
+        hashes = np.unique(hashes & 0xFFFFFFFF)
+        return ((self.a * hashes + self.b) % MERSENNE_PRIME).min(axis=1)
+
+    def band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[i * self.band_rows:(i + 1) * self.band_rows].tobytes() for i in range(len(self.bands))]
+
+    def find(self, key: str, signature: Optional[np.ndarray]) -> Tuple[Optional[Representative], str]:
+        """The representative of a text and whether it is an exact or near duplicate, call with lock held"""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key], "exact"
+        if signature is None:
+            return None, ""
+        best, similarity = None, self.threshold
+        candidates = set()
+        for band, band_key in zip(self.bands, self.band_keys(signature)):
+            candidates.update(band.get(band_key, ()))
+        for candidate in candidates:
+            representative = self.entries[candidate]
+            estimate = float(np.mean(representative.signature == signature))
+            if estimate >= similarity:
+                best, similarity = representative, estimate
+        if best is None:
+            return None, ""
+        self.entries.move_to_end(normalize_text(best.text))
+        return best, "near"
+
+    def register(self, key: str, text: str, signature: Optional[np.ndarray]) -> Representative:
+        """Call with lock held"""
+        representative = Representative(text, signature)
+        self.entries[key] = representative
+        if signature is not None:
+            for band, band_key in zip(self.bands, self.band_keys(signature)):
+                band.setdefault(band_key, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            if evicted.signature is not None:
+                for band, band_key in zip(self.bands, self.band_keys(evicted.signature)):
+                    band[band_key].discard(evicted_key)
+                    if not band[band_key]:
+                        del band[band_key]
+        return representative
+
+    def representative(self, text: str) -> Tuple[Representative, str]:
+        """The representative of the text, the text becomes one when it is new"""
+        key = normalize_text(text)
+        signature = None if key in self.entries else self.signature(key)
+        with self.lock:
+            representative, kind = self.find(key, signature)
+            if representative is None:
+                representative = self.register(key, text, signature)
+            return representative, kind
+
+    def lookup(self, text: str) -> Tuple[str, Optional[List[float]], str]:
+        """(text of the representative, its vector when embedded, exact/near) of a duplicate.
+
+        A new text is its own representative and the kind is empty.
+        """
+        representative, kind = self.representative(text)
+        vector = representative.vector
+        return representative.text, vector.tolist() if vector is not None else None, kind
+
+    def embedded(self, vectors: Dict[str, List[float]]):
+        """Keep the vectors of embedded texts for their duplicates"""
+        for text, vector in vectors.items():
+            representative, kind = self.representative(text)
+            if representative.vector is None and kind != "near":
+                representative.vector = np.asarray(vector, dtype=np.float32)
+
+    def reused(self, kind: str, tokens: int):
+        with self.lock:
+            self.stats[kind] += 1
+            self.stats["embeddings_saved"] += 1
+            self.stats["tokens_saved"] += tokens
+
+    def drop_boilerplate(self, page_id: str, docs: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """(kept, dropped) documents, chunks repeated on more than drop_after pages are dropped.
+
+        The first chunk of a document is kept, the index needs it to know that the document is indexed.
+        """
+        if not self.drop_after:
+            return docs, []
+        kept, dropped = [], []
+        for doc in docs:
+            representative, _ = self.representative(doc["chunk"])
+            with self.lock:
+                if len(representative.pages) <= self.drop_after:
+                    representative.pages.add(page_id)
+                boilerplate = len(representative.pages) > self.drop_after
+            if boilerplate and not doc["id"].endswith("_0"):
+                dropped.append(doc)
+            else:
+                kept.append(doc)
+        if dropped:
+            with self.lock:
+                self.stats["dropped"] += len(dropped)
+                self.stats["dropped_bytes"] += sum(len(json.dumps(doc)) for doc in dropped)
+        return kept, dropped
@@ -0,0 +1,396 @@
+"""Indexing split into shards by space and page id, run by several worker processes or containers.
+
+The coordinator lists the pages of each space once and puts the shards of a run, each with the headers of its
+pages, in a lease queue, a SQLite file that all workers can open. Workers lease one shard at a time and index it.
+A worker that dies loses its lease when it expires and the shard is handed to another worker. When all shards are
+done, the coordinator purges deleted attachments, moves the watermarks of the incremental mode and merges the
+diagnostics of the shards.
+
+    python -m confluence_vector_sync.distributed coordinator --workers 4
+    python -m confluence_vector_sync.distributed worker
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+
+from confluence_vector_sync import otel
+from confluence_vector_sync.config import get_config
+from confluence_vector_sync.confluence import PageHeader, SpacePages
+from confluence_vector_sync.journal import RunJournal
+from confluence_vector_sync.sync import (collect_diagnostics, index_space, prepare, purge_attachments,
+                                         record_profile, save_watermarks)
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+# Stats that are not added up when the diagnostics of the shards are merged
+MAX_STATS = {"workers", "peak_in_flight_bytes", "rate", "concurrency", "max_batch_seconds"}
+
+
+def page_bucket(page_id: str, buckets: int) -> int:
+    """Bucket of a page, the same in every process (unlike hash())"""
+    return zlib.crc32(page_id.encode()) % buckets
+
+
+def dump_pages(pages: List[PageHeader]) -> str:
+    return json.dumps([dict(asdict(page), last_modified=page.last_modified.isoformat() if page.last_modified else None)
+                       for page in pages])
+
+
+def load_pages(pages: str) -> List[PageHeader]:
+    return [PageHeader(**dict(page, last_modified=datetime.fromisoformat(page["last_modified"])
+                              if page["last_modified"] else None)) for page in json.loads(pages)]
+
+
+@dataclass(slots=True)
+class Shard:
+    space: str
+    bucket: int
+    buckets: int
+
+    @property
+    def name(self) -> str:
+        return f"{self.space}-{self.bucket}"
+
+
+class ShardQueue:
+    """Shards of a run and who works on them, in a SQLite file shared by the coordinator and the workers.
+
+    A leased shard is handed to another worker when its lease expires, a shard that failed max_attempts times
+    is given up.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = 600, max_attempts: int = 3):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Autocommit, the transactions that lease are started explicitly
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS shards ("
+                                "space TEXT NOT NULL, "
+                                "bucket INTEGER NOT NULL, "
+                                "buckets INTEGER NOT NULL, "
+                                "status TEXT NOT NULL, "
+                                "worker TEXT, "
+                                "lease_until REAL, "
+                                "attempts INTEGER NOT NULL DEFAULT 0, "
+                                "result TEXT, "
+                                "reconciled INTEGER NOT NULL DEFAULT 0, "
+                                "pages TEXT NOT NULL DEFAULT '[]', "
+                                "PRIMARY KEY (space, bucket))")
+        # Whether all shards of the run are queued, the coordinator queues them space by space
+        self.connection.execute("CREATE TABLE IF NOT EXISTS run (created INTEGER NOT NULL)")
+
+    def start(self) -> bool:
+        """Forget the shards of the previous run unless it did not finish. Returns if a new run can be created.
+
+        A previous run whose shards were not all queued is started over, its coordinator stopped while listing.
+        Workers wait until the shards of the new run are created.
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            unfinished = self.connection.execute("SELECT COUNT(*) FROM shards WHERE status IN (?, ?)",
+                                                 (PENDING, LEASED)).fetchone()[0]
+            created = self.connection.execute("SELECT created FROM run").fetchone()
+            new_run = not unfinished or (created is not None and not created[0])
+            if new_run:
+                self.connection.execute("DELETE FROM shards")
+                self.connection.execute("DELETE FROM run")
+                self.connection.execute("INSERT INTO run (created) VALUES (0)")
+            self.connection.execute("COMMIT")
+        return new_run
+
+    def create(self, spaces: Iterable[SpacePages], buckets: int):
+        """Queue the shards of a new run, call after start.
+
+        The pages of each space are divided into the buckets, the shards keep the headers of their pages. The run
+        is finished once all spaces are queued and their shards done.
+        """
+        for space in spaces:
+            pages = [[] for _ in range(buckets)]
+            for page in space.pages:
+                pages[page_bucket(page.id, buckets)].append(page)
+            # Inserted space by space, only the pages of one space are in memory. Workers start on the shards of
+            # the first spaces while the next ones are listed
+            with self.lock:
+                self.connection.execute("BEGIN IMMEDIATE")
+                self.connection.executemany("INSERT INTO shards (space, bucket, buckets, status, reconciled, pages) "
+                                            "VALUES (?, ?, ?, ?, ?, ?)",
+                                            ((space.key, bucket, buckets, PENDING, space.reconciled,
+                                              dump_pages(bucket_pages)) for bucket, bucket_pages in enumerate(pages)))
+                self.connection.execute("COMMIT")
+        with self.lock:
+            self.connection.execute("UPDATE run SET created = 1")
+
+    def space_pages(self, shard: Shard) -> SpacePages:
+        """The pages of the shard as the coordinator listed them"""
+        with self.lock:
+            reconciled, pages = self.connection.execute("SELECT reconciled, pages FROM shards "
+                                                        "WHERE space = ? AND bucket = ?",
+                                                        (shard.space, shard.bucket)).fetchone()
+        return SpacePages(key=shard.space, reconciled=bool(reconciled), pages=load_pages(pages))
+
+    def lease(self, worker: str) -> Optional[Shard]:
+        """Lease the next pending shard, or a shard whose lease expired"""
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.connection.execute("SELECT space, bucket, buckets FROM shards "
+                                          "WHERE status = ? OR (status = ? AND lease_until < ?) "
+                                          "ORDER BY attempts, space, bucket LIMIT 1",
+                                          (PENDING, LEASED, now)).fetchone()
+            if row:
+                self.connection.execute("UPDATE shards SET status = ?, worker = ?, lease_until = ?, "
+                                        "attempts = attempts + 1 WHERE space = ? AND bucket = ?",
+                                        (LEASED, worker, now + self.lease_seconds, row[0], row[1]))
+            self.connection.execute("COMMIT")
+        return Shard(*row) if row else None
+
+    def renew(self, shard: Shard, worker: str) -> bool:
+        """Extend the lease, False when the shard has been handed to another worker"""
+        with self.lock:
+            updated = self.connection.execute("UPDATE shards SET lease_until = ? "
+                                              "WHERE space = ? AND bucket = ? AND worker = ? AND status = ?",
+                                              (time.time() + self.lease_seconds, shard.space, shard.bucket,
+                                               worker, LEASED)).rowcount
+        return updated > 0
+
+    def complete(self, shard: Shard, worker: str, result: Dict):
+        with self.lock:
+            self.connection.execute("UPDATE shards SET status = ?, result = ? "
+                                    "WHERE space = ? AND bucket = ? AND worker = ?",
+                                    (DONE, json.dumps(result), shard.space, shard.bucket, worker))
+
+    def fail(self, shard: Shard, worker: str):
+        """Give the shard back to the queue, or give up on it after max_attempts"""
+        with self.lock:
+            self.connection.execute("UPDATE shards SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                                    "lease_until = NULL WHERE space = ? AND bucket = ? AND worker = ?",
+                                    (self.max_attempts, FAILED, PENDING, shard.space, shard.bucket, worker))
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            rows = self.connection.execute("SELECT status, COUNT(*) FROM shards GROUP BY status").fetchall()
+        return {status: 0 for status in (PENDING, LEASED, DONE, FAILED)} | dict(rows)
+
+    def finished(self) -> bool:
+        """All shards of the run are queued and none is left to index"""
+        with self.lock:
+            row = self.connection.execute("SELECT created FROM run").fetchone()
+        counts = self.counts()
+        return (row is None or bool(row[0])) and counts[PENDING] + counts[LEASED] == 0
+
+    def results(self) -> Dict[str, List[Dict]]:
+        """The results of the shards by space, None for the shards that failed"""
+        with self.lock:
+            rows = self.connection.execute("SELECT space, status, result FROM shards").fetchall()
+        results = {}
+        for space, status, result in rows:
+            results.setdefault(space, []).append(json.loads(result) if status == DONE else None)
+        return results
+
+    def close(self):
+        self.connection.close()
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def run_worker(config: Dict = None, queue: ShardQueue = None, worker: str = None, confluence=None, search=None,
+               poll_seconds: float = 5) -> int:
+    """Index shards until none is left, returns how many this worker completed.
+
+    Waits while other workers hold leases, their shards come back when a worker dies.
+    """
+    config, confluence, search, extraction_cache = prepare(config, confluence, search)
+    queue = queue or ShardQueue(config["shard_queue_path"], lease_seconds=config["shard_lease_seconds"])
+    worker = worker or worker_name()
+    completed = 0
+    while True:
+        shard = queue.lease(worker)
+        if shard is None:
+            # No shards at all, the coordinator has not queued them yet
+            if queue.finished() and any(queue.counts().values()):
+                break
+            time.sleep(poll_seconds)
+            continue
+        try:
+            result = index_shard(config, confluence, search, shard, queue, worker)
+        except Exception as e:
+            logging.exception(f"Could not index shard {shard.name}: {e}")
+            queue.fail(shard, worker)
+            continue
+        queue.complete(shard, worker, result)
+        completed += 1
+    collect_diagnostics(search, confluence, extraction_cache)
+    otel.flush()
+    return completed
+
+
+def index_shard(config: Dict, confluence, search, shard: Shard, queue: ShardQueue, worker: str) -> Dict:
+    """Index the pages of the shard, returns its diagnostics and what the watermarks need"""
+    logging.info(f"Worker {worker} indexing shard {shard.name}")
+    search.reset()
+    confluence.rate_limiter.reset()
+    journal = None
+    if config["run_journal_path"]:
+        # A journal per shard, the worker that takes over a shard resumes it
+        journal = RunJournal(f"{config['run_journal_path']}.{shard.name}")
+        search.journal = journal
+    renewing = threading.Event()
+    renewer = threading.Thread(target=renew_lease, args=(queue, shard, worker, renewing), daemon=True)
+    renewer.start()
+    indexed = False
+    try:
+        with otel.stage("shard", space=shard.space, bucket=shard.bucket):
+            # The shard only has its own pages, include selects the indexed pages of the bucket when reconciling
+            modified, reconciled = index_space(
+                search, queue.space_pages(shard),
+                include=lambda page_id: page_bucket(page_id, shard.buckets) == shard.bucket)
+            search.close()
+        indexed = True
+    finally:
+        renewing.set()
+        renewer.join()
+        search.journal = None
+        if journal:
+            # The journal of a failed shard stays unfinished, the next worker resumes from it
+            if indexed:
+                journal.finish()
+            journal.close()
+    search.diagnostics["rate_limits"]["confluence"] = confluence.rate_limiter.stats
+    if journal:
+        search.diagnostics["journal"] = journal.stats
+    return {"diagnostics": search.diagnostics,
+            "modified": modified.isoformat() if modified else None,
+            "reconciled": reconciled,
+            # The attachments seen by the shard are still in confluence, purging does not need to check them
+            "attachments": sorted(search.attachment_cache.pop(shard.space, set()))}
+
+
+def renew_lease(queue: ShardQueue, shard: Shard, worker: str, done: threading.Event):
+    while not done.wait(queue.lease_seconds / 3):
+        if not queue.renew(shard, worker):
+            logging.warning(f"Lost the lease of shard {shard.name}, another worker indexes it too")
+
+
+def coordinate(config: Dict = None, workers: int = 1, confluence=None, search=None, poll_seconds: float = 5
+               ) -> Dict:
+    """Queue the shards of the run, run local workers (0 waits for workers in other containers) and finish the run"""
+    config, confluence, search, extraction_cache = prepare(config, confluence, search)
+    if config["search_type"] == "LOCAL":
+        raise ValueError("The local vector store can only be written by one process, use sync.py")
+    started = datetime.now(timezone.utc)
+    search.create_or_update_index()
+    queue = ShardQueue(config["shard_queue_path"], lease_seconds=config["shard_lease_seconds"])
+    if queue.start():
+        # Each space is listed once, with its attachments, for all of its shards
+        queue.create(confluence.iter_space_pages(), config["shard_buckets"])
+    else:
+        logging.warning("The previous run did not finish, resuming its shards")
+    # spawn, the workers build their own clients from the environment
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=worker_main, name=f"worker-{n}") for n in range(workers)]
+    for process in processes:
+        process.start()
+    while not queue.finished():
+        if processes and not any(process.is_alive() for process in processes):
+            raise RuntimeError(f"All workers stopped before the shards were done: {queue.counts()}")
+        time.sleep(poll_seconds)
+    for process in processes:
+        process.join()
+    diagnostics = finish_run(config, confluence, search, queue, started)
+    if extraction_cache:
+        extraction_cache.close()
+    return diagnostics
+
+
+def finish_run(config: Dict, confluence, search, queue: ShardQueue, started: datetime) -> Dict:
+    """Purge the deleted attachments, move the watermarks and merge the diagnostics of the shards"""
+    results = queue.results()
+    diagnostics = merge_diagnostics([result["diagnostics"] for shards in results.values()
+                                     for result in shards if result])
+    if config["index_attachments"]:
+        # Attachments are removed per space, after all shards of the space listed theirs
+        for space, shards in results.items():
+            if None not in shards:
+                search.attachment_cache[space] = {attachment_id for result in shards
+                                                  for attachment_id in result["attachments"]}
+        purge_attachments(search, [space for space, shards in results.items() if None not in shards])
+        search.close()
+        diagnostics["counts"]["remove"] = diagnostics.get("counts", {}).get("remove", 0) + \
+            search.diagnostics["counts"]["remove"]
+    diagnostics["shards"] = queue.counts()
+    if confluence.state:
+        space_marks = {}
+        for space, shards in results.items():
+            if None in shards:
+                logging.warning(f"Some shards of space {space} failed, not moving its watermark")
+                continue
+            modified = [datetime.fromisoformat(result["modified"]) for result in shards if result["modified"]]
+            space_marks[space] = (max(modified, default=None), all(result["reconciled"] for result in shards))
+        save_watermarks(confluence.state, space_marks, started, diagnostics)
+    record_profile(config, diagnostics)
+    queue.close()
+    otel.flush()
+    return diagnostics
+
+
+def merge_diagnostics(shards: List[Dict]) -> Dict:
+    """Adds up the diagnostics of the shards, recursively. Peaks and worker counts take the maximum"""
+    merged = {}
+    for diagnostics in shards:
+        for key, value in diagnostics.items():
+            if isinstance(value, dict):
+                merged[key] = merge_diagnostics([merged.get(key) or {}, value])
+            elif isinstance(value, bool):
+                merged[key] = merged.get(key, False) or value
+            elif isinstance(value, (int, float)) and key in MAX_STATS:
+                merged[key] = max(merged.get(key, 0), value)
+            elif isinstance(value, (int, float)):
+                merged[key] = merged.get(key, 0) + value
+            elif isinstance(value, list):
+                merged[key] = merged.get(key, []) + value
+            elif key not in merged:
+                merged[key] = value
+    # Rates do not add up, they are recomputed from the totals where these are known
+    embedding = merged.get("embedding")
+    if embedding and embedding.get("seconds"):
+        embedding["texts_per_second"] = round(embedding["texts"] / embedding["seconds"], 2)
+    for stats in (merged.get("embedding_cache"), merged.get("extraction_cache")):
+        if stats and "hit_rate" in stats:
+            lookups = sum(stats.get(name, 0) for name in ("hits", "content_hits", "misses"))
+            stats["hit_rate"] = round((stats["hits"] + stats.get("content_hits", 0)) / lookups, 3) if lookups else 0.0
+    return merged
+
+
+def worker_main():
+    run_worker()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("role", choices=["coordinator", "worker"])
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="worker processes of the coordinator, 0 waits for workers in other containers")
+    args = parser.parse_args()
+    if args.role == "coordinator":
+        print(coordinate(get_config(), workers=args.workers))
+    else:
+        print(run_worker(get_config()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from confluence_vector_sync import otel
+from confluence_vector_sync.parsing import token_counter
+
+# Vector fields of a search document and the text field they are embedded from
+VECTOR_FIELDS = {"titleVector": "title", "chunkVector": "chunk"}
+
+
+class LazyEmbedder:
+    """An embedding model that is created by the factory when the first text is embedded"""
+
+    def __init__(self, factory: Callable[[], object]):
+        self.factory = factory
+        self.embedder = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.embedder is None:
+                self.embedder = self.factory()
+            return self.embedder
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.get().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.get().embed_query(text)
+
+
+class EmbeddingBatcher:
+    """Collects texts to embed across many documents and embeds them in token-budgeted batches.
+
+    Documents are added with the vector fields that still need embedding set to None.
+    Vectors found in the (optional) EmbeddingCache are filled in without calling the embedder, and so are the
+    vectors of texts that the (optional) ChunkDeduplicator finds to repeat a text embedded in the run.
+    A document is returned (from add or flush) once all of its vectors are filled in.
+    A batch mixes the texts of several documents, when it can not be embedded all of them are given up and
+    passed to on_error(documents, exception). Without on_error the exception is raised.
+    """
+
+    def __init__(self, embedder, model: str, batch_size: int = 16, max_batch_tokens: int = 50000, cache=None,
+                 rate_limiter=None, dedup=None, on_error: Callable[[List[Dict], Exception], None] = None):
+        self.embedder = embedder
+        self.on_error = on_error
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.dedup = dedup
+        self.model = model
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.lock = threading.Lock()
+        # text -> [(document, vector field)], identical texts are embedded once
+        self.queue: Dict[str, List[Tuple[Dict, str]]] = {}
+        self.tokens: Dict[str, int] = {}
+        self.remaining: Dict[int, int] = {}
+        self.stats = None
+        self.reset()
+
+    def reset(self):
+        """Start over, the documents that a failed run left in the queue are dropped"""
+        with self.lock:
+            self.queue = {}
+            self.tokens = {}
+            self.remaining = {}
+        self.stats = {"batches": 0,
+                      "texts": 0,
+                      "tokens": 0,
+                      "failed": 0,
+                      "seconds": 0.0,
+                      "texts_per_second": 0.0,
+                      # The slowest batch, the average is seconds / batches
+                      "max_batch_seconds": 0.0}
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add(self, docs: List[Dict], token_counts: Optional[Dict[str, int]] = None) -> List[Dict]:
+        """Queue the documents for embedding, returns documents that are ready for upload.
+
+        token_counts are the known token counts of texts (from the splitter), other texts are counted here.
+        """
+        token_counts = token_counts or {}
+        cached = {}
+        if self.cache:
+            cached = self.cache.get_many({doc[source] for doc in docs for field, source in VECTOR_FIELDS.items()
+                                          if doc.get(field) is None})
+        if self.dedup and cached:
+            self.dedup.embedded(cached)
+        ready = []
+        with self.lock:
+            for doc in docs:
+                for field, source in VECTOR_FIELDS.items():
+                    if doc.get(field) is None and doc[source] in cached:
+                        doc[field] = cached[doc[source]]
+                missing = [field for field in VECTOR_FIELDS if doc.get(field) is None]
+                if not missing:
+                    ready.append(doc)
+                    continue
+                self.remaining[id(doc)] = len(missing)
+                for field in missing:
+                    text = doc[VECTOR_FIELDS[field]]
+                    if self.dedup and self.reuse(doc, field, text, token_counts):
+                        continue
+                    if text not in self.queue:
+                        self.queue[text] = []
+                        self.tokens[text] = token_counts.get(text) or self.count_tokens(text)
+                    self.queue[text].append((doc, field))
+                if self.remaining[id(doc)] == 0:
+                    # Every vector was reused from a duplicate
+                    del self.remaining[id(doc)]
+                    ready.append(doc)
+            batches = self.take_batches(full_only=True)
+        for batch, tokens in batches:
+            ready.extend(self.embed_batch(batch, tokens))
+        return ready
+
+    def flush(self) -> List[Dict]:
+        """Embed everything still in the queue, returns the documents that got completed."""
+        with self.lock:
+            batches = self.take_batches(full_only=False)
+        ready = []
+        for batch, tokens in batches:
+            ready.extend(self.embed_batch(batch, tokens))
+        return ready
+
+    def reuse(self, doc: Dict, field: str, text: str, token_counts: Dict[str, int]) -> bool:
+        """Fill in or queue the vector of a duplicate of an earlier text, call with lock held"""
+        representative, vector, kind = self.dedup.lookup(text)
+        if vector is not None:
+            doc[field] = vector
+            self.remaining[id(doc)] -= 1
+        elif representative != text and representative in self.queue:
+            self.queue[representative].append((doc, field))
+        else:
+            return False
+        if kind:
+            self.dedup.reused(kind, token_counts.get(text) or self.count_tokens(text))
+        return True
+
+    def count_tokens(self, text: str) -> int:
+        return token_counter(self.model)(text)
+
+    def take_batches(self, full_only: bool) -> List[Tuple[Dict[str, List[Tuple[Dict, str]]], int]]:
+        """Pop (batch, tokens) from the queue, bounded by text count and token budget (call with lock held)."""
+        batches = []
+        batch, batch_tokens = {}, 0
+        for text in list(self.queue):
+            tokens = self.tokens[text]
+            if batch and (len(batch) >= self.batch_size or batch_tokens + tokens > self.max_batch_tokens):
+                batches.append((batch, batch_tokens))
+                batch, batch_tokens = {}, 0
+            batch[text] = self.queue[text]
+            batch_tokens += tokens
+        if batch and (not full_only or len(batch) >= self.batch_size):
+            batches.append((batch, batch_tokens))
+        for batch, _ in batches:
+            for text in batch:
+                del self.queue[text]
+                del self.tokens[text]
+        return batches
+
+    def embed_batch(self, batch: Dict[str, List[Tuple[Dict, str]]], tokens: int) -> List[Dict]:
+        texts = list(batch)
+        start = time.perf_counter()
+        try:
+            with otel.stage("embed", texts=len(texts), tokens=tokens):
+                if self.rate_limiter:
+                    vectors = self.rate_limiter.call(self.embedder.embed_documents, texts)
+                else:
+                    vectors = self.embedder.embed_documents(texts)
+        except Exception as e:
+            self.fail_batch(batch, e)
+            return []
+        latency = time.perf_counter() - start
+        otel.tokens_embedded.add(tokens)
+        if self.cache:
+            self.cache.put_many(dict(zip(texts, vectors)))
+        if self.dedup:
+            self.dedup.embedded(dict(zip(texts, vectors)))
+        ready = []
+        with self.lock:
+            self.stats["batches"] += 1
+            self.stats["texts"] += len(texts)
+            self.stats["tokens"] += tokens
+            self.stats["seconds"] += latency
+            self.stats["max_batch_seconds"] = max(self.stats["max_batch_seconds"], round(latency, 3))
+            if self.stats["seconds"] > 0:
+                self.stats["texts_per_second"] = round(self.stats["texts"] / self.stats["seconds"], 2)
+            for text, vector in zip(texts, vectors):
+                for doc, field in batch[text]:
+                    if id(doc) not in self.remaining:
+                        # Given up with a batch that failed
+                        continue
+                    doc[field] = vector
+                    self.remaining[id(doc)] -= 1
+                    if self.remaining[id(doc)] == 0:
+                        del self.remaining[id(doc)]
+                        ready.append(doc)
+        logging.debug(f"Embedded batch of {len(texts)} texts ({tokens} tokens) in {latency:.3f}s")
+        return ready
+
+    def fail_batch(self, batch: Dict[str, List[Tuple[Dict, str]]], error: Exception):
+        """Give up the documents waiting for a batch that could not be embedded, also their other vectors"""
+        failed = {}
+        with self.lock:
+            self.stats["failed"] += len(batch)
+            for entries in batch.values():
+                for doc, _ in entries:
+                    if self.remaining.pop(id(doc), None) is not None:
+                        failed[id(doc)] = doc
+        logging.warning(f"Could not embed batch of {len(batch)} texts for {len(failed)} documents: {error}")
+        if self.on_error is None:
+            raise error
+        self.on_error(list(failed.values()), error)
@@ -0,0 +1,122 @@
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from array import array
+from typing import Dict, Iterable, List
+
+
+def normalize_text(text: str) -> str:
+    """Whitespace and unicode differences do not change the text for embedding purposes."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent embedding vectors keyed by (model, hash of the normalized text).
+
+    Stored in SQLite with least recently used eviction once max_entries is exceeded.
+    """
+
+    def __init__(self, path: str, model: str, max_entries: int = 500000):
+        self.model = model
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings ("
+                                "model TEXT NOT NULL, "
+                                "key TEXT NOT NULL, "
+                                "vector BLOB NOT NULL, "
+                                "last_used INTEGER NOT NULL, "
+                                "PRIMARY KEY (model, key))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.connection.commit()
+        self.clock = self.connection.execute("SELECT COALESCE(MAX(last_used), 0) FROM embeddings").fetchone()[0]
+        self.entries = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.stats = None
+        self.reset()
+
+    def reset(self):
+        self.stats = {"hits": 0,
+                      "misses": 0,
+                      "evictions": 0,
+                      "hit_rate": 0.0}
+
+    def get_many(self, texts: Iterable[str], touch: bool = True) -> Dict[str, List[float]]:
+        """Returns the cached vectors for the texts that are found in the cache.
+
+        With touch, the found vectors become the most recently used. Without, the file is not written.
+        """
+        keys = {}
+        for text in texts:
+            keys.setdefault(text_key(text), []).append(text)
+        found = {}
+        with self.lock:
+            if touch:
+                self.clock += 1
+            key_list = list(keys)
+            # Stay well below the sqlite max number of host parameters
+            for i in range(0, len(key_list), 500):
+                part = key_list[i:i + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({placeholders})",
+                    [self.model, *part]).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    for text in keys[key]:
+                        found[text] = vector.tolist()
+                if rows and touch:
+                    self.connection.execute(
+                        f"UPDATE embeddings SET last_used = ? WHERE model = ? AND key IN ({','.join('?' * len(rows))})",
+                        [self.clock, self.model, *[key for key, _ in rows]])
+            if touch:
+                self.connection.commit()
+            hits = len(found)
+            self.stats["hits"] += hits
+            self.stats["misses"] += sum(len(v) for v in keys.values()) - hits
+            self.update_hit_rate()
+        return found
+
+    def put_many(self, vectors: Dict[str, List[float]]):
+        if not vectors:
+            return
+        rows = {text_key(text): array("f", vector).tobytes() for text, vector in vectors.items()}
+        with self.lock:
+            self.clock += 1
+            # Texts of the same key and vectors stored by another run are replaced, they are not new entries
+            new_keys = set(rows)
+            key_list = list(rows)
+            for i in range(0, len(key_list), 500):
+                part = key_list[i:i + 500]
+                new_keys.difference_update(key for key, in self.connection.execute(
+                    f"SELECT key FROM embeddings WHERE model = ? AND key IN ({','.join('?' * len(part))})",
+                    [self.model, *part]))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, key, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(self.model, key, blob, self.clock) for key, blob in rows.items()])
+            self.entries += len(new_keys)
+            if self.entries > self.max_entries:
+                self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        """Drop the least recently used entries above max_entries (call with lock held)."""
+        self.entries = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        overflow = self.entries - self.max_entries
+        if overflow > 0:
+            self.connection.execute("DELETE FROM embeddings WHERE rowid IN "
+                                    "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)", (overflow,))
+            self.entries -= overflow
+            self.stats["evictions"] += overflow
+
+    def update_hit_rate(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        self.stats["hit_rate"] = round(self.stats["hits"] / lookups, 3) if lookups else 0.0
+
+    def close(self):
+        self.connection.close()
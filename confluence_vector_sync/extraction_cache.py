@@ -0,0 +1,104 @@
+import json
+import sqlite3
+import threading
+from typing import TYPE_CHECKING, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+if TYPE_CHECKING:
+    from langchain_core.documents import Document
+
+
+def handler_key(handler) -> str:
+    """The handler class and its model, another handler or model extracts differently"""
+    handler_type = type(handler)
+    return f"{handler_type.__module__}.{handler_type.__qualname__}:{getattr(handler, 'api_model', '')}"
+
+
+def version_key(attachment: Dict, handler) -> str:
+    """Key of an attachment version, known from the listing without downloading it"""
+    query = parse_qs(urlparse(attachment["_links"]["download"]).query)
+    version = (query.get("version") or [""])[0]
+    modified = (query.get("modificationDate") or [""])[0]
+    return f"version:{attachment['id']}:{version}:{modified}:{handler_key(handler)}"
+
+
+def content_key(sha256: str, handler) -> str:
+    """Key of the downloaded content, also hits when only the modification date of an attachment changed"""
+    return f"content:{sha256}:{handler_key(handler)}"
+
+
+class ExtractionCache:
+    """Persistent documents extracted from attachments, keyed by attachment version or content and handler.
+
+    Stored in SQLite with least recently used eviction once the stored documents exceed max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS extractions ("
+                                "key TEXT PRIMARY KEY, "
+                                "documents TEXT NOT NULL, "
+                                "size INTEGER NOT NULL, "
+                                "last_used INTEGER NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS extractions_last_used ON extractions (last_used)")
+        self.connection.commit()
+        self.clock, self.size = self.connection.execute(
+            "SELECT COALESCE(MAX(last_used), 0), COALESCE(SUM(size), 0) FROM extractions").fetchone()
+        self.stats = None
+        self.reset()
+
+    def reset(self):
+        self.stats = {"hits": 0,
+                      "content_hits": 0,
+                      "misses": 0,
+                      "evictions": 0,
+                      "hit_rate": 0.0}
+
+    def get(self, key: str) -> Optional[List['Document']]:
+        with self.lock:
+            self.clock += 1
+            row = self.connection.execute("SELECT documents FROM extractions WHERE key = ?", (key,)).fetchone()
+            if row:
+                self.connection.execute("UPDATE extractions SET last_used = ? WHERE key = ?", (self.clock, key))
+                self.connection.commit()
+        if row is None:
+            return None
+        # Only a run that extracts attachments needs langchain
+        from langchain_core.documents import Document
+        return [Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in json.loads(row[0])]
+
+    def put(self, keys: List[str], documents: List['Document']):
+        data = json.dumps([{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents])
+        with self.lock:
+            self.clock += 1
+            for key in keys:
+                old = self.connection.execute("SELECT size FROM extractions WHERE key = ?", (key,)).fetchone()
+                self.size += len(data) - (old[0] if old else 0)
+                self.connection.execute("INSERT OR REPLACE INTO extractions (key, documents, size, last_used) "
+                                        "VALUES (?, ?, ?, ?)", (key, data, len(data), self.clock))
+            if self.size > self.max_bytes:
+                self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        """Drop the least recently used entries until the size is below max_bytes (call with lock held)."""
+        rows = self.connection.execute("SELECT key, size FROM extractions ORDER BY last_used").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.size <= self.max_bytes:
+                break
+            evicted.append(key)
+            self.size -= size
+        self.connection.executemany("DELETE FROM extractions WHERE key = ?", [(key,) for key in evicted])
+        self.stats["evictions"] += len(evicted)
+
+    def count(self, result: str):
+        with self.lock:
+            self.stats[result] += 1
+            lookups = self.stats["hits"] + self.stats["content_hits"] + self.stats["misses"]
+            self.stats["hit_rate"] = round((self.stats["hits"] + self.stats["content_hits"]) / lookups, 3)
+
+    def close(self):
+        self.connection.close()
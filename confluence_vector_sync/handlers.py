@@ -0,0 +1,62 @@
+import importlib
+import threading
+
+# Packages can register more media handlers under this entry point group, by the name used in MEDIA_HANDLER_VALUE_*
+ENTRY_POINT_GROUP = "confluence_vector_sync.media_handlers"
+# The handlers of this package, imported only when an attachment needs them
+BUILTIN_MEDIA_HANDLERS = {
+    "GPTVisionMediaHandler": "confluence_vector_sync.gpt_vision:GPTVisionMediaHandler",
+    "AzureDocumentIntelligenceMediaHandler":
+        "confluence_vector_sync.azure_document_intelligence:AzureDocumentIntelligenceMediaHandler",
+}
+
+
+def find_entry_point(name: str):
+    # importlib.metadata is slow to import, the built-in handlers do not need it
+    from importlib.metadata import entry_points
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+        if entry_point.name == name:
+            return entry_point
+    return None
+
+
+def check_media_handler(name: str):
+    """Fails early on a handler name that can not be resolved, without importing the handler"""
+    if name in BUILTIN_MEDIA_HANDLERS or ":" in name or "." in name or find_entry_point(name) is not None:
+        return
+    raise ValueError(f"Unknown media handler {name}, use one of {', '.join(BUILTIN_MEDIA_HANDLERS)}, "
+                     f"an entry point of {ENTRY_POINT_GROUP} or a module:Class path")
+
+
+def resolve_media_handler(name: str) -> type:
+    """The class of a media handler: a handler of this package, an entry point or a module:Class (or module.Class)
+    path"""
+    path = BUILTIN_MEDIA_HANDLERS.get(name)
+    if path is None:
+        entry_point = find_entry_point(name)
+        if entry_point is not None:
+            return entry_point.load()
+        path = name
+    module, separator, attribute = path.partition(":")
+    if not separator:
+        module, _, attribute = path.rpartition(".")
+    return getattr(importlib.import_module(module), attribute)
+
+
+class LazyMediaHandler:
+    """A media handler that is imported and created with its config on first use.
+
+    The handlers pull in langchain and the Azure SDKs, which a run without attachments to extract does not need.
+    """
+
+    def __init__(self, name: str, config: str):
+        self.name = name
+        self.config = config
+        self.handler = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.handler is None:
+                self.handler = resolve_media_handler(self.name)(self.config)
+            return self.handler
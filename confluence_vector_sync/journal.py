@@ -0,0 +1,155 @@
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Set
+
+from confluence_vector_sync.confluence import PageHeader
+
+PLANNED = "planned"
+EMBEDDED = "embedded"
+UPLOADED = "uploaded"
+
+
+def item_version(item: PageHeader) -> str:
+    return item.last_modified.isoformat() if item.last_modified else ""
+
+
+class RunJournal:
+    """Progress of every page a run indexes or removes, kept in SQLite so that an interrupted run can be resumed.
+
+    A page is planned when the run decides to index or remove it, embedded once all its documents have their
+    vectors (and are handed to the writer) and uploaded once the writer has sent them. When the previous run did
+    not finish, the pages it uploaded are skipped. Pages that are planned or embedded, by an interrupted run or
+    because they failed, are indexed again and compared chunk by chunk with the index, whatever their dates say.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS items ("
+                                "item_id TEXT PRIMARY KEY, "
+                                "space TEXT NOT NULL, "
+                                "version TEXT NOT NULL, "
+                                "action TEXT NOT NULL, "
+                                "status TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS runs ("
+                                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                "started TEXT NOT NULL, "
+                                "finished TEXT)")
+        last_run = self.connection.execute("SELECT finished FROM runs ORDER BY id DESC LIMIT 1").fetchone()
+        self.resumed = last_run is not None and last_run[0] is None
+        # item id -> version that an interrupted run completed
+        self.done: Dict[str, str] = {}
+        if self.resumed:
+            self.done = dict(self.connection.execute("SELECT item_id, version FROM items WHERE status = ?",
+                                                     (UPLOADED,)))
+        self.unfinished: Set[str] = {row[0] for row in self.connection.execute(
+            "SELECT item_id FROM items WHERE status != ?", (UPLOADED,))}
+        self.run_id = self.connection.execute("INSERT INTO runs (started) VALUES (?)",
+                                              (datetime.now(timezone.utc).isoformat(),)).lastrowid
+        self.connection.commit()
+        # page id -> documents of the page that are not embedded yet
+        self.outstanding: Dict[str, int] = {}
+        # document id (page or attachment) -> page id, to find the pages of documents that could not be written
+        self.owners: Dict[str, str] = {}
+        # Pages that are embedded and wait for the writer to send their documents
+        self.waiting: Set[str] = set()
+        # Pages with documents that could not be written, they stay unfinished
+        self.failed: Set[str] = set()
+        self.stats = None
+        self.reset()
+
+    def reset(self):
+        self.stats = {"resumed": self.resumed,
+                      "skipped": 0,
+                      "redone": 0,
+                      "planned": 0,
+                      "uploaded": 0}
+
+    def is_done(self, item: PageHeader) -> bool:
+        """The item was completed by the interrupted run and has not changed since"""
+        if self.done.get(item.id) == item_version(item):
+            self.count("skipped")
+            return True
+        return False
+
+    def is_unfinished(self, item_id: str) -> bool:
+        """An earlier run started on the item but did not complete it"""
+        return item_id in self.unfinished
+
+    def plan(self, items: List[PageHeader], action: str):
+        if not items:
+            return
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO items (item_id, space, version, action, status) "
+                                        "VALUES (?, ?, ?, ?, ?)",
+                                        [(item.id, item.space, item_version(item), action, PLANNED)
+                                         for item in items])
+            self.connection.commit()
+            self.stats["planned"] += len(items)
+            self.stats["redone"] += sum(1 for item in items if item.id in self.unfinished)
+
+    def expect(self, page_id: str, docs: List[Dict]):
+        """The documents of the page that still need to be embedded and uploaded"""
+        with self.lock:
+            self.owners[page_id] = page_id
+            for doc in docs:
+                self.owners[doc["document_id"]] = page_id
+            if docs:
+                self.outstanding[page_id] = len(docs)
+        if not docs:
+            self.embedded([page_id])
+
+    def completed(self, docs: Iterable[Dict]):
+        """Documents that got their vectors and were handed to the writer"""
+        pages = []
+        with self.lock:
+            for doc in docs:
+                page_id = self.owners.get(doc["document_id"])
+                if page_id not in self.outstanding:
+                    continue
+                self.outstanding[page_id] -= 1
+                if self.outstanding[page_id] == 0:
+                    del self.outstanding[page_id]
+                    pages.append(page_id)
+        if pages:
+            self.embedded(pages)
+
+    def embedded(self, page_ids: List[str]):
+        """Everything of the pages is in the writer, call after the writer got their documents"""
+        with self.lock:
+            self.set_status(page_ids, EMBEDDED)
+            self.waiting.update(page_ids)
+
+    def flushed(self, failed_keys: Set[str]):
+        """The writer sent everything it had, the waiting pages are uploaded unless some of their documents failed"""
+        with self.lock:
+            self.failed.update(self.owners[key.rsplit("_", 1)[0]] for key in failed_keys
+                               if key.rsplit("_", 1)[0] in self.owners)
+            uploaded = [page_id for page_id in self.waiting if page_id not in self.failed]
+            self.waiting = set()
+            self.set_status(uploaded, UPLOADED)
+            self.stats["uploaded"] += len(uploaded)
+            self.owners = {document_id: page_id for document_id, page_id in self.owners.items()
+                           if page_id in self.outstanding}
+
+    def set_status(self, item_ids: List[str], status: str):
+        """Call with lock held"""
+        self.connection.executemany("UPDATE items SET status = ? WHERE item_id = ?",
+                                    [(status, item_id) for item_id in item_ids])
+        self.connection.commit()
+
+    def count(self, name: str):
+        with self.lock:
+            self.stats[name] += 1
+
+    def finish(self):
+        """The run completed, only the pages that are not uploaded (failed) are kept for the next run"""
+        with self.lock:
+            self.connection.execute("DELETE FROM items WHERE status = ?", (UPLOADED,))
+            self.connection.execute("UPDATE runs SET finished = ? WHERE id = ?",
+                                    (datetime.now(timezone.utc).isoformat(), self.run_id))
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,419 @@
+import json
+import logging
+import os
+import re
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from azure.core.exceptions import ResourceNotFoundError
+
+from confluence_vector_sync.azure_ai_search import AzureAISearchIndexer
+
+VECTOR_FIELDS = ("titleVector", "chunkVector")
+
+
+@dataclass(slots=True)
+class IndexingResult:
+    """Result of one document of a batch, like the IndexingResult of azure-search-documents"""
+    key: str
+    succeeded: bool = True
+    status_code: int = 200
+    error_message: Optional[str] = None
+
+
+class LocalVectorStore:
+    """A vector index in a directory, with the methods of the azure SearchClient that the indexer uses.
+
+    The documents without their vectors are kept in a JSON sidecar, the vectors of each vector field in a
+    matrix file (float32, or int8 with a scale per row) that is memory mapped when the store is opened. A matrix
+    only has rows for the documents with a vector in its field, a rows file maps them to the documents.
+    Changes are kept in memory and written when the store is saved. Queries are exact (flat), or with
+    index="ivf" go to the nprobe nearest of sqrt(n) k-means clusters built when the store is saved.
+    Scores are cosine similarities.
+    """
+
+    def __init__(self, path: str, quantization: str = "float32", index: str = "flat", nprobe: int = 8):
+        if quantization not in ("float32", "int8"):
+            raise ValueError(f"Unknown quantization {quantization}, use float32 or int8")
+        if index not in ("flat", "ivf"):
+            raise ValueError(f"Unknown index {index}, use flat or ivf")
+        self.path = path
+        self.quantization = quantization
+        self.index = index
+        self.nprobe = nprobe
+        self.lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self.load()
+
+    def load(self):
+        """(Re)opens the saved store, changes that were not saved are dropped"""
+        with self.lock:
+            # documents without vectors, row -> id of the matrices (None once replaced or deleted)
+            self.documents: Dict[str, Dict] = {}
+            self.ids: List[Optional[str]] = []
+            self.vectors: Dict[str, np.ndarray] = {}
+            # field -> document row (in ids) of each matrix row, and matrix row of each document row (-1 for none)
+            self.rows: Dict[str, np.ndarray] = {}
+            self.slots: Dict[str, np.ndarray] = {}
+            self.scales: Dict[str, np.ndarray] = {}
+            self.norms: Dict[str, np.ndarray] = {}
+            self.clusters: Dict[str, Dict[str, np.ndarray]] = {}
+            # id -> field -> vector, uploaded since the store was saved
+            self.pending: Dict[str, Dict[str, np.ndarray]] = {}
+            metadata_path = os.path.join(self.path, "metadata.json")
+            if os.path.exists(metadata_path):
+                with open(metadata_path) as f:
+                    metadata = json.load(f)
+                self.documents = metadata["documents"]
+                self.ids = metadata["ids"]
+                for field in VECTOR_FIELDS:
+                    file = self.file(field, "vectors")
+                    if os.path.exists(file):
+                        self.vectors[field] = np.load(file, mmap_mode="r")
+                        # Stores saved before the rows files have a row for every document
+                        self.rows[field] = np.load(self.file(field, "rows")) if os.path.exists(
+                            self.file(field, "rows")) else np.arange(len(self.vectors[field]))
+                        self.slots[field] = np.full(len(self.ids), -1)
+                        self.slots[field][self.rows[field]] = np.arange(len(self.rows[field]))
+                    if os.path.exists(self.file(field, "scales")):
+                        self.scales[field] = np.load(self.file(field, "scales"))
+                    if os.path.exists(self.file(field, "clusters", ".npz")):
+                        with np.load(self.file(field, "clusters", ".npz")) as clusters:
+                            self.clusters[field] = dict(clusters)
+            self.row_of = {doc_id: row for row, doc_id in enumerate(self.ids) if doc_id is not None}
+
+    def file(self, field: str, kind: str, suffix: str = ".npy") -> str:
+        return os.path.join(self.path, f"{field}.{kind}{suffix}")
+
+    def __len__(self):
+        return len(self.documents)
+
+    # SearchClient methods
+
+    def upload_documents(self, documents: List[Dict]) -> List[IndexingResult]:
+        with self.lock:
+            for doc in documents:
+                self.detach(doc["id"], keep_vectors=False)
+                self.put(dict(doc))
+        return [IndexingResult(doc["id"]) for doc in documents]
+
+    def merge_documents(self, documents: List[Dict]) -> List[IndexingResult]:
+        results = []
+        with self.lock:
+            for doc in documents:
+                if doc["id"] not in self.documents:
+                    results.append(IndexingResult(doc["id"], False, 404, "Document not found"))
+                    continue
+                if any(field in doc for field in VECTOR_FIELDS):
+                    self.detach(doc["id"], keep_vectors=True)
+                self.put(doc, self.documents[doc["id"]])
+                results.append(IndexingResult(doc["id"]))
+        return results
+
+    def delete_documents(self, documents: List[Dict]) -> List[IndexingResult]:
+        with self.lock:
+            for doc in documents:
+                self.detach(doc["id"], keep_vectors=False)
+                self.documents.pop(doc["id"], None)
+        return [IndexingResult(doc["id"]) for doc in documents]
+
+    def get_document(self, key: str, selected_fields: List[str] = None) -> Dict:
+        with self.lock:
+            if key not in self.documents:
+                raise ResourceNotFoundError(f"Document {key} not found")
+            return self.select(key, selected_fields)
+
+    def search(self, search_text: str = "*", filter: str = None, select: List[str] = None,
+               order_by: List[str] = None, top: int = None, **kwargs) -> List[Dict]:
+        """Documents that match the OData filter (and all words of search_text in title or chunk)"""
+        matches = parse_filter(filter) if filter else (lambda doc: True)
+        words = [] if not search_text or search_text == "*" else search_text.lower().split()
+        with self.lock:
+            results = [doc for doc in self.documents.values() if matches(doc) and
+                       all(word in f'{doc.get("title", "")} {doc.get("chunk", "")}'.lower() for word in words)]
+            if order_by:
+                field, _, direction = order_by[0].partition(" ")
+                results.sort(key=lambda doc: doc.get(field) or "", reverse=direction == "desc")
+            if top is not None:
+                results = results[:top]
+            return [self.select(doc["id"], select) for doc in results]
+
+    # Vector queries
+
+    def query(self, vector: List[float], top: int = 5, field: str = "chunkVector", filter: str = None,
+              select: List[str] = None) -> List[Dict]:
+        """The top documents by cosine similarity of their field to the vector, with the score in @search.score"""
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        matches = parse_filter(filter) if filter else None
+        with self.lock:
+            scores: Dict[str, float] = {}
+            if field in self.vectors and len(self.vectors[field]):
+                rows = self.candidate_rows(field, query)
+                row_scores = self.score_rows(field, rows, query)
+                for row, score in zip(self.rows[field][rows].tolist(), row_scores.tolist()):
+                    doc_id = self.ids[row]
+                    # Empty vectors (no title) are kept in the document and not searched
+                    if doc_id is not None and field not in self.documents[doc_id]:
+                        scores[doc_id] = score
+            for doc_id, vectors in self.pending.items():
+                if field in vectors:
+                    norm = np.linalg.norm(vectors[field])
+                    scores[doc_id] = float(vectors[field] @ query / norm) if norm else 0.0
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+            results = []
+            for doc_id, score in ranked:
+                if matches is None or matches(self.documents[doc_id]):
+                    results.append({**self.select(doc_id, select), "@search.score": score})
+                    if len(results) == top:
+                        break
+            return results
+
+    def candidate_rows(self, field: str, query: np.ndarray) -> np.ndarray:
+        """Rows of the matrix of the field to score"""
+        if field not in self.clusters:
+            return np.arange(len(self.vectors[field]))
+        clusters = self.clusters[field]
+        probes = np.argsort(clusters["centroids"] @ query)[::-1][:self.nprobe]
+        return np.flatnonzero(np.isin(clusters["assignments"], probes))
+
+    def score_rows(self, field: str, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        vectors = self.vectors[field]
+        if field not in self.norms:
+            self.norms[field] = np.linalg.norm(self.dequantize(field, slice(None)), axis=1)
+        norms = self.norms[field][rows]
+        dots = np.asarray(vectors[rows], dtype=np.float32) @ query
+        if field in self.scales:
+            dots = dots * self.scales[field][rows]
+        return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+
+    # Storage
+
+    def save(self):
+        """Writes the documents and the vectors of the documents that are left, replacing the previous files"""
+        with self.lock:
+            ids = list(self.documents)
+            matrices = {}
+            rows = {}
+            for field in VECTOR_FIELDS:
+                dimensions = self.dimensions(field)
+                vectors = [] if dimensions is None else [(i, self.vector(doc_id, field))
+                                                         for i, doc_id in enumerate(ids)]
+                vectors = [(i, vector) for i, vector in vectors if vector is not None and len(vector) == dimensions]
+                if not vectors:
+                    for kind, suffix in (("vectors", ".npy"), ("rows", ".npy"), ("scales", ".npy"),
+                                         ("clusters", ".npz")):
+                        self.remove(self.file(field, kind, suffix))
+                    continue
+                rows[field] = np.array([i for i, _ in vectors], dtype=np.int64)
+                matrices[field] = np.stack([vector for _, vector in vectors]).astype(np.float32)
+            for field, matrix in matrices.items():
+                self.write(self.file(field, "rows"), lambda f: np.save(f, rows[field]))
+                if self.quantization == "int8":
+                    scales = np.abs(matrix).max(axis=1) / 127
+                    quantized = np.round(matrix / np.where(scales > 0, scales, 1)[:, None]).astype(np.int8)
+                    self.write(self.file(field, "vectors"), lambda f: np.save(f, quantized))
+                    self.write(self.file(field, "scales"), lambda f: np.save(f, scales.astype(np.float32)))
+                else:
+                    self.write(self.file(field, "vectors"), lambda f: np.save(f, matrix))
+                    self.remove(self.file(field, "scales"))
+                if self.index == "ivf" and len(matrix) >= 2 * self.nprobe:
+                    centroids, assignments = kmeans(matrix, clusters=max(int(np.sqrt(len(matrix))), self.nprobe))
+                    self.write(self.file(field, "clusters", ".npz"),
+                               lambda f: np.savez(f, centroids=centroids, assignments=assignments))
+                else:
+                    self.remove(self.file(field, "clusters", ".npz"))
+            # Vectors live in the matrices, empty vectors (no title) stay in the documents
+            self.write(os.path.join(self.path, "metadata.json"),
+                       lambda f: f.write(json.dumps({"documents": self.documents, "ids": ids}).encode()))
+            self.load()
+        logging.info(f"Saved {len(ids)} documents to the local index {self.path}")
+
+    def write(self, path: str, write: Callable):
+        """Writes to a temporary file that replaces path, readers never see a partial file"""
+        with open(path + ".tmp", "wb") as f:
+            write(f)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def remove(path: str):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def clear(self):
+        with self.lock:
+            for name in os.listdir(self.path):
+                os.remove(os.path.join(self.path, name))
+            self.load()
+
+    # Documents and their vectors
+
+    def put(self, doc: Dict, existing: Dict = None):
+        """Stores the document, its non-empty vectors as pending (call with lock held)"""
+        document = existing if existing is not None else {}
+        for key, value in doc.items():
+            if key in VECTOR_FIELDS and value is not None and len(value):
+                self.pending.setdefault(doc["id"], {})[key] = np.asarray(value, dtype=np.float32)
+                document.pop(key, None)
+            else:
+                document[key] = value
+        self.documents[doc["id"]] = document
+
+    def detach(self, doc_id: str, keep_vectors: bool):
+        """Releases the row of a document, keeping its vectors as pending if asked (call with lock held)"""
+        row = self.row_of.pop(doc_id, None)
+        if row is None:
+            if not keep_vectors:
+                self.pending.pop(doc_id, None)
+            return
+        if keep_vectors:
+            for field in self.vectors:
+                if self.has_vector(doc_id, field, row):
+                    self.pending.setdefault(doc_id, {})[field] = self.dequantize(field, self.slots[field][row])
+        self.ids[row] = None
+
+    def has_vector(self, doc_id: str, field: str, row: Optional[int] = None) -> bool:
+        if field in self.pending.get(doc_id, {}):
+            return True
+        row = self.row_of.get(doc_id) if row is None else row
+        return row is not None and field in self.vectors and self.slots[field][row] >= 0 and \
+            field not in self.documents.get(doc_id, {})
+
+    def vector(self, doc_id: str, field: str) -> Optional[np.ndarray]:
+        if field in self.pending.get(doc_id, {}):
+            return self.pending[doc_id][field]
+        if self.has_vector(doc_id, field):
+            return self.dequantize(field, self.slots[field][self.row_of[doc_id]])
+        return None
+
+    def dequantize(self, field: str, rows) -> np.ndarray:
+        vectors = np.asarray(self.vectors[field][rows], dtype=np.float32)
+        if field in self.scales:
+            scales = self.scales[field][rows]
+            vectors = vectors * (scales[:, None] if vectors.ndim == 2 else scales)
+        return vectors
+
+    def dimensions(self, field: str) -> Optional[int]:
+        if field in self.vectors:
+            return self.vectors[field].shape[1]
+        for vectors in self.pending.values():
+            if field in vectors:
+                return len(vectors[field])
+        return None
+
+    def select(self, doc_id: str, fields: Optional[List[str]]) -> Dict:
+        doc = self.documents[doc_id]
+        result = {}
+        for field in fields or [*doc, *(field for field in VECTOR_FIELDS if field not in doc)]:
+            if field in VECTOR_FIELDS and field not in doc:
+                vector = self.vector(doc_id, field)
+                result[field] = vector.tolist() if vector is not None else None
+            else:
+                result[field] = doc.get(field)
+        return result
+
+
+def kmeans(vectors: np.ndarray, clusters: int, iterations: int = 10, seed: int = 0):
+    """Spherical k-means, returns the (unit) centroids and the cluster of every vector"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit = vectors / np.where(norms > 0, norms, 1)
+    rng = np.random.default_rng(seed)
+    centroids = unit[rng.choice(len(unit), size=clusters, replace=False)]
+    assignments = np.zeros(len(unit), dtype=np.int32)
+    for _ in range(iterations):
+        assignments = np.argmax(unit @ centroids.T, axis=1).astype(np.int32)
+        for cluster in range(clusters):
+            members = unit[assignments == cluster]
+            if len(members):
+                centroid = members.sum(axis=0)
+                centroids[cluster] = centroid / (np.linalg.norm(centroid) or 1.0)
+    return centroids.astype(np.float32), assignments
+
+
+def parse_filter(expression: str) -> Callable[[Dict], bool]:
+    """A predicate for the OData filters the indexer uses: eq, ne, gt, lt, search.in, and, or, not and parentheses"""
+    tokens = re.findall(r"\(|\)|'(?:[^']|'')*'|[\w.]+", expression)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def parse_or():
+        left = parse_and()
+        while peek() == "or":
+            take()
+            left = (lambda a, b: lambda doc: a(doc) or b(doc))(left, parse_and())
+        return left
+
+    def parse_and():
+        left = parse_term()
+        while peek() == "and":
+            take()
+            left = (lambda a, b: lambda doc: a(doc) and b(doc))(left, parse_term())
+        return left
+
+    def parse_term():
+        token = take()
+        if token == "search.in":
+            # search.in(field, 'value,value', ',')
+            take()
+            field, values = take(), take()[1:-1].replace("''", "'")
+            delimiters = take()[1:-1] if peek() != ")" else " ,"
+            take()
+            members = set(re.split("|".join(map(re.escape, delimiters)), values))
+            return lambda doc: doc.get(field) in members
+        if token == "not":
+            term = parse_term()
+            return lambda doc: not term(doc)
+        if token == "(":
+            term = parse_or()
+            take()
+            return term
+        operator, value = take(), take()
+        value = value[1:-1].replace("''", "'") if value.startswith("'") else None if value == "null" else value
+        compare = {"eq": lambda a: a == value,
+                   "ne": lambda a: a != value,
+                   "gt": lambda a: a is not None and a > value,
+                   "lt": lambda a: a is not None and a < value}[operator]
+        return lambda doc: compare(doc.get(token))
+
+    return parse_or()
+
+
+class LocalSearchIndexer(AzureAISearchIndexer):
+    """The indexer with a LocalVectorStore in a directory instead of an Azure AI Search index.
+
+    Nothing is sent to Azure AI Search, the store is saved when the sync closes the indexer.
+    """
+
+    def __init__(self, config):
+        # The local store is not throttled
+        super().__init__(dict(config, azure_search_max_rps=1e6, azure_search_max_concurrency=64))
+
+    def create_client(self, config) -> LocalVectorStore:
+        return LocalVectorStore(config["local_index_path"],
+                                quantization=config["local_index_quantization"],
+                                index=config["local_index_type"],
+                                nprobe=config["local_index_nprobe"])
+
+    def create_or_update_index(self):
+        """The store has no schema, the vector dimensions follow the first vectors"""
+
+    def drop_index(self):
+        self.client.clear()
+
+    def close(self):
+        super().close()
+        self.client.save()
+
+    def query(self, text: str, top: int = 5, filter: str = None) -> List[Dict]:
+        """The chunks most similar to the text"""
+        return self.client.query(self.embedder.embed_query(text), top=top, filter=filter,
+                                 select=["id", "document_id", "title", "chunk", "url"])
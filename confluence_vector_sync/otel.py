@@ -1,28 +1,62 @@
 import logging
 import os
+import time
+from contextlib import contextmanager
 
 from azure.core.settings import settings
-from azure.monitor.opentelemetry.exporter import AzureMonitorLogExporter
 from opentelemetry.sdk._logs import (
     LoggerProvider,
     LoggingHandler
 )
 from opentelemetry._logs import set_logger_provider
 from opentelemetry.sdk._logs._internal.export import BatchLogRecordProcessor
-from opentelemetry import trace
+from opentelemetry import metrics, trace
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import ConsoleMetricExporter, PeriodicExportingMetricReader
 from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+# The api hands out proxies until setup() sets the providers, so instruments can be created at import time
+tracer = trace.get_tracer("confluence_vector_sync")
+meter = metrics.get_meter("confluence_vector_sync")
+stage_duration = meter.create_histogram("sync.stage.duration", unit="s",
+                                        description="Duration of a step of the sync, by stage")
+payload_size = meter.create_histogram("sync.payload.size", unit="By",
+                                      description="Size of page bodies, attachments and upload batches, by kind")
+tokens_embedded = meter.create_counter("sync.embedding.tokens", unit="{token}",
+                                       description="Tokens sent to the embedding model")
+bytes_downloaded = meter.create_counter("sync.confluence.downloaded", unit="By",
+                                        description="Bytes of page bodies and attachments fetched from confluence")
+
+_tracer_provider = None
+_meter_provider = None
 
 
 def setup():
+    """Sets up the exporters, once per process.
+
+    Application Insights when APPLICATIONINSIGHTS_CONNECTION_STRING is set, and console or OTLP (configured with the
+    standard OTEL_EXPORTER_OTLP_* variables) when TELEMETRY_EXPORTER says so.
+    """
+    global _tracer_provider, _meter_provider
     settings.tracing_implementation = "opentelemetry"
+    if _tracer_provider is not None:
+        return
+    span_exporters = []
+    metric_exporters = []
     if os.environ.get("APPLICATIONINSIGHTS_CONNECTION_STRING") is not None:
-        trace.set_tracer_provider(TracerProvider())
-        tracer = trace.get_tracer(__name__)
+        # The exporters take a noticeable part of the start up, they are imported when they are used
+        from azure.monitor.opentelemetry.exporter import (
+            AzureMonitorLogExporter,
+            AzureMonitorMetricExporter,
+            AzureMonitorTraceExporter
+        )
+        connection_string = os.environ["APPLICATIONINSIGHTS_CONNECTION_STRING"]
         logger_provider = LoggerProvider()
         set_logger_provider(logger_provider)
 
         exporter = AzureMonitorLogExporter(
-            connection_string=os.environ["APPLICATIONINSIGHTS_CONNECTION_STRING"]
+            connection_string=connection_string
         )
 
         logger_provider.add_log_record_processor(BatchLogRecordProcessor(exporter))
@@ -30,5 +64,52 @@ def setup():
 
         # Attach LoggingHandler to root logger
         logging.getLogger().addHandler(handler)
+        span_exporters.append(AzureMonitorTraceExporter(connection_string=connection_string))
+        metric_exporters.append(AzureMonitorMetricExporter(connection_string=connection_string))
     else:
         logging.warning("No application insights connection string found.")
+
+    exporter_type = os.getenv("TELEMETRY_EXPORTER", "none").lower()
+    if exporter_type == "console":
+        span_exporters.append(ConsoleSpanExporter())
+        metric_exporters.append(ConsoleMetricExporter())
+    elif exporter_type == "otlp":
+        try:
+            from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError:
+            logging.error("TELEMETRY_EXPORTER=otlp needs the opentelemetry-exporter-otlp-proto-http package")
+        else:
+            span_exporters.append(OTLPSpanExporter())
+            metric_exporters.append(OTLPMetricExporter())
+    if not span_exporters:
+        return
+
+    _tracer_provider = TracerProvider()
+    for exporter in span_exporters:
+        _tracer_provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(_tracer_provider)
+    interval = int(os.getenv("TELEMETRY_EXPORT_INTERVAL", "60")) * 1000
+    _meter_provider = MeterProvider(metric_readers=[PeriodicExportingMetricReader(exporter,
+                                                                                  export_interval_millis=interval)
+                                                    for exporter in metric_exporters])
+    metrics.set_meter_provider(_meter_provider)
+
+
+def flush():
+    """Export what is still buffered, call at the end of a run"""
+    if _tracer_provider:
+        _tracer_provider.force_flush()
+    if _meter_provider:
+        _meter_provider.force_flush()
+
+
+@contextmanager
+def stage(name: str, **attributes):
+    """A span around a step of the sync, its duration is also recorded in the stage histogram"""
+    start = time.perf_counter()
+    with tracer.start_as_current_span(name, attributes=attributes) as span:
+        try:
+            yield span
+        finally:
+            stage_duration.record(time.perf_counter() - start, {"stage": name})
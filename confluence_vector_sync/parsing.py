@@ -0,0 +1,226 @@
+import re
+from functools import lru_cache
+from html.parser import HTMLParser
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import tiktoken
+
+# Tags that end a block of text, blocks are the units that chunks are built from
+BLOCK_TAGS = {"p", "div", "li", "tr", "pre", "blockquote", "table", "ul", "ol", "dt", "dd", "hr", "section",
+              "ac:plain-text-body", "ac:rich-text-body", "ac:task-body", "ac:layout-cell"}
+HEADING_TAGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+CELL_TAGS = {"td", "th"}
+# Macro parameters (code language, panel colour, ...) are not text of the page
+SKIPPED_TAGS = {"ac:parameter", "script", "style"}
+PREFORMATTED_TAGS = {"pre", "ac:plain-text-body"}
+FRAGMENT_SIZE = 64 * 1024
+WHITESPACE = re.compile(r"\s+")
+
+
+# Kept apart from confluence.py so that parser processes do not need to import the confluence client
+def split_storage_format(content: str, chunk_size: int, chunk_overlap: int,
+                         tokenizer: Optional[str] = None) -> List[Dict]:
+    """Extracts the text of a page in confluence storage format and splits it into chunks.
+
+    The chunk size and overlap are in characters, or in tokens of the tokenizer (an embedding model) when it is
+    given. Chunks measured in tokens carry their token count.
+    """
+    if tokenizer is None:
+        chunker = StorageFormatChunker(chunk_size, chunk_overlap)
+        return [{"text": text, "chunk": i} for i, text in enumerate(chunker.chunks(fragments(content)))]
+    length = token_counter(tokenizer)
+    chunker = StorageFormatChunker(chunk_size, chunk_overlap, length=length)
+    return [{"text": text, "chunk": i, "tokens": length(text)}
+            for i, text in enumerate(chunker.chunks(fragments(content)))]
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """Tokenizer for the embedding model, deployment names fall back to the ada-002 encoding."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=None)
+def token_counter(model: str) -> Callable[[str], int]:
+    """Counts tokens with the encoding of the model, loaded once per process"""
+    encode = get_encoding(model).encode
+    return lambda text: len(encode(text, disallowed_special=()))
+
+
+def fragments(content: str, size: int = FRAGMENT_SIZE) -> Iterator[str]:
+    for start in range(0, len(content), size):
+        yield content[start:start + size]
+
+
+class StorageFormatChunker(HTMLParser):
+    """Turns confluence storage format into chunks in a single pass.
+
+    The page is tokenized as it is fed and cut at paragraph, list item and table row boundaries. A heading
+    starts a new chunk, and every chunk starts with the headings it is under. Only the blocks of the chunk
+    being built are kept, so the memory does not grow with the page. Sizes are measured with length, in
+    characters by default.
+    """
+
+    def __init__(self, chunk_size: int, chunk_overlap: int, length: Callable[[str], int] = len):
+        super().__init__(convert_charrefs=True)
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.length = length
+        # (level, text) of the headings above the current position
+        self.headings: List[Tuple[int, str]] = []
+        self.heading_level = 0
+        self.text: List[str] = []
+        self.cell = False
+        self.skipped = 0
+        self.preformatted = 0
+        # (text, length) of the blocks of the chunk being built
+        self.blocks: List[Tuple[str, int]] = []
+        self.size = 0
+        # New blocks since the last chunk, the others are the overlap with it
+        self.fresh = 0
+        self.done: List[str] = []
+
+    def chunks(self, fragments: Iterable[str]) -> Iterator[str]:
+        for fragment in fragments:
+            self.feed(fragment)
+            yield from self.drain()
+        self.close()
+        self.end_block()
+        self.emit(overlap=False)
+        yield from self.drain()
+
+    def drain(self) -> List[str]:
+        done, self.done = self.done, []
+        return done
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skipped += 1
+        elif tag in HEADING_TAGS:
+            self.end_block()
+            self.emit(overlap=False)
+            self.heading_level = HEADING_TAGS[tag]
+        elif tag in CELL_TAGS:
+            if self.cell:
+                self.text.append(" | ")
+            self.cell = True
+        elif tag == "br":
+            self.text.append("\n")
+        elif tag in BLOCK_TAGS:
+            self.end_block()
+        if tag in PREFORMATTED_TAGS:
+            self.preformatted += 1
+
+    def handle_startendtag(self, tag, attrs):
+        if tag == "br":
+            self.text.append("\n")
+        elif tag in BLOCK_TAGS:
+            self.end_block()
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skipped = max(self.skipped - 1, 0)
+        elif tag in HEADING_TAGS and self.heading_level:
+            heading = WHITESPACE.sub(" ", "".join(self.text)).strip()
+            self.text = []
+            if heading:
+                self.headings = [h for h in self.headings if h[0] < self.heading_level] + \
+                                [(self.heading_level, heading)]
+            self.heading_level = 0
+        elif tag in BLOCK_TAGS:
+            self.end_block()
+        if tag in PREFORMATTED_TAGS:
+            self.end_block()
+            self.preformatted = max(self.preformatted - 1, 0)
+
+    def handle_data(self, data):
+        if not self.skipped:
+            self.text.append(data)
+
+    def unknown_decl(self, data):
+        # Code macros keep their content in CDATA sections
+        if data.startswith("CDATA[") and not self.skipped:
+            self.text.append(data[len("CDATA["):])
+
+    def end_block(self):
+        text = "".join(self.text)
+        self.text = []
+        self.cell = False
+        if self.heading_level:
+            # Text outside of tags in a heading still belongs to it
+            self.text = [text]
+            return
+        if self.preformatted:
+            text = text.strip("\n")
+        else:
+            text = WHITESPACE.sub(" ", text).strip()
+        if text:
+            budget = self.budget()
+            length = self.length(text)
+            if length <= budget:
+                self.add_block(text, length)
+                return
+            # Split where the characters of the block would reach the budget, tokens vary in length
+            for part in split_long(text, max(len(text) * budget // length, 1)):
+                self.add_block(part, self.length(part))
+
+    def prefix(self) -> str:
+        if not self.headings:
+            return ""
+        return " > ".join(text for _, text in self.headings)[:self.chunk_size // 4] + "\n"
+
+    def budget(self) -> int:
+        return max(self.chunk_size - self.length(self.prefix()), self.chunk_size // 2)
+
+    def add_block(self, text: str, length: int):
+        budget = self.budget()
+        # Blocks are joined with newlines, counted as one character or token each
+        while self.blocks and self.size + length > budget:
+            if self.fresh:
+                self.emit(overlap=True)
+            else:
+                # The overlap does not fit next to the new block
+                self.size -= self.blocks.pop(0)[1] + 1
+        self.blocks.append((text, length))
+        self.size += length + 1
+        self.fresh += 1
+
+    def emit(self, overlap: bool):
+        """Completes the chunk, with overlap its last blocks up to chunk_overlap start the next chunk"""
+        if self.fresh:
+            self.done.append(self.prefix() + "\n".join(text for text, _ in self.blocks))
+        kept = []
+        if overlap:
+            size = 0
+            for text, length in reversed(self.blocks):
+                size += length + 1
+                if size > self.chunk_overlap:
+                    if not kept:
+                        # The last block alone is larger than the overlap, its end overlaps instead
+                        tail = text[len(text) - len(text) * self.chunk_overlap // length:]
+                        tail = tail[tail.find(" ") + 1:] if " " in tail else ""
+                        kept = [(tail, self.length(tail))] if tail else []
+                    break
+                kept.insert(0, (text, length))
+        self.blocks = kept
+        self.size = sum(length + 1 for _, length in kept)
+        self.fresh = 0
+
+
+def split_long(text: str, size: int) -> Iterator[str]:
+    """Splits a block that does not fit a chunk, at a sentence end or else a space"""
+    while len(text) > size:
+        cut = text.rfind(". ", size // 2, size)
+        if cut > 0:
+            cut += 1
+        else:
+            cut = text.rfind(" ", size // 2, size)
+        if cut <= 0:
+            cut = size
+        yield text[:cut].rstrip()
+        text = text[cut:].lstrip()
+    if text:
+        yield text
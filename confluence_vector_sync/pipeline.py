@@ -0,0 +1,91 @@
+import contextvars
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Iterable, List, Optional
+
+# Marks the end of the input of a stage
+_DONE = object()
+
+
+class Stage:
+    """A step of the pipeline, run by its own pool of worker threads.
+
+    fn takes one item and returns the item for the next stage, or None to drop it.
+    Items that fail are dropped and reported to the on_error(stage name, item, exception) of the pipeline.
+    """
+
+    def __init__(self, name: str, fn: Callable, workers: int = 1):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.stats = {"workers": self.workers, "items": 0, "errors": 0, "seconds": 0.0}
+
+
+class Pipeline:
+    """Runs items through stages that are connected with bounded queues.
+
+    A full queue blocks the stage in front of it, so a slow stage slows down the producers instead of
+    the items piling up in memory. Each stage has its own concurrency, so the total time is bounded
+    by the slowest stage instead of the sum of all of them.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = 32, on_error: Callable = None):
+        self.stages = stages
+        self.on_error = on_error
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.lock = threading.Lock()
+        self.running = {}
+
+    @property
+    def stats(self):
+        return {stage.name: stage.stats for stage in self.stages}
+
+    def run(self, items: Iterable):
+        threads = []
+        for i, stage in enumerate(self.stages):
+            self.running[i] = stage.workers
+            for n in range(stage.workers):
+                # Workers run in a copy of the caller's context, their tracing spans belong to the caller's span
+                thread = threading.Thread(target=contextvars.copy_context().run, args=(self.work, i),
+                                          name=f"{stage.name}-{n}", daemon=True)
+                thread.start()
+                threads.append(thread)
+        for item in items:
+            self.queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            self.queues[0].put(_DONE)
+        for thread in threads:
+            thread.join()
+
+    def work(self, i: int):
+        stage = self.stages[i]
+        output: Optional[queue.Queue] = self.queues[i + 1] if i + 1 < len(self.stages) else None
+        while True:
+            item = self.queues[i].get()
+            if item is _DONE:
+                break
+            start = time.perf_counter()
+            try:
+                result = stage.fn(item)
+            except Exception as e:
+                result = None
+                with self.lock:
+                    stage.stats["errors"] += 1
+                if self.on_error:
+                    self.on_error(stage.name, item, e)
+                else:
+                    logging.warning(f"Pipeline stage {stage.name} failed: {e}")
+            with self.lock:
+                stage.stats["items"] += 1
+                stage.stats["seconds"] += time.perf_counter() - start
+            if result is not None and output is not None:
+                output.put(result)
+        with self.lock:
+            self.running[i] -= 1
+            last = self.running[i] == 0
+        # The last worker of a stage tells the next stage that there is no more input
+        if last and output is not None:
+            for _ in range(self.stages[i + 1].workers):
+                output.put(_DONE)
@@ -0,0 +1,264 @@
+import json
+import math
+import os
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from confluence_vector_sync.attachment_loader import AttachmentLoader, attachment_size
+from confluence_vector_sync.azure_ai_search_writer import DONE_STATS, SearchDocumentWriter
+from confluence_vector_sync.confluence import TOKEN_CHUNK_SIZE
+from confluence_vector_sync.handlers import LazyMediaHandler
+
+# Seconds per request of the work a plan does not do, until a run with RUN_PROFILE_PATH has measured them
+DEFAULT_LATENCIES = {"embedding": 0.5, "upload": 1.0, "attachment": 10.0}
+# Weight of the earlier runs in the profile, each run counts less than the one after it
+PROFILE_DECAY = 0.8
+# A value of an embedding as the model returns it, placeholder vectors serialize to the size of real ones
+PLACEHOLDER_VALUE = -0.015160853415727615
+# Chunks per byte of an attachment until a run has measured them
+DEFAULT_CHUNKS_PER_BYTE = 1 / (20 * 1024)
+# Document Intelligence bills by page, the pages of a document are estimated from its size
+BYTES_PER_DOCUMENT_PAGE = 100 * 1024
+DOCUMENT_INTELLIGENCE_HANDLER = "AzureDocumentIntelligenceMediaHandler"
+
+
+class RunProfile:
+    """Latencies and sizes measured by earlier runs, kept in a small JSON file between runs.
+
+    Each kind of request keeps decayed totals of its count, seconds and so on, so recent runs weigh the most.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.services: Dict[str, Dict[str, float]] = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.services = json.load(f).get("services", {})
+
+    def ratio(self, service: str, numerator: str, denominator: str) -> Optional[float]:
+        totals = self.services.get(service) or {}
+        return totals[numerator] / totals[denominator] if totals.get(denominator) else None
+
+    def latency(self, service: str) -> Tuple[float, bool]:
+        """Seconds per request of the service and whether they were measured"""
+        latency = self.ratio(service, "seconds", "requests")
+        return (DEFAULT_LATENCIES[service], False) if latency is None else (latency, True)
+
+    def record(self, diagnostics: Dict):
+        embedding = diagnostics.get("embedding") or {}
+        upload = diagnostics.get("upload") or {}
+        attachments = diagnostics.get("attachments") or {}
+        measured = {"embedding": {"requests": embedding.get("batches", 0),
+                                  "seconds": embedding.get("seconds", 0.0)},
+                    "upload": {"requests": sum(upload.get(f"{action}_batches", 0) for action in DONE_STATS),
+                               "seconds": upload.get("seconds", 0.0)},
+                    "attachment": {"requests": attachments.get("extracted", 0),
+                                   "seconds": attachments.get("extract_seconds", 0.0),
+                                   "bytes": attachments.get("extract_bytes", 0),
+                                   "chunks": attachments.get("extract_chunks", 0)}}
+        for service, values in measured.items():
+            if not values["requests"]:
+                continue
+            totals = self.services.setdefault(service, {})
+            for name, value in values.items():
+                totals[name] = totals.get(name, 0.0) * PROFILE_DECAY + value
+
+    def save(self):
+        # Write and rename, a crash does not leave a half written file behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"services": self.services}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class PlanEmbedder:
+    """Returns placeholder vectors of the configured dimensions instead of calling the embedding model"""
+
+    def __init__(self, dimensions: int):
+        self.vector = [PLACEHOLDER_VALUE] * dimensions
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.vector] * len(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.vector
+
+
+class ReadOnlyEmbeddingCache:
+    """Looks vectors up in the embedding cache without marking them as used, a plan stores no placeholder vectors"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.stats = cache.stats
+
+    def get_many(self, texts: Iterable[str]) -> Dict[str, List[float]]:
+        return self.cache.get_many(texts, touch=False)
+
+    def put_many(self, vectors: Dict[str, List[float]]):
+        pass
+
+
+class PlanWriter(SearchDocumentWriter):
+    """Batches the uploads, merges and deletes like the writer of a run and counts the batches instead of sending
+    them"""
+
+    def __init__(self, writer: SearchDocumentWriter):
+        super().__init__(None, max_documents=writer.max_documents, max_bytes=writer.max_bytes)
+
+    def send(self, action: str, docs: List[Dict]):
+        self.stats[f"{action}_batches"] += 1
+        self.stats[DONE_STATS[action]] += len(docs)
+
+
+class PlanExtractor:
+    """Counts the attachments that would be downloaded and extracted, instead of the AttachmentExtractor.
+
+    Attachments in the extraction cache are taken from it, their chunks are planned like those of the pages.
+    """
+
+    def __init__(self, loader: AttachmentLoader):
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.stats = {"extract": 0,
+                      "cached": 0,
+                      "bytes": 0,
+                      "document_intelligence": 0,
+                      "document_intelligence_pages": 0}
+
+    def extract(self, attachments: Iterable[Dict]) -> Iterator[Tuple[Dict, List]]:
+        for attachment in attachments:
+            cached = self.loader.cached(attachment)
+            with self.lock:
+                if cached is not None:
+                    self.stats["cached"] += 1
+                else:
+                    self.stats["extract"] += 1
+                    self.stats["bytes"] += attachment_size(attachment) or 0
+                    if self.handler_name(attachment["metadata"]["mediaType"]) == DOCUMENT_INTELLIGENCE_HANDLER:
+                        self.stats["document_intelligence"] += 1
+                        self.stats["document_intelligence_pages"] += document_pages(attachment)
+            yield attachment, cached or []
+
+    def handler_name(self, media_type: str) -> str:
+        handler = self.loader.handlers[media_type]
+        return handler.name if isinstance(handler, LazyMediaHandler) else type(handler).__name__
+
+    def close(self):
+        pass
+
+
+def document_pages(attachment: Dict) -> int:
+    """Pages of an attachment for Document Intelligence, estimated from its size. An image is one page"""
+    if attachment["metadata"]["mediaType"].startswith("image/"):
+        return 1
+    return max(1, math.ceil((attachment_size(attachment) or 0) / BYTES_PER_DOCUMENT_PAGE))
+
+
+class SyncPlanner:
+    """Turns the search indexer of a run into a dry run and estimates what the run would take.
+
+    The indexer works out the changeset itself: the pages are listed, compared with the index, fetched, parsed
+    and diffed chunk by chunk like in a sync. Only the embedding model, the writes to the index and the download
+    and extraction of attachments are replaced by stand-ins that count what they would have done. The time of
+    that work is projected from the latencies in the profile at the configured concurrency, the time of
+    everything else is measured by the plan.
+    """
+
+    def __init__(self, config: Dict, search, profile: RunProfile):
+        self.config = config
+        self.search = search
+        self.profile = profile
+        batcher = search.embedding_batcher
+        batcher.embedder = PlanEmbedder(search.vector_dimensions)
+        # Placeholder vectors are not worth pacing
+        batcher.rate_limiter = None
+        if batcher.cache:
+            batcher.cache = ReadOnlyEmbeddingCache(batcher.cache)
+        search.writer = PlanWriter(search.writer)
+        search.journal = None
+        self.extractor = None
+        if config["index_attachments"]:
+            self.extractor = search.attachment_extractor = PlanExtractor(search.attachment_loader)
+        self.started = time.perf_counter()
+
+    def finish(self, confluence) -> Dict:
+        """Embed and write what is still buffered and return the plan"""
+        search = self.search
+        search.upload_stage(search.embedding_batcher.flush())
+        search.writer.flush()
+        if search.parse_pool:
+            search.parse_pool.shutdown()
+            search.parse_pool = None
+        read_seconds = time.perf_counter() - self.started
+        embedding = search.embedding_batcher.stats
+        upload = search.writer.stats
+        cache = search.embedding_cache.stats if search.embedding_cache else {}
+        dedup = search.dedup.stats if search.dedup else {}
+        plan = {"changeset": dict(search.diagnostics["counts"]),
+                "attachments": dict(self.extractor.stats) if self.extractor else {},
+                "embedding": {"calls": embedding["batches"],
+                              "texts": embedding["texts"],
+                              "tokens": embedding["tokens"],
+                              "cached": cache.get("hits", 0),
+                              "deduplicated": dedup.get("embeddings_saved", 0)},
+                "upload": {"batches": sum(upload[f"{action}_batches"] for action in DONE_STATS),
+                           "documents": upload["uploaded"],
+                           "bytes": upload["bytes"],
+                           "merged": upload["merged"],
+                           "deleted": upload["deleted"]}}
+        if self.extractor:
+            self.estimate_attachments(plan)
+        extract = plan["attachments"].get("extract", 0)
+        calls = plan["embedding"]["calls"]
+        batches = plan["upload"]["batches"]
+        plan["requests"] = {"confluence": confluence.rate_limiter.stats["requests"] + extract,
+                            "embedding": calls,
+                            "azure_search": search.search_limiter.stats["requests"] + batches,
+                            "document_intelligence": plan["attachments"].get("document_intelligence", 0)}
+        latencies = {service: self.profile.latency(service) for service in DEFAULT_LATENCIES}
+        config = self.config
+        embed_concurrency = max(1, min(search.embed_workers, config["embedding_max_concurrency"]))
+        seconds = {"read": read_seconds,
+                   "embedding": max(calls * latencies["embedding"][0] / embed_concurrency,
+                                    calls / config["embedding_max_rps"]),
+                   # The writer sends one batch at a time
+                   "upload": max(batches * latencies["upload"][0], batches / config["azure_search_max_rps"]),
+                   "attachments": extract * latencies["attachment"][0] / max(1, search.attachment_workers)}
+        # The stages of the pipeline overlap, the slowest one bounds the run
+        seconds["total"] = max(seconds.values())
+        plan["latencies"] = {service: {"seconds": round(latency, 3), "measured": measured}
+                             for service, (latency, measured) in latencies.items()}
+        plan["seconds"] = {name: round(value, 1) for name, value in seconds.items()}
+        return plan
+
+    def estimate_attachments(self, plan: Dict):
+        """Adds the chunks of the attachments that the plan did not extract to its embedding and upload.
+
+        How many chunks an attachment has comes from the chunks per byte of the attachments that earlier runs
+        extracted, their tokens and size from the chunks that the plan has.
+        """
+        attachments, embedding, upload = plan["attachments"], plan["embedding"], plan["upload"]
+        chunks_per_byte = self.profile.ratio("attachment", "chunks", "bytes")
+        if chunks_per_byte is None:
+            chunks_per_byte = DEFAULT_CHUNKS_PER_BYTE
+        chunks = round(attachments["bytes"] * chunks_per_byte)
+        attachments["estimated_chunks"] = chunks
+        if not chunks:
+            return
+        batcher, writer = self.search.embedding_batcher, self.search.writer
+        tokens_per_text = embedding["tokens"] / embedding["texts"] if embedding["texts"] else TOKEN_CHUNK_SIZE
+        if upload["documents"]:
+            bytes_per_document = upload["bytes"] / upload["documents"]
+        else:
+            bytes_per_document = len(json.dumps(batcher.embedder.vector)) + 4 * tokens_per_text
+        # The chunks and the title of each attachment
+        texts = chunks + attachments["extract"]
+        tokens = round(chunks * tokens_per_text)
+        embedding["texts"] += texts
+        embedding["tokens"] += tokens
+        embedding["calls"] += max(math.ceil(texts / batcher.batch_size), math.ceil(tokens / batcher.max_batch_tokens))
+        upload["documents"] += chunks
+        upload["bytes"] += round(chunks * bytes_per_document)
+        upload["batches"] += max(math.ceil(chunks / writer.max_documents),
+                                 math.ceil(chunks * bytes_per_document / writer.max_bytes))
@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional
+
+import requests
+
+# Responses with these statuses mean "slow down", they are retried
+THROTTLE_STATUS_CODES = {429, 503}
+
+
+def throttle_delay(obj) -> Optional[float]:
+    """Seconds to wait if the response or exception is a throttling error (0 if the server did not say), else None.
+
+    Works with requests responses and with the errors of requests, openai and azure-core, which all carry
+    the status code and the response headers.
+    """
+    response = getattr(obj, "response", None) if isinstance(obj, Exception) else obj
+    status = getattr(obj, "status_code", None) or getattr(response, "status_code", None)
+    if status not in THROTTLE_STATUS_CODES:
+        return None
+    headers = getattr(response, "headers", None) or {}
+    for header, scale in (("retry-after-ms", 0.001), ("x-ms-retry-after-ms", 0.001), ("Retry-After", 1)):
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            return max(0.0, float(value) * scale)
+        except ValueError:
+            try:
+                # Retry-After can also be a http date
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return 0.0
+
+
+class AdaptiveRateLimiter:
+    """Client side rate control for one remote service.
+
+    Requests are paced with a token bucket and the number of requests in flight is capped. Throttling
+    responses halve both the rate and the concurrency, honor Retry-After for every caller of the service
+    and are retried. Successful requests slowly raise them again (AIMD).
+    """
+
+    def __init__(self, name: str, max_rate: float = 10.0, max_concurrency: int = 8, max_retries: int = 6,
+                 max_backoff: float = 60.0):
+        self.name = name
+        self.max_rate = max_rate
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.rate = max_rate
+        self.concurrency = float(self.max_concurrency)
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.stats = None
+        self.reset()
+
+    def reset(self):
+        self.stats = {"requests": 0,
+                      "throttled": 0,
+                      "retries": 0,
+                      "wait_seconds": 0.0,
+                      "rate": self.rate,
+                      "concurrency": int(self.concurrency)}
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """Call fn through the limiter, retrying when the service throttles"""
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = throttle_delay(e)
+                self.release()
+                if delay is None or attempt == self.max_retries:
+                    raise
+            else:
+                delay = throttle_delay(result)
+                self.release()
+                if delay is None:
+                    self.on_success()
+                    return result
+                if attempt == self.max_retries:
+                    return result
+            self.on_throttle(delay, attempt)
+            with self.condition:
+                self.stats["retries"] += 1
+
+    def acquire(self):
+        start = time.monotonic()
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.in_flight >= int(self.concurrency):
+                    wait = None
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    self.stats["requests"] += 1
+                    self.stats["wait_seconds"] += time.monotonic() - start
+                    return
+                self.condition.wait(wait)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+            self.stats["rate"] = round(self.rate, 2)
+            self.stats["concurrency"] = int(self.concurrency)
+            self.condition.notify_all()
+
+    def on_throttle(self, delay: float, attempt: int):
+        if not delay:
+            # No Retry-After from the server, exponential backoff
+            delay = min(self.max_backoff, 2 ** attempt)
+        logging.info(f"{self.name} throttled, waiting {delay:.1f}s")
+        with self.condition:
+            self.concurrency = max(1.0, self.concurrency / 2)
+            self.rate = max(self.max_rate / 100, self.rate / 2)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            self.stats["throttled"] += 1
+            self.stats["rate"] = round(self.rate, 2)
+            self.stats["concurrency"] = int(self.concurrency)
+
+
+class RateLimitedSession(requests.Session):
+    """requests session that sends every request through a rate limiter"""
+
+    def __init__(self, rate_limiter: AdaptiveRateLimiter):
+        super().__init__()
+        self.rate_limiter = rate_limiter
+
+    def request(self, *args, **kwargs):
+        return self.rate_limiter.call(super().request, *args, **kwargs)
+
+
+def rate_limiter_from_config(config: Dict, service: str) -> AdaptiveRateLimiter:
+    """Creates the limiter of a service (confluence, embedding or azure_search) from a config"""
+    return AdaptiveRateLimiter(name=service,
+                               max_rate=config[f"{service}_max_rps"],
+                               max_concurrency=config[f"{service}_max_concurrency"],
+                               max_retries=config["rate_limit_max_retries"])
@@ -10,5 +10,11 @@ def search_indexer_from_config(config: Dict[str, str]):
             return AzureAISearchIndexer(
                 config=config
             )
+        case "LOCAL":
+            # The local index is only imported by the runs that use it
+            from confluence_vector_sync.local_search import LocalSearchIndexer
+            return LocalSearchIndexer(
+                config=config
+            )
         case _:
             raise Exception(f'Invalid search type {config["search_type"]} specified in config')
@@ -0,0 +1,43 @@
+import json
+import os
+from datetime import datetime
+from typing import Dict, Optional
+
+
+class SyncState:
+    """What previous runs know about each space, kept in a small JSON file between runs"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.spaces: Dict[str, Dict[str, str]] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.spaces = json.load(f).get("spaces", {})
+
+    def get_date(self, space: str, key: str) -> Optional[datetime]:
+        value = self.spaces.get(space, {}).get(key)
+        return datetime.fromisoformat(value) if value else None
+
+    def set_date(self, space: str, key: str, value: datetime):
+        self.spaces.setdefault(space, {})[key] = value.isoformat()
+
+    def get_watermark(self, space: str) -> Optional[datetime]:
+        """Latest modification date of the space that has been indexed"""
+        return self.get_date(space, "watermark")
+
+    def set_watermark(self, space: str, value: datetime):
+        self.set_date(space, "watermark", value)
+
+    def get_reconciled(self, space: str) -> Optional[datetime]:
+        """When all pages of the space were listed last time"""
+        return self.get_date(space, "reconciled")
+
+    def set_reconciled(self, space: str, value: datetime):
+        self.set_date(space, "reconciled", value)
+
+    def save(self):
+        # Write and rename, a crash does not leave a half written file behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"spaces": self.spaces}, f, indent=2)
+        os.replace(tmp_path, self.path)
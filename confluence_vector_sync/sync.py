@@ -1,17 +1,85 @@
+import argparse
 import logging
 import os
-from typing import Dict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
 
 from confluence_vector_sync import otel
 from confluence_vector_sync.attachment_loader import AttachmentLoader
 from confluence_vector_sync.config import get_config
-from confluence_vector_sync.confluence import confluence_from_config
+from confluence_vector_sync.confluence import PageHeader, SpacePages, confluence_from_config
+from confluence_vector_sync.extraction_cache import ExtractionCache
+from confluence_vector_sync.journal import RunJournal
+from confluence_vector_sync.planner import RunProfile, SyncPlanner
 from confluence_vector_sync.search import search_indexer_from_config
+from confluence_vector_sync.state import SyncState
+
+# Pages with these statuses are removed from the index
+REMOVED_STATUSES = {"archived", "trashed", "deleted"}
 
 
 def sync(config: Dict[str, str] = None, confluence=None, search=None):
+    config, confluence, search, extraction_cache = prepare(config, confluence, search)
+    journal = None
+    if config["run_journal_path"]:
+        journal = RunJournal(config["run_journal_path"])
+        if journal.resumed:
+            logging.warning("The previous run did not finish, resuming it")
+        search.journal = journal
+    started = datetime.now(timezone.utc)
+    with otel.stage("sync"):
+        # Create model of documents in search-index for all included confluence spaces
+        search.create_or_update_index()
+        # Spaces are listed and indexed one after the other, only the pages of one space are in memory
+        space_marks = {}
+        for space in confluence.iter_space_pages():
+            with otel.stage("space", space=space.key):
+                space_marks[space.key] = index_space(search, space)
+
+        if config["index_attachments"]:
+            purge_attachments(search, confluence.space_filter)
+        with otel.stage("close"):
+            search.close()
+    collect_diagnostics(search, confluence, extraction_cache)
+    if journal:
+        journal.finish()
+        search.diagnostics["journal"] = journal.stats
+        journal.close()
+    if confluence.state:
+        save_watermarks(confluence.state, space_marks, started, search.diagnostics)
+    record_profile(config, search.diagnostics)
+    otel.flush()
+    logging.info("Indexing complete")
+    logging.debug(search.diagnostics)
+    return search.diagnostics
+
+
+def plan(config: Dict[str, str] = None, confluence=None, search=None) -> Dict:
+    """What a sync would do and how long it would take, worked out without embedding or writing to the index.
+
+    Confluence and the index are read like in a sync, the incremental state is not moved and nothing is cached.
+    """
+    config, confluence, search, extraction_cache = prepare(config, confluence, search)
+    planner = SyncPlanner(config, search, RunProfile(config["run_profile_path"]))
+    with otel.stage("plan"):
+        for space in confluence.iter_space_pages():
+            index_space(search, space)
+        if config["index_attachments"]:
+            purge_attachments(search, confluence.space_filter)
+    estimate = planner.finish(confluence)
+    if extraction_cache:
+        extraction_cache.close()
+    otel.flush()
+    return estimate
+
+
+def prepare(config: Dict[str, str] = None, confluence=None, search=None):
+    """The config, confluence and search indexer of a run, set up for attachments and the incremental mode.
+
+    Returns them with the extraction cache, which is None when it is not used.
+    """
     load_dotenv()
     otel.setup()
     logging.getLogger().setLevel(level=os.getenv('LOG_LEVEL', 'WARNING').upper())
@@ -23,29 +91,93 @@ def sync(config: Dict[str, str] = None, confluence=None, search=None):
 
     if not search:
         search = search_indexer_from_config(config)
+    extraction_cache = None
     if config["index_attachments"]:
-        search.attachment_loader = AttachmentLoader(config["media_handlers"])
+        if config["extraction_cache_path"]:
+            extraction_cache = ExtractionCache(config["extraction_cache_path"],
+                                               max_bytes=config["extraction_cache_max_bytes"])
+        search.attachment_loader = AttachmentLoader(config["media_handlers"], cache=extraction_cache)
         confluence.handle_attachments = True
     confluence.space_filter = config["confluence_space_filter"]
-    page_model = confluence.create_space_page_map()
-    current = [page for p in page_model for page in page_model[p]["pages"] if
-               page["status"] not in {"archived", "trashed"}]
-    archived = [page for p in page_model for page in page_model[p]["pages"] if
-                page["status"] in {"archived", "trashed", "deleted"}]
-    # Create model of documents in search-index for all included confluence spaces
-    search.create_or_update_index()
+    if config["confluence_incremental"]:
+        confluence.incremental = True
+        confluence.state = SyncState(config["sync_state_path"])
+        confluence.reconcile_interval = timedelta(hours=config["confluence_reconcile_hours"])
     search.confluence = confluence
+    return config, confluence, search, extraction_cache
 
-    search.index(changeset={"upsert": current, "remove": archived})
-    if config["index_attachments"]:
-        for space in confluence.space_filter:
-            logging.info("Purging deleted attachments from index for space %s", space)
+
+def purge_attachments(search, spaces: List[str]):
+    for space in spaces:
+        logging.info("Purging deleted attachments from index for space %s", space)
+        with otel.stage("purge_attachments", space=space):
             search.purge_attachments(space)
-    logging.info("Indexing complete")
-    logging.debug(search.diagnostics)
-    return search.diagnostics
+
+
+def collect_diagnostics(search, confluence, extraction_cache: Optional[ExtractionCache]):
+    search.diagnostics["rate_limits"]["confluence"] = confluence.rate_limiter.stats
+    if extraction_cache:
+        search.diagnostics["extraction_cache"] = extraction_cache.stats
+        extraction_cache.close()
+
+
+def index_space(search, space: SpacePages, include: Callable[[str], bool] = None
+                ) -> Tuple[Optional[datetime], bool]:
+    """Index the pages of one space, returns the latest modification date of its pages and if it was reconciled.
+
+    include selects the page ids to index when the space is split into shards, by default all of them.
+    """
+    current = []
+    removed = []
+    for page in space.pages:
+        if include and not include(page.id):
+            continue
+        if page.status in REMOVED_STATUSES:
+            removed.append(page)
+        else:
+            current.append(page)
+    # Pages that are in the index but were not listed at all have been deleted from confluence
+    if space.reconciled:
+        listed = {page.id for page in current} | {page.id for page in removed}
+        removed.extend(PageHeader(id=page_id, space=space.key, status="deleted")
+                       for page_id in search.indexed_page_ids(space.key) - listed
+                       if not include or include(page_id))
+    search.index(changeset={"upsert": current, "remove": removed})
+    search.release_space(space.key)
+    modified = [page.last_modified for page in current + removed if page.last_modified]
+    return max(modified, default=None), space.reconciled
+
+
+def record_profile(config: Dict, diagnostics: Dict):
+    """Keep the latencies of the run for the estimates of the plans"""
+    if config["run_profile_path"]:
+        profile = RunProfile(config["run_profile_path"])
+        profile.record(diagnostics)
+        profile.save()
+
+
+def save_watermarks(state: SyncState, space_marks: Dict[str, Tuple[Optional[datetime], bool]], started: datetime,
+                    diagnostics: Dict):
+    """Remember how far the spaces are indexed, so the next incremental run lists only what changed after.
+
+    space_marks maps each space to the latest modification date of its listed pages and whether it was reconciled.
+    """
+    if diagnostics["counts"]["failed"] > 0:
+        # List the failed pages again next time
+        logging.warning("Some pages could not be indexed, not moving the watermarks")
+        return
+    for space_key, (modified, reconciled) in space_marks.items():
+        watermark = state.get_watermark(space_key)
+        if modified and (watermark is None or modified > watermark):
+            state.set_watermark(space_key, modified)
+        if reconciled:
+            state.set_reconciled(space_key, started)
+    state.save()
 
 
 # main
 if __name__ == "__main__":
-    print(sync())
+    parser = argparse.ArgumentParser(description="Index the confluence spaces of the configuration")
+    parser.add_argument("--plan", action="store_true",
+                        help="only estimate the requests, tokens and time of the run, nothing is embedded or written")
+    print(plan() if parser.parse_args().plan else sync())
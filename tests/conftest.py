@@ -0,0 +1,72 @@
+import logging
+import os
+from contextlib import ExitStack
+
+import pytest
+
+from benchmarks.fakes import FakeConfluenceServer, FakeSearchClient, FakeWiki, HashingEmbedder, TextMediaHandler
+from confluence_vector_sync.azure_ai_search import AzureAISearchIndexer
+from confluence_vector_sync.config import get_config
+from confluence_vector_sync.parsing import get_encoding
+from confluence_vector_sync.search import search_indexer_from_config
+
+
+class Fakes:
+    """A fake confluence server for a wiki, an in-memory search client and a hashing embedder, with the config
+    of runs against them"""
+
+    def __init__(self, server: FakeConfluenceServer, **overrides):
+        self.server = server
+        self.wiki = server.wiki
+        self.client = FakeSearchClient()
+        self.embedder = HashingEmbedder(dimensions=8)
+        self.config = get_config()
+        self.config.update({"confluence_url": server.url,
+                            "confluence_user_name": "test",
+                            "confluence_password": "test",
+                            "confluence_auth_method": "PASSWORD",
+                            "confluence_extra_headers": [],
+                            "confluence_space_filter": list(self.wiki.spaces),
+                            "azure_search_endpoint": server.url.rstrip("/"),
+                            "azure_search_key": "test",
+                            "azure_search_confluence_index": "test",
+                            "azure_search_full_reindex": False,
+                            "embedding_cache_path": "",
+                            "index_attachments": self.wiki.attachments_per_page > 0,
+                            "media_handlers": [{"text/plain": TextMediaHandler()}],
+                            "confluence_incremental": False})
+        for service in ("confluence", "embedding", "azure_search"):
+            self.config[f"{service}_max_rps"] = 10000
+            self.config[f"{service}_max_concurrency"] = 64
+        self.config.update(overrides)
+
+    def indexer(self) -> AzureAISearchIndexer:
+        """A new indexer of the config, with the fakes instead of the embedding model and Azure AI Search"""
+        os.environ.setdefault("OPENAI_API_KEY", "test")
+        indexer = search_indexer_from_config(self.config)
+        if self.config["search_type"] != "LOCAL":
+            indexer.client = indexer.writer.client = self.client
+        indexer.embedder = indexer.embedding_batcher.embedder = self.embedder
+        try:
+            get_encoding(self.config["azure_search_embedding_model"]).encode("tiktoken")
+        except Exception:
+            # The encodings are downloaded on first use, estimate the tokens when that is not possible
+            logging.warning("tiktoken encoding not available, estimating token counts")
+            indexer.embedding_batcher.count_tokens = lambda text: len(text) // 4 + 1
+        return indexer
+
+
+@pytest.fixture
+def start_fakes():
+    """Starts the Fakes of a wiki, config overrides as keyword arguments. The servers stop after the test"""
+    with ExitStack() as stack:
+        def start(wiki: FakeWiki, **overrides) -> Fakes:
+            return Fakes(stack.enter_context(FakeConfluenceServer(wiki)), **overrides)
+
+        yield start
+
+
+@pytest.fixture
+def search_client() -> FakeSearchClient:
+    """An empty in-memory index"""
+    return FakeSearchClient()
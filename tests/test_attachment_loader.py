@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+from langchain_core.documents import Document
+
+from confluence_vector_sync.attachment_loader import AttachmentExtractor, AttachmentLoader, SpooledDownload
+from confluence_vector_sync.config import get_config
+from confluence_vector_sync.extraction_cache import ExtractionCache, version_key
+
+
+class BytesHandler:
+    def __init__(self):
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def handle(self, file_path: str):
+        with open(file_path, "rb") as f:
+            return self.extract("file", f.read())
+
+    def handle_bytes(self, data: bytes):
+        return self.extract("bytes", data)
+
+    def extract(self, kind: str, data: bytes):
+        with self.lock:
+            self.calls.append(kind)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.02)
+        with self.lock:
+            self.active -= 1
+        return [Document(page_content=data.decode())]
+
+
+class ConfiguredHandler(BytesHandler):
+    created = 0
+
+    def __init__(self, config: str):
+        super().__init__()
+        ConfiguredHandler.created += 1
+        self.config = config
+
+
+class FakeConfluence:
+    downloads = 0
+
+    def download_attachment(self, attachment, spool_bytes):
+        self.downloads += 1
+        download = SpooledDownload(spool_bytes)
+        for _ in range(attachment["extensions"]["fileSize"] // 10):
+            download.write(attachment["id"].encode().ljust(10))
+        download.finish()
+        return download
+
+
+def attachment(i: int, size: int, modified: int = 1):
+    return {"id": f"att{i}", "metadata": {"mediaType": "text/plain"}, "extensions": {"fileSize": size},
+            "_links": {"download": f"/download/attachments/1/{i}.txt?version=1&modificationDate={modified}"}}
+
+
+def test_attachments_are_extracted_concurrently_within_the_budget():
+    handler = BytesHandler()
+    extractor = AttachmentExtractor(FakeConfluence(), AttachmentLoader([{"text/plain": handler}]), workers=4,
+                                    max_in_flight_bytes=300, spool_bytes=150)
+    attachments = [attachment(i, 100) for i in range(6)] + [attachment(6, 1000)]
+    results = list(extractor.extract(attachments))
+    extractor.close()
+    assert [a["id"] for a, _ in results] == [f"att{i}" for i in range(7)]
+    assert results[6][1][0].page_content.startswith("att6")
+    # Three attachments of 100 bytes fit the budget, the large one was processed alone from a file
+    assert 1 < handler.max_active <= 3
+    assert extractor.budget.peak == 1000 and extractor.budget.in_flight == 0
+    assert handler.calls.count("file") == 1
+
+
+def test_extractions_are_cached_by_version_and_content(tmp_path):
+    handler = BytesHandler()
+    confluence = FakeConfluence()
+    cache = ExtractionCache(str(tmp_path / "extractions.db"), max_bytes=1000)
+    extractor = AttachmentExtractor(confluence, AttachmentLoader([{"text/plain": handler}], cache=cache), workers=0)
+    first = list(extractor.extract([attachment(1, 100)]))
+    again = list(extractor.extract([attachment(1, 100)]))
+    # A new version with the same content is downloaded, but not extracted again
+    touched = list(extractor.extract([attachment(1, 100, modified=2)]))
+    assert first[0][1] == again[0][1] == touched[0][1]
+    assert (confluence.downloads, len(handler.calls)) == (2, 1)
+    assert {key: cache.stats[key] for key in ("hits", "content_hits", "misses")} == \
+           {"hits": 1, "content_hits": 1, "misses": 1}
+    # Least recently used extractions are evicted above max_bytes
+    list(extractor.extract([attachment(i, 200) for i in range(2, 6)]))
+    assert cache.size <= 1000 and cache.stats["evictions"] > 0
+    cache.close()
+
+
+def test_media_handlers_are_created_on_first_use(monkeypatch):
+    monkeypatch.setenv("MEDIA_HANDLER_KEY_1", "text/plain,text/csv")
+    monkeypatch.setenv("MEDIA_HANDLER_VALUE_1", f"{__name__}:ConfiguredHandler")
+    monkeypatch.setenv("MEDIA_HANDLER_CONFIG_1", "{}")
+    ConfiguredHandler.created = 0
+    loader = AttachmentLoader(get_config()["media_handlers"])
+    assert loader.can_handle("text/csv") and ConfiguredHandler.created == 0
+    extractor = AttachmentExtractor(FakeConfluence(), loader, workers=0)
+    assert list(extractor.extract([attachment(1, 100)]))[0][1][0].page_content.startswith("att1")
+    handler = loader.handler("text/csv")
+    # One handler for the media types of a variable, keyed in the cache by its own class
+    assert ConfiguredHandler.created == 1 and handler.config == "{}" and handler.calls == ["bytes"]
+    assert "ConfiguredHandler" in version_key(attachment(1, 100), handler)
+    monkeypatch.setenv("MEDIA_HANDLER_VALUE_1", "NoSuchHandler")
+    with pytest.raises(ValueError):
+        get_config()
@@ -0,0 +1,108 @@
+import threading
+
+import pytest
+
+from benchmarks.fakes import FakeWiki
+from confluence_vector_sync.azure_ai_search import AzureAISearchIndexer, content_hash
+from confluence_vector_sync.azure_ai_search_writer import SearchDocumentWriter
+from confluence_vector_sync.config import get_config
+from confluence_vector_sync.confluence import PageHeader
+
+
+def make_indexer(search_client):
+    # Only what diffing and holding back the writes of a page need, without clients for the model and the index
+    indexer = AzureAISearchIndexer.__new__(AzureAISearchIndexer)
+    indexer.full_reindex = False
+    indexer.writer = SearchDocumentWriter(search_client)
+    indexer.lock = threading.Lock()
+    indexer.held = {}
+    indexer.owners = {}
+    indexer.journal = None
+    indexer.diagnostics = {"counts": {"chunk-stale": 0, "chunk-unchanged": 0}}
+    return indexer
+
+
+def chunk(document_id, i, text, attachment_page_id=""):
+    doc = {"id": f"{document_id}_{i}", "document_id": document_id, "attachment_page_id": attachment_page_id,
+           "chunk": text, "chunkVector": None, "last_modified_date": "new", "last_indexed_date": "now"}
+    doc["content_hash"] = content_hash(doc)
+    return doc
+
+
+def test_content_hash_ignores_dates_and_vectors():
+    doc = chunk("1", 0, "text")
+    assert content_hash(dict(doc, chunkVector=[0.1], last_indexed_date="later")) == doc["content_hash"]
+    assert content_hash(dict(doc, chunk="other")) != doc["content_hash"]
+
+
+def test_only_changed_chunks_are_uploaded(search_client):
+    indexer = make_indexer(search_client)
+    old = [chunk("1", 0, "same"), chunk("1", 1, "old"), chunk("1", 2, "gone"),
+           chunk("a", 0, "kept", "1"), chunk("b", 0, "detached", "1")]
+    indexed = {doc["id"]: (doc["document_id"], doc["content_hash"]) for doc in old}
+    item = PageHeader(id="1", space="S", status="current", attachments=[{"id": "a"}])
+    changed, stale, unchanged = indexer.diff_documents(item, [chunk("1", 0, "same"), chunk("1", 1, "new")], indexed)
+    assert [doc["id"] for doc in changed] == ["1_1"]
+    # The unchanged attachment "a" keeps its chunk, "b" is not attached anymore
+    assert stale == ["1_2", "b_0"]
+    assert unchanged == [{"id": "1_0", "last_modified_date": "new", "last_indexed_date": "now"}]
+    assert indexer.diagnostics["counts"] == {"chunk-stale": 2, "chunk-unchanged": 1}
+
+
+def test_writes_of_a_page_wait_for_all_its_documents(search_client):
+    indexer = make_indexer(search_client)
+    changed = [chunk("1", 1, "new"), chunk("a", 0, "new", "1")]
+    merges = [{"id": "1_0", "last_modified_date": "new", "last_indexed_date": "now"}]
+    indexer.hold("1", changed, ["1_2"], merges)
+    indexer.upload_stage(changed[:1])
+    # Nothing of the page is written before all its documents are embedded
+    assert not indexer.writer.uploads and not indexer.writer.deletes and not indexer.writer.merges
+    indexer.upload_stage(changed[1:])
+    assert list(indexer.writer.uploads) == ["1_1", "a_0"]
+    assert list(indexer.writer.deletes) == ["1_2"] and list(indexer.writer.merges) == ["1_0"]
+    # The dates of the first chunk are only merged when the uploads succeed
+    assert indexer.writer.merge_after["1_0"] == {"1_1", "a_0"}
+
+
+def test_schema_has_the_dimensions_and_compression_of_the_config(search_client):
+    indexer = make_indexer(search_client)
+    indexer.index_name = "confluence"
+    indexer.params = {"api-version": "2024-07-01"}
+    indexer.vector_dimensions, indexer.vector_compression, indexer.vector_oversampling = 256, "binary", 4.0
+    schema = indexer.index_schema()
+    vectors = [field for field in schema["fields"] if field["name"].endswith("Vector")]
+    assert [field["dimensions"] for field in vectors] == [256, 256]
+    compression = schema["vectorSearch"]["compressions"][0]
+    assert (compression["kind"], compression["defaultOversampling"]) == ("binaryQuantization", 4.0)
+    assert compression["rerankWithOriginalVectors"]
+    assert schema["vectorSearch"]["profiles"][0]["compression"] == compression["name"]
+    indexer.vector_compression = "none"
+    assert "compressions" not in indexer.index_schema()["vectorSearch"]
+
+
+def test_compression_needs_a_recent_api_version():
+    config = dict(get_config(), azure_search_vector_compression="scalar", azure_search_api_version="2023-11-01")
+    with pytest.raises(ValueError, match="2024-07-01"):
+        AzureAISearchIndexer(config)
+
+
+def test_cached_vectors_are_kept_apart_by_dimensions(tmp_path, start_fakes):
+    fakes = start_fakes(FakeWiki(spaces=1, pages=1), embedding_cache_path=str(tmp_path / "embeddings.db"),
+                        embedding_dimensions=8)
+    cache = fakes.indexer().embedding_cache
+    cache.put_many({"text": [0.5] * 8})
+    cache.close()
+    fakes.config["embedding_dimensions"] = 4
+    assert fakes.indexer().embedding_cache.get_many(["text"]) == {}
+    fakes.config["embedding_dimensions"] = 8
+    assert fakes.indexer().embedding_cache.get_many(["text"]) == {"text": [0.5] * 8}
+
+
+def test_pages_of_a_failed_embedding_batch_are_counted_once(search_client):
+    indexer = make_indexer(search_client)
+    indexer.failed_pages = set()
+    indexer.diagnostics["counts"]["failed"] = 0
+    error = RuntimeError("throttled")
+    indexer.on_embedding_error([chunk("1", 0, "a"), chunk("a", 0, "b", "1"), chunk("2", 0, "c")], error)
+    indexer.on_embedding_error([chunk("2", 1, "d")], error)
+    assert indexer.failed_pages == {"1", "2"} and indexer.diagnostics["counts"]["failed"] == 2
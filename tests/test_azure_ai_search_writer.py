@@ -0,0 +1,114 @@
+from types import SimpleNamespace
+
+from azure.core.exceptions import HttpResponseError, ServiceRequestError
+
+from confluence_vector_sync import azure_ai_search_writer
+from confluence_vector_sync.azure_ai_search_writer import SearchDocumentWriter
+
+
+def test_batches_by_count_and_size(search_client):
+    writer = SearchDocumentWriter(search_client, max_documents=2, max_bytes=10 ** 6)
+    writer.upload([{"id": str(i)} for i in range(5)])
+    writer.close()
+    assert [len(ids) for _, ids in search_client.log] == [2, 2, 1]
+
+    search_client.log.clear()
+    writer = SearchDocumentWriter(search_client, max_documents=100, max_bytes=40)
+    writer.upload([{"id": str(i), "chunk": "x" * 20} for i in range(3)])
+    writer.close()
+    assert [len(ids) for _, ids in search_client.log] == [1, 1, 1]
+
+
+def test_deletes_before_uploads(search_client):
+    search_client.documents = {"1_0": {}, "1_1": {}}
+    writer = SearchDocumentWriter(search_client)
+    writer.delete(["1_0", "1_1"])
+    writer.upload([{"id": "1_0"}])
+    writer.close()
+    assert search_client.log == [("delete", ["1_1"]), ("upload", ["1_0"])]
+    assert set(search_client.documents) == {"1_0"}
+
+
+def test_merges_after_uploads(search_client):
+    search_client.documents = {"1_0": {"id": "1_0", "chunk": "a", "last_indexed_date": "old"}}
+    writer = SearchDocumentWriter(search_client)
+    writer.merge([{"id": "1_0", "last_indexed_date": "new"}])
+    writer.upload([{"id": "1_1", "chunk": "b"}])
+    writer.close()
+    assert search_client.log == [("upload", ["1_1"]), ("merge", ["1_0"])]
+    assert search_client.documents["1_0"] == {"id": "1_0", "chunk": "a", "last_indexed_date": "new"}
+    assert writer.stats["merged"] == 1
+
+
+def test_merges_after_failed_uploads_are_given_up(monkeypatch, search_client):
+    monkeypatch.setattr(azure_ai_search_writer.time, "sleep", lambda seconds: None)
+    search_client.documents = {"1_0": {"id": "1_0", "last_modified_date": "old"}, "2_0": {"id": "2_0"}}
+    writer = SearchDocumentWriter(search_client, max_retries=0)
+    search_client.fail_once.add("1_1")
+    writer.upload([{"id": "1_1"}, {"id": "2_1"}])
+    writer.merge([{"id": "1_0", "last_modified_date": "new"}], after=["1_1"])
+    writer.merge([{"id": "2_0", "last_modified_date": "new"}], after=["2_1"])
+    flushed = []
+    writer.on_flush = flushed.append
+    writer.close()
+    assert search_client.log[-1] == ("merge", ["2_0"])
+    assert search_client.documents["1_0"]["last_modified_date"] == "old"
+    assert flushed == [{"1_1", "1_0"}]
+
+
+def test_reset_drops_the_buffered_documents(search_client):
+    search_client.documents = {"1_0": {"id": "1_0"}}
+    writer = SearchDocumentWriter(search_client)
+    writer.delete(["1_0"])
+    writer.upload([{"id": "2_0"}])
+    writer.merge([{"id": "1_0"}], after=["2_0"])
+    writer.reset()
+    writer.close()
+    assert search_client.log == [] and writer.stats["uploaded"] == 0
+
+
+def test_retries_only_failed_keys(monkeypatch, search_client):
+    monkeypatch.setattr(azure_ai_search_writer.time, "sleep", lambda seconds: None)
+    search_client.fail_once.add("b")
+    writer = SearchDocumentWriter(search_client)
+    writer.upload([{"id": "a"}, {"id": "b"}])
+    writer.close()
+    assert search_client.log == [("upload", ["a", "b"]), ("upload", ["b"])]
+    assert writer.stats["uploaded"] == 2
+    assert writer.stats["retried"] == 1
+    assert writer.stats["failed"] == 0
+
+
+def test_connection_errors_fail_the_keys(monkeypatch, search_client):
+    monkeypatch.setattr(azure_ai_search_writer.time, "sleep", lambda seconds: None)
+
+    def upload_documents(documents):
+        search_client.log.append(("upload", [doc["id"] for doc in documents]))
+        raise ServiceRequestError("connection refused")
+
+    monkeypatch.setattr(search_client, "upload_documents", upload_documents)
+    writer = SearchDocumentWriter(search_client, max_retries=1)
+    flushed = []
+    writer.on_flush = flushed.append
+    writer.upload([{"id": "a"}, {"id": "b"}])
+    writer.close()
+    assert len(search_client.log) == 2
+    assert flushed == [{"a", "b"}] and writer.stats["failed"] == 2
+
+
+def test_throttling_is_left_to_the_rate_limiter(monkeypatch, search_client):
+    monkeypatch.setattr(azure_ai_search_writer.time, "sleep", lambda seconds: None)
+
+    def upload_documents(documents):
+        search_client.log.append(("upload", [doc["id"] for doc in documents]))
+        error = HttpResponseError("throttled")
+        error.status_code = 429
+        raise error
+
+    monkeypatch.setattr(search_client, "upload_documents", upload_documents)
+    # A limiter that gave up retrying, it raises the last throttling error
+    limiter = SimpleNamespace(call=lambda fn, **kwargs: fn(**kwargs))
+    writer = SearchDocumentWriter(search_client, rate_limiter=limiter)
+    writer.upload([{"id": "a"}])
+    writer.close()
+    assert len(search_client.log) == 1 and writer.stats["failed"] == 1
@@ -0,0 +1,63 @@
+from confluence_vector_sync.confluence import ConfluenceWrapper, PageHeader
+
+
+class FakeConfluence:
+    url = "https://example.atlassian.net/wiki"
+
+    def __init__(self, pages: int, server_max_limit: int = 1000):
+        self.pages = [{"id": str(i), "status": "current", "title": f"Page {i}",
+                       "version": {"when": "2024-01-01T00:00:00.000Z"},
+                       "_links": {"webui": f"/spaces/SPACE/pages/{i}/Page+{i}"}} for i in range(pages)]
+        self.server_max_limit = server_max_limit
+        self.calls = []
+
+    def get_all_pages_from_space(self, space_key, start=0, limit=100, **kwargs):
+        self.calls.append(("list", start, limit))
+        return self.pages[start:start + min(limit, self.server_max_limit)]
+
+    def get(self, path, params=None, absolute=False):
+        self.calls.append(("get", path, params))
+        ids = params["cql"][len("id in ("):-1].split(",")
+        return {"results": [{"id": i, "body": {"storage": {"value": f"<p>{i}</p>"}}} for i in ids if i != "3"]}
+
+    def get_page_by_id(self, page_id, expand=None):
+        self.calls.append(("page", page_id))
+        return {"body": {"storage": {"value": "single"}}}
+
+
+def make_wrapper(confluence, **kwargs):
+    wrapper = ConfluenceWrapper(url=confluence.url, username="user", password="password", **kwargs)
+    wrapper.confluence = confluence
+    return wrapper
+
+
+def test_pages_are_listed_with_a_fixed_page_size():
+    confluence = FakeConfluence(250, server_max_limit=50)
+    pages = list(make_wrapper(confluence, page_size=100).get_pages("SPACE"))
+    assert [page["id"] for page in pages] == [str(i) for i in range(250)]
+    # The server returned less than asked for, the listing continues after the last result
+    assert [call[1:] for call in confluence.calls] == [(start, 100) for start in range(0, 300, 50)]
+
+
+def test_page_bodies_are_fetched_in_batches():
+    confluence = FakeConfluence(5)
+    wrapper = make_wrapper(confluence, body_batch_size=2)
+    pages = [PageHeader(id=str(i), space="SPACE", status="current") for i in range(5)]
+    contents = [wrapper.get_page_content(page) for page in wrapper.with_page_bodies(pages)]
+    assert contents == ["<p>0</p>", "<p>1</p>", "<p>2</p>", "single", "<p>4</p>"]
+    assert [call[0] for call in confluence.calls] == ["get", "get", "page", "get"]
+    # The bodies are not kept in the page model
+    assert all(page.body is None for page in pages)
+
+
+def test_spaces_are_listed_lazily():
+    confluence = FakeConfluence(3)
+    confluence.get_space = lambda space_key: {"key": space_key}
+    wrapper = make_wrapper(confluence)
+    wrapper.space_filter = ["A", "B"]
+    spaces = wrapper.iter_space_pages()
+    space = next(spaces)
+    assert (space.key, space.reconciled, confluence.calls) == ("A", True, [])
+    page = next(space.pages)
+    assert (page.id, page.space, page.title, page.last_modified.year) == ("0", "A", "Page 0", 2024)
+    assert wrapper.get_page_url(page) == "https://example.atlassian.net/wiki/display/A/Page+0"
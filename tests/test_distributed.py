@@ -0,0 +1,88 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from benchmarks.fakes import FakeWiki
+from confluence_vector_sync.confluence import PageHeader, SpacePages
+from confluence_vector_sync.distributed import ShardQueue, coordinate, merge_diagnostics, run_worker
+
+
+def test_workers_index_all_shards(tmp_path, start_fakes):
+    wiki = FakeWiki(spaces=2, pages=6, attachments=1, page_bytes=3000)
+    fakes = start_fakes(wiki, shard_queue_path=str(tmp_path / "shards.db"), shard_buckets=3)
+    with ThreadPoolExecutor() as pool:
+        # Workers started before the coordinator wait for the shards
+        workers = [pool.submit(run_worker, fakes.config, worker=f"worker-{n}", poll_seconds=0.05,
+                               search=fakes.indexer()) for n in range(2)]
+        diagnostics = coordinate(fakes.config, workers=0, search=fakes.indexer(), poll_seconds=0.05)
+    assert sum(worker.result() for worker in workers) == 6
+    assert diagnostics["shards"] == {"pending": 0, "leased": 0, "done": 6, "failed": 0}
+    counts = diagnostics["counts"]
+    assert (counts["create"], counts["attachment-create"], counts["failed"]) == (12, 12, 0)
+    assert {doc["document_id"] for doc in fakes.client.documents.values() if doc["item_type"] == "page"} == \
+           {str(i) for i in range(1, 13)}
+    # Each space is listed once by the coordinator, not by each of its three shards
+    assert fakes.server.requests["attachment_inventory"] == 4 and "attachments" not in fakes.server.requests
+
+    wiki.removed.add("3")
+    with ThreadPoolExecutor() as pool:
+        coordinator = pool.submit(coordinate, fakes.config, workers=0, search=fakes.indexer(), poll_seconds=0.05)
+        # A worker that starts before the next run is queued would find the previous run done
+        queue = ShardQueue(fakes.config["shard_queue_path"])
+        while not queue.counts()["pending"]:
+            time.sleep(0.01)
+        completed = run_worker(fakes.config, worker="worker-0", search=fakes.indexer())
+        counts = coordinator.result()["counts"]
+    assert (completed, counts["create"], counts["update"], counts["remove"]) == (6, 0, 0, 1)
+    assert not [doc for doc in fakes.client.documents.values() if "3" in (doc["document_id"],
+                                                                          doc["attachment_page_id"])]
+
+
+def test_expired_and_failed_leases(tmp_path):
+    queue = ShardQueue(str(tmp_path / "shards.db"), lease_seconds=0, max_attempts=2)
+    assert queue.start()
+    queue.create([SpacePages(key="A", reconciled=True, pages=[PageHeader(id="1", space="A", status="current")])], 1)
+    shard = queue.lease("worker-0")
+    assert queue.space_pages(shard).pages == [PageHeader(id="1", space="A", status="current")]
+    # The lease expired, another worker takes over and the first one can not renew anymore
+    assert queue.lease("worker-1") == shard
+    assert not queue.renew(shard, "worker-0")
+    assert not queue.start()
+    queue.fail(shard, "worker-1")
+    assert queue.counts()["failed"] == 1 and queue.results() == {"A": [None]}
+    assert queue.lease("worker-2") is None and queue.finished()
+
+
+def test_shards_are_queued_space_by_space(tmp_path):
+    queue = ShardQueue(str(tmp_path / "shards.db"))
+    worker = ShardQueue(str(tmp_path / "shards.db"))
+    assert queue.start()
+
+    def spaces():
+        yield SpacePages(key="A", reconciled=True, pages=[PageHeader(id="1", space="A", status="current")])
+        # The shards of A can be indexed while B is listed, the run is not finished before B is queued
+        shard = worker.lease("worker-0")
+        worker.complete(shard, "worker-0", {})
+        assert shard.space == "A" and not worker.finished()
+        yield SpacePages(key="B", reconciled=True, pages=[PageHeader(id="2", space="B", status="current")])
+        raise RuntimeError("listing failed")
+
+    with pytest.raises(RuntimeError):
+        queue.create(spaces(), 1)
+    assert worker.lease("worker-0").space == "B" and not worker.finished()
+    # Some spaces were never listed, the run is started over
+    assert queue.start() and not any(queue.counts().values())
+    queue.create([SpacePages(key="A", reconciled=True, pages=[])], 1)
+    worker.complete(worker.lease("worker-0"), "worker-0", {})
+    assert worker.finished()
+
+
+def test_merge_diagnostics():
+    merged = merge_diagnostics([
+        {"counts": {"create": 2}, "embedding": {"texts": 10, "seconds": 2.0, "texts_per_second": 5.0},
+         "pipeline": {"embed": {"workers": 2}}, "embedding_cache": None},
+        {"counts": {"create": 3}, "embedding": {"texts": 30, "seconds": 2.0, "texts_per_second": 15.0},
+         "pipeline": {"embed": {"workers": 2}}, "embedding_cache": None}])
+    assert merged == {"counts": {"create": 5}, "embedding": {"texts": 40, "seconds": 4.0, "texts_per_second": 10.0},
+                      "pipeline": {"embed": {"workers": 2}}, "embedding_cache": None}
@@ -0,0 +1,152 @@
+from confluence_vector_sync.dedup import ChunkDeduplicator
+from confluence_vector_sync.embedding import EmbeddingBatcher
+from confluence_vector_sync.embedding_cache import EmbeddingCache
+
+
+class FakeEmbedder:
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(text))] for text in texts]
+
+
+def make_batcher(embedder, **kwargs):
+    batcher = EmbeddingBatcher(embedder, model="text-embedding-ada-002", **kwargs)
+    # Word count instead of tiktoken, so the tests do not need to download the encoding
+    batcher.count_tokens = lambda text: len(text.split())
+    return batcher
+
+
+def make_doc(title, chunk):
+    return {"title": title, "titleVector": None, "chunk": chunk, "chunkVector": None}
+
+
+def test_batches_across_documents():
+    embedder = FakeEmbedder()
+    batcher = make_batcher(embedder, batch_size=4)
+    first = [make_doc("Page", "one"), make_doc("Page", "two")]
+    # Title is shared between chunks, so only 3 distinct texts so far
+    assert batcher.add(first) == []
+    ready = batcher.add([make_doc("Other", "three")])
+    assert len(embedder.calls) == 1 and len(embedder.calls[0]) == 4
+    assert ready == first
+    ready = batcher.flush()
+    assert len(ready) == 1
+    assert ready[0]["titleVector"] == [5.0] and ready[0]["chunkVector"] == [5.0]
+    assert batcher.stats["batches"] == 2
+    assert batcher.stats["texts"] == 5
+    assert 0 <= batcher.stats["max_batch_seconds"] <= batcher.stats["seconds"]
+
+
+def test_reset_drops_the_queued_documents():
+    embedder = FakeEmbedder()
+    batcher = make_batcher(embedder, batch_size=4)
+    batcher.add([make_doc("Page", "one")])
+    batcher.reset()
+    assert len(batcher) == 0 and batcher.flush() == [] and not embedder.calls
+
+
+def test_documents_of_a_failed_batch_are_reported():
+    class FailingEmbedder(FakeEmbedder):
+        def embed_documents(self, texts):
+            if "B" in texts:
+                raise RuntimeError("throttled")
+            return super().embed_documents(texts)
+
+    failed = []
+    batcher = make_batcher(FailingEmbedder(), batch_size=3, on_error=lambda docs, error: failed.extend(docs))
+    first = make_doc("A", "one")
+    second = [make_doc("B", "two"), make_doc("B", "three")]
+    assert batcher.add([first]) == []
+    # The batch of "A", "one" and the shared title "B" fails, the second page is given up with the first
+    assert batcher.add(second) == []
+    assert batcher.flush() == []
+    assert sorted(map(id, failed)) == sorted(map(id, [first, *second]))
+    assert not batcher.remaining and batcher.stats["failed"] == 3
+
+
+def test_token_budget_splits_batches():
+    embedder = FakeEmbedder()
+    batcher = make_batcher(embedder, batch_size=100, max_batch_tokens=3)
+    docs = [{"title": "", "titleVector": [], "chunk": "word " * 2, "chunkVector": None},
+            {"title": "", "titleVector": [], "chunk": "other " * 2, "chunkVector": None}]
+    # The second text does not fit the budget, so the first one is already a full batch
+    assert batcher.add(docs) == docs[:1]
+    assert batcher.flush() == docs[1:]
+    assert [len(call) for call in embedder.calls] == [1, 1]
+
+
+def test_documents_without_missing_vectors_are_ready():
+    batcher = make_batcher(FakeEmbedder())
+    doc = {"title": "", "titleVector": [], "chunk": "x", "chunkVector": [1.0]}
+    assert batcher.add([doc]) == [doc]
+
+
+def test_cache_hits_skip_the_embedder(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), model="text-embedding-ada-002")
+    embedder = FakeEmbedder()
+    batcher = make_batcher(embedder, cache=cache)
+    batcher.add([make_doc("Page", "one")])
+    batcher.flush()
+    # Whitespace differences do not change the cache key
+    doc = make_doc("Page ", "one")
+    assert make_batcher(embedder, cache=cache).add([doc]) == [doc]
+    assert len(embedder.calls) == 1
+    assert doc["chunkVector"] == [3.0]
+    assert cache.stats["hits"] == 2
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), model="text-embedding-ada-002", max_entries=2)
+    cache.put_many({"a": [1.0]})
+    cache.put_many({"b": [2.0]})
+    # Replaced, not a new entry
+    cache.put_many({"b ": [2.0]})
+    assert cache.entries == 2 and cache.stats["evictions"] == 0
+    cache.get_many(["a"])
+    cache.put_many({"c": [3.0]})
+    assert set(cache.get_many(["a", "b", "c"])) == {"a", "c"}
+    assert cache.stats["evictions"] == 1
+
+
+def test_cache_lookups_without_touch_keep_the_eviction_order(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), model="text-embedding-ada-002", max_entries=2)
+    cache.put_many({"a": [1.0]})
+    cache.put_many({"b": [2.0]})
+    assert cache.get_many(["a"], touch=False) == {"a": [1.0]}
+    cache.put_many({"c": [3.0]})
+    assert set(cache.get_many(["a", "b", "c"])) == {"b", "c"}
+
+
+def test_known_token_counts_are_not_counted_again():
+    embedder = FakeEmbedder()
+    batcher = make_batcher(embedder, batch_size=10, max_batch_tokens=100)
+    counted = []
+    batcher.count_tokens = lambda text: counted.append(text) or 1
+    batcher.add([make_doc("", "a"), make_doc("", "b")], token_counts={"a": 60, "b": 60})
+    batcher.flush()
+    # The titles were counted, the chunks were batched by their known counts
+    assert counted == [""] and [len(call) for call in embedder.calls] == [2, 1]
+
+
+def test_duplicates_reuse_vectors():
+    embedder = FakeEmbedder()
+    batcher = make_batcher(embedder, batch_size=2, dedup=ChunkDeduplicator(threshold=0.8))
+    words = [f"word{i}" for i in range(60)]
+    text = " ".join(words)
+    near = " ".join(words[:30] + ["changed"] + words[31:])
+    other = " ".join(reversed(words))
+    first = [{"title": "", "titleVector": [], "chunk": text, "chunkVector": None},
+             {"title": "", "titleVector": [], "chunk": near, "chunkVector": None}]
+    # The near duplicate waits for the vector of the text it repeats
+    assert batcher.add(first) == []
+    assert batcher.flush() == first
+    later = [{"title": "", "titleVector": [], "chunk": f"  {text}", "chunkVector": None},
+             {"title": "", "titleVector": [], "chunk": other, "chunkVector": None}]
+    assert batcher.add(later) == later[:1]
+    assert batcher.flush() == later[1:]
+    assert embedder.calls == [[text], [other]]
+    assert first[1]["chunkVector"] == later[0]["chunkVector"] == first[0]["chunkVector"]
+    assert (batcher.dedup.stats["exact"], batcher.dedup.stats["near"]) == (1, 1)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from benchmarks.fakes import FakeWiki
+from confluence_vector_sync.local_search import LocalSearchIndexer, LocalVectorStore
+from confluence_vector_sync.sync import sync
+
+
+def make_docs(n: int, dimensions: int = 16):
+    vectors = np.random.default_rng(0).standard_normal((n, dimensions), dtype=np.float32)
+    return [{"id": f"{i}_0", "document_id": str(i), "space": "A" if i % 2 else "B", "title": "",
+             "titleVector": [], "chunk": f"chunk {i}", "chunkVector": vectors[i].tolist()} for i in range(n)]
+
+
+@pytest.mark.parametrize("quantization,index", [("float32", "flat"), ("int8", "flat"), ("float32", "ivf")])
+def test_store_queries_survive_saving(tmp_path, quantization, index):
+    store = LocalVectorStore(str(tmp_path), quantization=quantization, index=index, nprobe=4)
+    docs = make_docs(200)
+    store.upload_documents(docs)
+    store.delete_documents([{"id": "5_0"}])
+    store.merge_documents([{"id": "7_0", "chunk": "merged"}])
+    before = [result["id"] for result in store.query(docs[7]["chunkVector"], top=3)]
+    store.save()
+
+    store = LocalVectorStore(str(tmp_path), quantization=quantization, index=index, nprobe=4)
+    results = store.query(docs[7]["chunkVector"], top=3, filter="space eq 'A'")
+    assert before[0] == results[0]["id"] == "7_0" and results[0]["chunk"] == "merged"
+    assert results[0]["@search.score"] == pytest.approx(1.0, abs=0.01)
+    assert all(store.get_document(result["id"])["space"] == "A" for result in results)
+    assert not store.query(docs[5]["chunkVector"], top=1)[0]["id"] == "5_0"
+    assert store.get_document("8_0", ["titleVector"]) == {"titleVector": []}
+    assert np.allclose(store.get_document("8_0")["chunkVector"], docs[8]["chunkVector"], atol=0.05)
+    assert len(store) == 199
+
+
+def test_sync_to_local_index(tmp_path, start_fakes):
+    fakes = start_fakes(FakeWiki(spaces=2, pages=5, page_bytes=3000), search_type="LOCAL",
+                        local_index_path=str(tmp_path))
+    indexer = fakes.indexer()
+    assert isinstance(indexer, LocalSearchIndexer)
+    counts = sync(config=fakes.config, search=indexer)["counts"]
+    assert (counts["create"], counts["failed"]) == (10, 0)
+    # The saved index is read again by the next run, nothing changed
+    counts = sync(config=fakes.config, search=fakes.indexer())["counts"]
+    assert (counts["create"], counts["update"]) == (0, 0)
+    chunk = next(doc for doc in LocalVectorStore(str(tmp_path)).search(filter="document_id eq '3'"))
+    store = LocalVectorStore(str(tmp_path))
+    results = store.query(fakes.embedder.embed_query(chunk["chunk"]), top=1)
+    assert results[0]["id"] == chunk["id"]
+    # The title vector is stored once per page, with its first chunk
+    assert len(store.vectors["titleVector"]) == 10 < len(store.vectors["chunkVector"])
+    title = store.query(fakes.embedder.embed_query("Page 3"), field="titleVector", top=1)[0]
+    assert title["id"] == "3_0" and title["@search.score"] == pytest.approx(1.0, abs=0.01)
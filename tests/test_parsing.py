@@ -0,0 +1,35 @@
+from benchmarks.fakes import FakeWiki
+from confluence_vector_sync.parsing import StorageFormatChunker, fragments, split_storage_format
+
+
+def test_chunks_follow_the_page_structure():
+    content = ("<p>Intro</p><h1>Install</h1><p>First &amp; only step.</p><h2>Linux</h2>"
+               "<ac:structured-macro ac:name=\"code\"><ac:parameter ac:name=\"language\">bash</ac:parameter>"
+               "<ac:plain-text-body><![CDATA[echo hi\nls -la]]></ac:plain-text-body></ac:structured-macro>"
+               "<table><tr><th>Name</th><th>Value</th></tr><tr><td>a</td><td>1</td></tr></table>"
+               "<h1>Usage</h1><ul><li>one</li><li>two</li></ul>")
+    assert [chunk["text"] for chunk in split_storage_format(content, 200, 50)] == [
+        "Intro",
+        "Install\nFirst & only step.",
+        "Install > Linux\necho hi\nls -la\nName | Value\na | 1",
+        "Usage\none\ntwo"]
+
+
+def test_chunks_are_bounded_and_do_not_depend_on_how_the_page_is_fed():
+    content = FakeWiki(pages=1, page_bytes=30000).body("1")
+    chunks = split_storage_format(content, 500, 100)
+    assert all(len(chunk["text"]) <= 500 for chunk in chunks)
+    # Consecutive chunks of a section overlap
+    overlap = chunks[1]["text"].split("\n")[1]
+    assert overlap and chunks[0]["text"].endswith(overlap)
+    texts = list(StorageFormatChunker(500, 100).chunks(fragments(content, size=7)))
+    assert texts == [chunk["text"] for chunk in chunks]
+
+
+def test_chunks_can_be_measured_in_tokens():
+    content = FakeWiki(pages=1, page_bytes=30000).body("1")
+    # Words stand in for tokens, so the test does not need to download the encoding
+    words = lambda text: len(text.split())
+    texts = list(StorageFormatChunker(100, 20, length=words).chunks(fragments(content)))
+    assert all(words(text) <= 100 for text in texts)
+    assert max(words(text) for text in texts) > 80
@@ -0,0 +1,27 @@
+from confluence_vector_sync.pipeline import Pipeline, Stage
+
+
+def test_items_pass_all_stages():
+    results = []
+    pipeline = Pipeline([Stage("double", lambda x: x * 2, workers=3),
+                         Stage("drop_odd", lambda x: x if x % 4 == 0 else None, workers=2),
+                         Stage("collect", results.append)],
+                        queue_size=2)
+    pipeline.run(range(100))
+    assert sorted(results) == [x for x in range(0, 200, 4)]
+    assert pipeline.stats["double"]["items"] == 100
+    assert pipeline.stats["collect"]["items"] == 50
+
+
+def test_failed_items_are_dropped():
+    results = []
+
+    def fail_on_three(x):
+        if x == 3:
+            raise ValueError("three")
+        return x
+
+    pipeline = Pipeline([Stage("check", fail_on_three, workers=2), Stage("collect", results.append)])
+    pipeline.run(range(5))
+    assert sorted(results) == [0, 1, 2, 4]
+    assert pipeline.stats["check"]["errors"] == 1
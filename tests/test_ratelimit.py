@@ -0,0 +1,62 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from confluence_vector_sync.ratelimit import AdaptiveRateLimiter, throttle_delay
+
+
+class ThrottledError(Exception):
+    def __init__(self, status_code, headers):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(status_code=status_code, headers=headers)
+
+
+def test_throttle_delay():
+    assert throttle_delay(SimpleNamespace(status_code=200, headers={})) is None
+    assert throttle_delay(SimpleNamespace(status_code=429, headers={"Retry-After": "3"})) == 3
+    assert throttle_delay(ThrottledError(503, {"retry-after-ms": "500"})) == 0.5
+    assert throttle_delay(ThrottledError(429, {})) == 0
+    assert throttle_delay(ValueError("not http")) is None
+
+
+def test_retries_throttled_calls_and_backs_off():
+    limiter = AdaptiveRateLimiter("test", max_rate=1000, max_concurrency=8)
+    calls = []
+
+    def flaky():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise ThrottledError(429, {"Retry-After": "0.2"})
+        return "ok"
+
+    assert limiter.call(flaky) == "ok"
+    assert calls[1] - calls[0] >= 0.2
+    assert limiter.stats["throttled"] == 1
+    assert limiter.stats["retries"] == 1
+    assert limiter.stats["concurrency"] == 4
+    assert limiter.stats["wait_seconds"] >= 0.2
+
+
+def test_throttled_response_is_returned_after_max_retries():
+    limiter = AdaptiveRateLimiter("test", max_rate=1000, max_retries=1)
+    response = SimpleNamespace(status_code=429, headers={"Retry-After": "0"})
+    assert limiter.call(lambda: response) is response
+    assert limiter.stats["throttled"] == 1
+
+
+def test_other_errors_are_raised():
+    limiter = AdaptiveRateLimiter("test")
+    with pytest.raises(ThrottledError):
+        limiter.call(lambda: (_ for _ in ()).throw(ThrottledError(400, {})))
+    assert limiter.stats["retries"] == 0
+
+
+def test_paces_requests():
+    limiter = AdaptiveRateLimiter("test", max_rate=20)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.call(lambda: None)
+    # The bucket starts with one token, the other four wait for 1/20s each
+    assert time.monotonic() - start >= 0.19
@@ -0,0 +1,185 @@
+from benchmarks.fakes import FakeWiki
+from confluence_vector_sync.confluence import ConfluenceWrapper, confluence_from_config
+from confluence_vector_sync.journal import RunJournal
+from confluence_vector_sync.parsing import split_storage_format
+from confluence_vector_sync.state import SyncState
+from confluence_vector_sync.sync import plan, prepare, sync
+
+
+def test_sync_against_fakes(start_fakes):
+    wiki = FakeWiki(spaces=2, pages=5, attachments=1, page_bytes=3000)
+    fakes = start_fakes(wiki)
+    counts = sync(config=fakes.config, search=fakes.indexer())["counts"]
+    assert (counts["create"], counts["attachment-create"], counts["failed"]) == (10, 10, 0)
+    assert {doc["document_id"] for doc in fakes.client.documents.values() if doc["item_type"] == "page"} == \
+           {str(i) for i in range(1, 11)}
+    assert all(doc["content_hash"] and len(doc["chunkVector"]) == 8 for doc in fakes.client.documents.values())
+    # The attachments are listed per space (a page of results and the empty end), not per page
+    assert "attachments" not in fakes.server.requests and fakes.server.requests["attachment_inventory"] == 4
+
+    edited = wiki.edit(0.2)
+    removed = next(str(i) for i in range(1, 11) if str(i) not in edited)
+    wiki.removed.add(removed)
+    embedded = fakes.embedder.texts
+    counts = sync(config=fakes.config, search=fakes.indexer())["counts"]
+    assert (counts["create"], counts["update"], counts["remove"], counts["failed"]) == (0, 2, 1, 0)
+    assert not [doc for doc in fakes.client.documents.values() if removed in (doc["document_id"],
+                                                                              doc["attachment_page_id"])]
+    # The chunks of the edited pages were either merged unchanged or embedded again, next to the titles
+    edited_chunks = [doc for doc in fakes.client.documents.values() if doc["document_id"] in edited]
+    assert counts["chunk-unchanged"] + fakes.embedder.texts - embedded == len(edited_chunks) + len(edited)
+
+
+def test_interrupted_run_is_resumed(tmp_path, start_fakes):
+    wiki = FakeWiki(spaces=1, pages=5, page_bytes=6000)
+    fakes = start_fakes(wiki, run_journal_path=str(tmp_path / "journal.db"))
+    journal = sync(config=fakes.config, search=fakes.indexer())["journal"]
+    assert journal["planned"] == journal["uploaded"] == 5
+    confluence = confluence_from_config(fakes.config)
+    confluence.space_filter = fakes.config["confluence_space_filter"]
+    pages = {page.id: page for space in confluence.iter_space_pages() for page in space.pages}
+    # The run was interrupted after uploading one page and only the first chunk of another
+    half = next(page_id for page_id in pages if f"{page_id}_1" in fakes.client.documents)
+    done = next(page_id for page_id in pages if page_id != half)
+    journal = RunJournal(fakes.config["run_journal_path"])
+    journal.plan([pages[done], pages[half]], "upsert")
+    journal.embedded([done])
+    journal.flushed(set())
+    journal.close()
+    del fakes.client.documents[f"{half}_1"]
+
+    diagnostics = sync(config=fakes.config, search=fakes.indexer())
+    assert diagnostics["journal"] == {"resumed": True, "skipped": 1, "redone": 1, "planned": 1, "uploaded": 1}
+    assert diagnostics["counts"]["update"] == 1 and f"{half}_1" in fakes.client.documents
+    # Finished, the next run starts from scratch
+    assert not sync(config=fakes.config, search=fakes.indexer())["journal"]["resumed"]
+
+
+def test_deleted_attachments_are_purged(start_fakes):
+    wiki = FakeWiki(spaces=1, pages=6, attachments=2, page_bytes=3000, attachment_bytes=6000)
+    fakes = start_fakes(wiki)
+    sync(config=fakes.config, search=fakes.indexer())
+    wiki.removed_attachments.update({"att1x0", "att2x1"})
+    wiki.removed.add("3")
+    checks = fakes.server.requests.get("attachment", 0)
+    counts = sync(config=fakes.config, search=fakes.indexer())["counts"]
+    # The page and its attachments, then the two attachments of pages that did not change
+    assert (counts["remove"], counts["update"]) == (3, 0)
+    remaining = {doc["document_id"] for doc in fakes.client.documents.values() if doc["attachment_page_id"]}
+    assert remaining == {f"att{page}x{k}" for page in (1, 2, 4, 5, 6) for k in (0, 1)} - {"att1x0", "att2x1"}
+    # Only the attachments missing from the listing are looked up, once each
+    assert fakes.server.requests["attachment"] - checks == 2
+
+
+def test_boilerplate_is_embedded_once_and_dropped(start_fakes):
+    wiki = FakeWiki(spaces=1, pages=12, page_bytes=3000, templates=2)
+    fakes = start_fakes(wiki, dedup_chunks="near", dedup_drop_after=3)
+    diagnostics = sync(config=fakes.config, search=fakes.indexer())
+    dedup = diagnostics["dedup"]
+    assert dedup["near"] > 0 and dedup["dropped"] > 0
+    chunks = sum(len(split_storage_format(wiki.body(page_id), ConfluenceWrapper.chunk_size,
+                                          ConfluenceWrapper.chunk_overlap)) for page_id in wiki.page_ids("SP0"))
+    assert len(fakes.client.documents) == chunks - dedup["dropped"]
+    assert all(f"{page_id}_0" in fakes.client.documents for page_id in wiki.page_ids("SP0"))
+    # Every chunk and title is embedded or gets the vector of a duplicate
+    assert fakes.embedder.texts + dedup["embeddings_saved"] == len(fakes.client.documents) + 12
+
+
+def test_plan_counts_what_the_sync_does(tmp_path, start_fakes):
+    wiki = FakeWiki(spaces=2, pages=5, page_bytes=6000)
+    fakes = start_fakes(wiki, embedding_dimensions=8, run_profile_path=str(tmp_path / "profile.json"))
+    for _ in range(2):
+        indexed = {key: dict(doc) for key, doc in fakes.client.documents.items()}
+        embedded = fakes.embedder.texts
+        estimate = plan(config=fakes.config, search=fakes.indexer())
+        assert fakes.client.documents == indexed and fakes.embedder.texts == embedded
+        diagnostics = sync(config=fakes.config, search=fakes.indexer())
+        assert estimate["changeset"] == diagnostics["counts"]
+        assert estimate["embedding"]["texts"] == diagnostics["embedding"]["texts"] == fakes.embedder.texts - embedded
+        assert estimate["embedding"]["calls"] == diagnostics["embedding"]["batches"]
+        assert estimate["upload"]["documents"] == diagnostics["upload"]["uploaded"]
+        assert estimate["upload"]["merged"] == diagnostics["upload"]["merged"]
+        wiki.edit(0.2)
+    # The second plan used the latencies that the first sync measured
+    assert estimate["changeset"]["update"] == 2 and estimate["latencies"]["embedding"]["measured"]
+
+
+def test_page_that_failed_to_embed_is_indexed_by_the_next_run(start_fakes):
+    wiki = FakeWiki(spaces=1, pages=3, page_bytes=6000, page_bytes_sigma=0)
+    fakes = start_fakes(wiki, embedding_batch_size=1)
+    broken = split_storage_format(wiki.body("1"), ConfluenceWrapper.chunk_size, ConfluenceWrapper.chunk_overlap)[2]
+    embed_documents = fakes.embedder.embed_documents
+
+    def failing_embed_documents(texts):
+        if broken["text"] in texts:
+            raise RuntimeError("model unavailable")
+        return embed_documents(texts)
+
+    fakes.embedder.embed_documents = failing_embed_documents
+    assert sync(config=fakes.config, search=fakes.indexer())["counts"]["failed"] == 1
+    # Nothing of the page is written, its first chunk would mark it as indexed
+    assert not [key for key in fakes.client.documents if key.startswith("1_")]
+
+    fakes.embedder.embed_documents = embed_documents
+    counts = sync(config=fakes.config, search=fakes.indexer())["counts"]
+    assert (counts["create"], counts["failed"]) == (1, 0)
+    assert "1_2" in fakes.client.documents
+
+
+def test_rejected_documents_fail_their_page(start_fakes):
+    fakes = start_fakes(FakeWiki(spaces=1, pages=3, page_bytes=3000))
+    fakes.client.rejected.add("2_0")
+    assert sync(config=fakes.config, search=fakes.indexer())["counts"]["failed"] == 1
+    fakes.client.rejected.clear()
+    counts = sync(config=fakes.config, search=fakes.indexer())["counts"]
+    assert (counts["create"], counts["failed"]) == (1, 0) and "2_0" in fakes.client.documents
+
+
+def test_incremental_runs_list_the_changed_pages(tmp_path, start_fakes):
+    wiki = FakeWiki(spaces=1, pages=5, page_bytes=3000)
+    fakes = start_fakes(wiki, confluence_incremental=True, sync_state_path=str(tmp_path / "state.json"))
+    sync(config=fakes.config, search=fakes.indexer())
+    assert SyncState(fakes.config["sync_state_path"]).get_watermark("SP0") == wiki.modified("5")
+
+    edited = wiki.edit(0.4)
+    assert sync(config=fakes.config, search=fakes.indexer())["counts"]["update"] == 2
+    assert SyncState(fakes.config["sync_state_path"]).get_watermark("SP0") == max(map(wiki.modified, edited))
+    # The next run lists the pages modified since the day before the watermark, not the whole space
+    confluence = prepare(fakes.config, search=fakes.indexer())[1]
+    space = next(confluence.iter_space_pages())
+    assert not space.reconciled and {page.id for page in space.pages} == set(edited)
+    bodies = fakes.server.requests["bodies"]
+    counts = sync(config=fakes.config, search=fakes.indexer())["counts"]
+    assert not any(counts.values()) and fakes.server.requests["bodies"] == bodies
+
+
+def test_failed_incremental_run_keeps_the_watermark(tmp_path, start_fakes):
+    wiki = FakeWiki(spaces=1, pages=5, page_bytes=3000)
+    fakes = start_fakes(wiki, confluence_incremental=True, sync_state_path=str(tmp_path / "state.json"))
+    sync(config=fakes.config, search=fakes.indexer())
+    edited = wiki.edit(0.4)
+    fakes.client.rejected.add(f"{edited[0]}_0")
+    assert sync(config=fakes.config, search=fakes.indexer())["counts"]["failed"] == 1
+    assert SyncState(fakes.config["sync_state_path"]).get_watermark("SP0") == wiki.modified("5")
+
+    fakes.client.rejected.clear()
+    counts = sync(config=fakes.config, search=fakes.indexer())["counts"]
+    assert (counts["update"], counts["failed"]) == (1, 0)
+    assert SyncState(fakes.config["sync_state_path"]).get_watermark("SP0") == max(map(wiki.modified, edited))
+
+
+def test_deleted_pages_are_removed_when_reconciling(tmp_path, start_fakes):
+    wiki = FakeWiki(spaces=1, pages=5, page_bytes=3000)
+    fakes = start_fakes(wiki, confluence_incremental=True, sync_state_path=str(tmp_path / "state.json"))
+    sync(config=fakes.config, search=fakes.indexer())
+    reconciled = SyncState(fakes.config["sync_state_path"]).get_reconciled("SP0")
+    wiki.removed.add("2")
+    # CQL does not find deleted pages, they stay in the index until the space is listed in full
+    assert sync(config=fakes.config, search=fakes.indexer())["counts"]["remove"] == 0
+    assert "2_0" in fakes.client.documents
+    assert SyncState(fakes.config["sync_state_path"]).get_reconciled("SP0") == reconciled
+
+    fakes.config["confluence_reconcile_hours"] = 0
+    assert sync(config=fakes.config, search=fakes.indexer())["counts"]["remove"] == 1
+    assert "2_0" not in fakes.client.documents
+    assert SyncState(fakes.config["sync_state_path"]).get_reconciled("SP0") > reconciled